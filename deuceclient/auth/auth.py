@@ -2,12 +2,16 @@
 Deuce Authentication API
 """
 import json
-import requests
 import logging
-import datetime
+import threading
 import time
 
-from deuce.common.command import Command
+import requests.exceptions
+
+from deuceclient.auth.tokencache import TokenCache, parse_expiration
+from deuceclient.common.command import Command
+from deuceclient.common.tracing import body_summary, redact_headers, \
+    token_fingerprint
 
 
 # TODO: Add a base Auth class
@@ -42,7 +46,8 @@ class Authentication(Command):
                 'Unknown Data Center: {0:}'.format(datacenter))
 
     def __init__(self, userid, credentials, usertype='user', method='apikey',
-                 datacenter='us'):
+                 datacenter='us', pool=None, token_cache=None,
+                 instrumentation=None):
         """
         Initialize the Agent access
           sslenabled - True if using HTTPS; otherwise False
@@ -56,9 +61,20 @@ class Authentication(Command):
                      ** all lower case **
           userid - username/tenantid/tenantname for the authentication
           credentials - apikey/password/token for the given user
+          datacenter - data center whose identity service to use
+          pool - optional deuceclient.common.pool.ConnectionPool to share
+                 with other clients; defaults to a pool of its own
+          token_cache - optional deuceclient.auth.tokencache.TokenCache
+                        consulted before contacting the identity service
+                        and updated with every new token
+          instrumentation - optional
+                            deuceclient.common.instrumentation.Instrumentation
+                            notified of every request
         """
         apihost = Authentication.__get_identity_apihost(datacenter)
-        super(self.__class__, self).__init__(True, apihost, "/v2.0/tokens")
+        super(self.__class__, self).__init__(True, apihost, "/v2.0/tokens",
+                                             pool=pool,
+                                             instrumentation=instrumentation)
 
         self.log = logging.getLogger(__name__)
         self.parameters = {}
@@ -136,134 +152,282 @@ class Authentication(Command):
 
         self.body = json.dumps(self.o)
         self.auth_data = {}
+        self.catalog = None
+        self.endpoint_regions = None
+        self.tenant_id = None
+        self.mossoid = None
+
+        self.expires_at = 0.0
+
+        self.token_cache = token_cache
+        self.token_cache_key = TokenCache.Key(apihost, userid, usertype,
+                                              method, credentials)
+
+        self.renew_lock = threading.Lock()
+        self.refresher = None
+        self.refresher_stop = threading.Event()
+
+    def __log_request_data(self, request):
+        """
+        (internal) Log the information about the request, without the
+        credentials it carries
+        """
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return
+        self.log.debug('%s %s body: %s headers: %s', request.method,
+                       request.uri, body_summary(request.body),
+                       redact_headers(request.headers))
 
-    def GetToken(self, retry=5):
+    def GetToken(self, retry=5, backoff=0.5, max_backoff=8.0):
         """
         Retrieve the Authentication Tokey
+          retry - times to retry when identity is unavailable (404, 5xx
+                  or a connection failure)
+          backoff - seconds to wait before the first retry; doubled for
+                    every further retry up to max_backoff
 
         Note: This may expire quickly. Tokens are valid for 6 hours
               but are not instance specific
+              Prefer AuthToken, which renews the token only once when
+              several threads find it expired at the same time
         """
-        self.log.debug('host: %s', self.apihost)
-        self.log.debug('body: %s', self.Body)
-        self.log.debug('headers: %s', self.Headers)
-        self.log.debug('uri: %s', self.Uri)
-        response = requests.post(self.Uri,
-                                 headers=self.Headers,
-                                 data=self.Body)
-        if response.status_code is 200:
-            self.auth_data = response.json()
-            self.log.info('auth token: %s',
-                          self.auth_data['access']['token']['id'])
-            self.log.debug('GetToken Response: {0:}'.format(self.auth_data))
-            return self.auth_data['access']['token']['id']
-        elif response.status_code is 404:
-            self.log.error('server return unavailable. Trying again up to '
-                           '{0:} times.'.format(retry))
-            self.log.error('reason: ' + response.reason)
-            if retry is 0:
-                self.log.error('No more retries. Failed.')
-                raise AuthenticationError(
-                    'No more retries for authentication.')
+        attempt = 0
+        while True:
+            request = self.BuildRequest('POST', '/v2.0/tokens',
+                                        body=self.body, operation='GetToken')
+            self.__log_request_data(request)
+            try:
+                response = self.Send(request)
+                reason = '{0:} {1:}'.format(response.status_code,
+                                            response.reason)
+            except requests.exceptions.RequestException as ex:
+                response = None
+                reason = str(ex)
+
+            if response is not None and response.status_code == 200:
+                self.__set_auth_data(response.json())
+                self.log.info('auth token: %s', token_fingerprint(
+                    self.auth_data['access']['token']['id']))
+                if self.token_cache is not None:
+                    self.token_cache.Put(self.token_cache_key, self.auth_data)
+                return self.auth_data['access']['token']['id']
+
+            elif response is None or response.status_code == 404 or \
+                    response.status_code >= 500:
+                self.log.error('server return unavailable ({0:}). '
+                               '{1:} retries left.'.format(reason,
+                                                          retry - attempt))
+                if attempt >= retry:
+                    self.log.error('No more retries. Failed.')
+                    raise AuthenticationError(
+                        'No more retries for authentication.')
+                time.sleep(min(backoff * (2 ** attempt), max_backoff))
+                attempt = attempt + 1
+                if self.instrumentation is not None:
+                    self.instrumentation.RequestRetried('GetToken')
+
+            elif response.status_code >= 400:
+                self.log.error('reason: ' + response.reason)
+                self.log.error('failed to authenticate - {0:}: {1:}'.format(
+                    response.status_code, response.text))
+                # Whatever is cached for these credentials is of no use
+                if self.token_cache is not None:
+                    self.token_cache.Remove(self.token_cache_key)
+                raise AuthCredentialsErrors(
+                    'Failed to authenticate - {0:}: {1:}'.format(
+                        response.status_code, response.text))
+
             else:
-                return self.GetToken(retry - 1)
-        elif response.status_code >= 400:
-            self.log.error('reason: ' + response.reason)
-            self.log.error('failed to authenticate - {0:}: {1:}'.format(
-                response.status_code, response.text))
-        else:
-            self.log.error('reason: ' + response.reason)
-            self.log.error('failed to authenticate: ' + response.text)
-            self.auth_data = {}
-            return ''
+                self.log.error('reason: ' + response.reason)
+                self.log.error('failed to authenticate: ' + response.text)
+                self.__set_auth_data({})
+                return ''
 
-    def IsExpired(self, fuzz=0):
+    @staticmethod
+    def __parse_expiration(expires):
+        """
+        (internal) Convert the token expiration time to seconds since
+        the epoch
         """
-        Checks to see if the auth token has expired by comparing its
-        expiration time stamp to the current time in utc
-        """
-        def time_fuzzy_compare(timeval_older, timeval_newer, new_fuzz):
-            """
-            (internal) Fuzzy Compare two time values
-            """
-
-            def time_layer_compare(val_older, val_newer, next_layer):
-                """
-                (internal) compare layers recursively
-                """
-                if val_older == val_newer:
-                    if next_layer is not None:
-                        return next_layer['call'](next_layer['older'],
-                                                  next_layer['newer'],
-                                                  next_layer['next'])
-                    else:
-                        return True
-                else:
-                    return val_older > val_newer
-
-            time_layers = {
-                'call': time_layer_compare,
-                'older': timeval_older.month,
-                'newer': timeval_newer.month,
-                'next': {
-                    'call': time_layer_compare,
-                    'older': timeval_older.day,
-                    'newer': timeval_newer.day,
-                    'next': {
-                        'call': time_layer_compare,
-                        'older': timeval_older.hour,
-                        'newer': timeval_newer.hour,
-                        'next': {
-                            'call': time_layer_compare,
-                            'older': timeval_older.minute,
-                            'newer': timeval_newer.minute,
-                            'next': {
-                                'call': time_layer_compare,
-                                'older': timeval_older.second,
-                                'newer': (timeval_newer.second + new_fuzz),
-                                'next': None
-                            }
-                        }
-                    }
-                }
-            }
-
-            return time_layer_compare(timeval_older.year,
-                                      timeval_newer.year,
-                                      time_layers)
-
-        # 2013-12-24T14:02:26.550Z
-        expirationtime = datetime.datetime.utcnow()
         try:
-            try:
-                expirationtime = datetime.datetime.strptime(
-                    self.AuthExpirationTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            except ValueError:
-                try:
-                    expirationtime = datetime.datetime.strptime(
-                        self.AuthExpirationTime, "%Y-%m-%dT%H:%M:%S")
-                except ValueError:
-                    msg = 'Unknown time format: {1:}'.format(
-                        self.AuthExpirationTime)
-                    self.log.error(msg)
-                    raise AuthenticationError(msg)
-        except AuthExpirationError:
+            return parse_expiration(expires)
+        except ValueError as ex:
+            raise AuthenticationError(str(ex))
+
+    def __set_auth_data(self, auth_data):
+        """
+        (internal) Install a new identity response, parsing its expiration
+        time once so that validity checks are cheap
+        """
+        expires_at = 0.0
+        try:
+            expires_at = Authentication.__parse_expiration(
+                auth_data['access']['token']['expires'])
+        except LookupError:
             self.log.debug('Not Auth Token data to check against.')
-            return True
+        catalog, endpoint_regions, tenant_id, mossoid = \
+            Authentication.__index_catalog(auth_data)
+        self.auth_data = auth_data
+        self.catalog = catalog
+        self.endpoint_regions = endpoint_regions
+        self.tenant_id = tenant_id
+        self.mossoid = mossoid
+        self.expires_at = expires_at
 
-        nowtime = datetime.datetime.utcnow()
+    @staticmethod
+    def __index_catalog(auth_data):
+        """
+        (internal) Index the service catalog of an identity response
 
-        # Log the times and then do a fuzzy comparison
-        self.log.debug('Current Time: ' + str(nowtime))
-        self.log.debug('Auth Token Expiration Time: ' + str(expirationtime))
-        if time_fuzzy_compare(expirationtime, nowtime, fuzz):
-            self.log.debug(
-                'Auth Token is still valid (fuzz = {0:} seconds)'.format(fuzz))
-            return False
-        else:
-            self.log.debug(
-                'Auth Token is expired (fuzz = {0:} seconds)'.format(fuzz))
-            return True
+        Returns (catalog, endpoint_regions, tenant_id, mossoid) where
+        catalog maps service name to region to the list of its endpoints,
+        in catalog order, and endpoint_regions maps service name to the
+        region of each of its endpoints, in catalog order; both are None if
+        the response has no service catalog
+        """
+        try:
+            tenant_id = auth_data['access']['token']['tenant']['id']
+        except LookupError:
+            tenant_id = None
+
+        try:
+            services = auth_data['access']['serviceCatalog']
+        except LookupError:
+            return (None, None, tenant_id, None)
+
+        catalog = {}
+        endpoint_regions = {}
+        mossoid = None
+        for service in services:
+            regions = catalog.setdefault(service.get('name'), {})
+            region_list = endpoint_regions.setdefault(service.get('name'), [])
+            service_mossoid = None
+            for endpoint in service.get('endpoints', []):
+                regions.setdefault(endpoint.get('region'), []).append(
+                    endpoint)
+                region_list.append(endpoint.get('region'))
+                if service_mossoid is None and endpoint.get('tenantId'):
+                    service_mossoid = endpoint['tenantId']
+            if service.get('name') == 'cloudFiles' and \
+                    service_mossoid is not None:
+                mossoid = service_mossoid
+        return (catalog, endpoint_regions, tenant_id, mossoid)
+
+    def __service_regions(self, name):
+        """
+        (internal) Map of region to endpoints of a service in the catalog,
+        authenticating first if there is no catalog yet
+        """
+        if self.catalog is None:
+            # We need the auth data so we must have an Auth Token
+            token = self.AuthToken  # noqa
+        if self.catalog is None:
+            raise LookupError('serviceCatalog')
+        return self.catalog.get(name, {})
+
+    def IsExpired(self, fuzz=0):
+        """
+        Checks to see if the auth token has expired, or will within fuzz
+        seconds, by comparing its expiration time to the current time
+        """
+        return time.time() + fuzz >= self.expires_at
+
+    def StartRefresher(self, lead_time=300, retry_interval=10):
+        """
+        Start a background thread renewing the token ahead of its expiration
+        so that callers of AuthToken never wait on the identity service
+          lead_time - seconds before expiration to renew the token
+          retry_interval - seconds to wait after a failed renewal
+        """
+        if self.refresher is not None and self.refresher.is_alive():
+            return
+
+        self.refresher_stop.clear()
+        self.refresher = threading.Thread(target=self.__refresh,
+                                          args=(lead_time, retry_interval),
+                                          name='deuce-token-refresher')
+        self.refresher.daemon = True
+        self.refresher.start()
+
+    def StopRefresher(self):
+        """
+        Stop the background token refresher
+        """
+        self.refresher_stop.set()
+        if self.refresher is not None:
+            self.refresher.join()
+            self.refresher = None
+
+    def __refresh(self, lead_time, retry_interval):
+        """
+        (internal) Background token refresher loop
+        """
+        while True:
+            delay = max(self.expires_at - lead_time - time.time(), 0)
+            if self.refresher_stop.wait(delay):
+                return
+            try:
+                self.log.info('Renewing token ahead of expiration')
+                self.__renew(lead_time)
+                if self.IsExpired(fuzz=lead_time):
+                    raise AuthenticationError('Token was not renewed')
+            except Exception as ex:
+                self.log.error('Failed to renew token: %s', ex)
+                if self.refresher_stop.wait(retry_interval):
+                    return
+
+    def __renew(self, fuzz):
+        """
+        (internal) Renew the token unless it is valid for another fuzz
+        seconds, making sure only one thread contacts identity at a time
+
+        While another thread is renewing, callers keep using the current
+        token as long as it has not actually expired; otherwise they wait
+        for the renewal and use its result.
+        """
+        if not self.renew_lock.acquire(False):
+            if not self.IsExpired():
+                return self.auth_data['access']['token']['id']
+            self.renew_lock.acquire()
+
+        try:
+            # Another thread or process may have renewed it meanwhile
+            if self.IsExpired(fuzz) and self.token_cache is not None:
+                self.__load_cached_token()
+            if self.IsExpired(fuzz):
+                return self.GetToken()
+            return self.auth_data['access']['token']['id']
+        finally:
+            self.renew_lock.release()
+
+    def InvalidateToken(self, token=None):
+        """
+        Forget the current token, e.g. after a server rejected it, in this
+        object and in the token cache; the next AuthToken obtains a new one
+          token - the token that was rejected; nothing is done if it has
+                  already been replaced
+        """
+        try:
+            current = self.auth_data['access']['token']['id']
+        except LookupError:
+            current = None
+        if token is not None and token != current:
+            return
+
+        self.log.warning('Discarding rejected token %s',
+                         token_fingerprint(current))
+        self.expires_at = 0.0
+        if self.token_cache is not None:
+            self.token_cache.Remove(self.token_cache_key, current)
+
+    def __load_cached_token(self):
+        """
+        (internal) Adopt the token in the token cache, if there is one
+        """
+        auth_data = self.token_cache.Get(self.token_cache_key)
+        if auth_data:
+            self.log.debug('Using cached token')
+            self.__set_auth_data(auth_data)
 
     @property
     def AuthToken(self):
@@ -273,15 +437,10 @@ class Authentication(Command):
         Note: See GetToken()
         """
         try:
-            if self.IsExpired():
-                # Obviously expired
-                return self.GetToken()
-            elif self.IsExpired(fuzz=2):
-                # Near expiration
-                self.log.info(
-                    'Token about to expire. Waiting 3 seconds to renew')
-                time.sleep(3)
-                return self.GetToken()
+            if self.IsExpired(fuzz=2):
+                # Expired or about to; a running refresher normally
+                # renews the token long before this happens
+                return self.__renew(2)
             else:
                 return self.auth_data['access']['token']['id']
         except LookupError:
@@ -299,18 +458,24 @@ class Authentication(Command):
             raise AuthExpirationError(
                 'AuthToken Expiration Time Not available.')
 
+    @property
+    def AuthExpirationTimestamp(self):
+        """
+        Retrieve the time the AuthToken expires in seconds since the epoch
+        """
+        return self.expires_at
+
     @property
     def AuthTenantId(self):
         """
         Retrieve the User Account Identifier
         """
-        try:
-            return self.auth_data['access']['token']['tenant']['id']
-        except LookupError:
+        if self.tenant_id is None:
             self.log.error('Unable to retrieve User Identifier. '
                            'Did you authenticate?')
             raise AuthenticationError('Unable to retrieve User Identifier. '
                                       'Did you authenticate?')
+        return self.tenant_id
 
     @property
     def AuthTenantName(self):
@@ -343,19 +508,11 @@ class Authentication(Command):
 
         Note: Assumes all DCs have the same mossoid
         """
-        try:
-            mossoid = None
-            for service in self.auth_data['access']['serviceCatalog']:
-                if service['name'] == 'cloudFiles':
-                    for endpoint in service['endpoints']:
-                        if len(endpoint['tenantId']):
-                            mossoid = endpoint['tenantId']
-                            break
-            return mossoid
-        except LookupError:
+        if self.catalog is None:
             msg = 'Unable to retrieve MossoID. Did you authenticate?'
             self.log.error(msg)
             raise AuthenticationError(msg)
+        return self.mossoid
 
     @property
     def AllCredentials(self, get_credentials=False):
@@ -366,27 +523,21 @@ class Authentication(Command):
 
         Note: get_credentials is RAX specific
         """
-        headers = self.Headers
-        headers['X-Auth-Token'] = self.AuthToken
-        old_uri = self.uri
         if not get_credentials:
-            self.ReInit(True,
-                        '/v2.0/users/{0:}/OS-KSADM/credentials'.format(
-                            self.AuthUserId))
+            uripath = '/v2.0/users/{0:}/OS-KSADM/credentials'.format(
+                self.AuthUserId)
         else:
-            self.ReInit(True,
-                        '/v2.0/users/{0:}/OS-KSADM/credentials/'
-                        'RAX-KSKEY:apiKeyCredentials'.format(
-                            self.parameters['userid']))
-
-        self.log.debug('host: %s', self.apihost)
-        self.log.debug('body: %s', self.Body)
-        self.log.debug('headers: %s', headers)
-        self.log.debug('uri: %s', self.Uri)
-        response = requests.get(self.Uri, headers=headers)
-
-        self.log.debug('Response ({0:}): {1:}'.format(response.status_code,
-                                                      response.text))
+            uripath = '/v2.0/users/{0:}/OS-KSADM/credentials/' \
+                      'RAX-KSKEY:apiKeyCredentials'.format(
+                          self.parameters['userid'])
+        request = self.BuildRequest('GET', uripath,
+                                    headers={'X-Auth-Token': self.AuthToken},
+                                    operation='AllCredentials')
+
+        self.__log_request_data(request)
+        response = self.Send(request)
+
+        self.log.debug('Response (%s)', response.status_code)
         if response.status_code in (200, 203):
             return response.json()
         elif response.status_code == 404:
@@ -400,22 +551,16 @@ class Authentication(Command):
             raise AuthenticationError('Error ({0:}: {1:}'.format(
                 response.status_code, response.text))
 
-        self.uri = old_uri
-
     def GetCloudFilesDataCenters(self):
         """
         Retrieve the list of Data Centers for the authentication
-        Returns an array of data centers
+        Returns an array of data centers, one per endpoint in catalog
+        order, so a data center with several endpoints is listed several
+        times
         """
         try:
-            # We need the auth data so we must have an Auth Token
-            token = self.AuthToken  # noqa
-            dclist = []
-            for service in self.auth_data['access']['serviceCatalog']:
-                if service['name'] == 'cloudFiles':
-                    for endpoint in service['endpoints']:
-                        dclist.append(endpoint['region'])
-            return dclist
+            self.__service_regions('cloudFiles')
+            return list(self.endpoint_regions.get('cloudFiles', []))
         except LookupError:
             msg = 'Unable to retrieve list of DCs for the currently ' \
                   'authenticated user'
@@ -429,21 +574,16 @@ class Authentication(Command):
         Returns an array of dictionaries containing 'name' and 'uri' pairs
         """
         try:
-            # We need the auth data so we must have an Auth Token
-            token = self.AuthToken  # noqa
             dcuri = []
-            for service in self.auth_data['access']['serviceCatalog']:
-                if service['name'] == 'cloudFiles':
-                    for endpoint in service['endpoints']:
-                        if endpoint['region'] == dc:
-                            publicuri = {}
-                            publicuri['name'] = 'public'
-                            publicuri['uri'] = endpoint['publicURL']
-                            dcuri.append(publicuri)
-                            sneturi = {}
-                            sneturi['name'] = 'snet'
-                            sneturi['uri'] = endpoint['internalURL']
-                            dcuri.append(sneturi)
+            for endpoint in self.__service_regions('cloudFiles').get(dc, []):
+                publicuri = {}
+                publicuri['name'] = 'public'
+                publicuri['uri'] = endpoint['publicURL']
+                dcuri.append(publicuri)
+                sneturi = {}
+                sneturi['name'] = 'snet'
+                sneturi['uri'] = endpoint['internalURL']
+                dcuri.append(sneturi)
             return dcuri
         except LookupError:
             msg = 'Unable to retrieve DC URI for the currently ' \
@@ -460,18 +600,14 @@ class Authentication(Command):
         dc = dc.upper()
 
         try:
-            # We need the auth data so we must have an Auth Token
-            token = self.AuthToken  # noqa
             dcuri = None
+            endpoints = self.__service_regions('cloudBackup').get(dc, [])
 
-            for service in self.auth_data['access']['serviceCatalog']:
-                if service['name'] == 'cloudBackup':
-                    for endpoint in service['endpoints']:
-                        if endpoint['region'] == dc:
-                            if useServiceNet:
-                                dcuri = endpoint['internalURL']
-                            else:
-                                dcuri = endpoint['publicURL']
+            for endpoint in endpoints:
+                if useServiceNet:
+                    dcuri = endpoint['internalURL']
+                else:
+                    dcuri = endpoint['publicURL']
             if dcuri is None:
                 msg = 'Unable to find DC URI for the ' \
                       'currently authenticated user'
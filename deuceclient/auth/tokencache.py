@@ -0,0 +1,172 @@
+"""
+Deuce Authentication Token Cache
+
+Shares authentication tokens between processes through a file so that
+short-lived processes do not each have to contact the identity service.
+"""
+import calendar
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def parse_expiration(expires):
+    """
+    Convert the expiration time of an identity token, e.g.
+    2013-12-24T14:02:26.550Z, to seconds since the epoch
+
+    Raises ValueError for an unknown format
+    """
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%fZ',
+                        '%Y-%m-%dT%H:%M:%SZ',
+                        '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return calendar.timegm(time.strptime(expires, time_format))
+        except ValueError:
+            pass
+    raise ValueError('Unknown time format: {0:}'.format(expires))
+
+
+class TokenCache(object):
+    """
+    On-disk cache of identity responses
+
+    Entries are kept in a single JSON file readable only by its owner and
+    keyed by a digest of the identity host, user, user type, method and
+    credentials. Readers and writers serialize on a lock file next to it.
+    Expired entries are dropped whenever an entry is stored.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialize the cache
+          path - cache file; defaults to ~/.deuceclient/tokens.json
+        """
+        self.log = logging.getLogger(__name__)
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.deuceclient',
+                                'tokens.json')
+        self.path = path
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+    @property
+    def Path(self):
+        """Cache file"""
+        return self.path
+
+    @staticmethod
+    def Key(apihost, userid, usertype, method, credentials):
+        """
+        Return the cache key for a set of authentication parameters
+        """
+        material = '\n'.join([apihost, userid, usertype, method,
+                              hashlib.sha1(credentials.encode('utf-8'))
+                              .hexdigest()])
+        return hashlib.sha1(material.encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def __locked(self, exclusive):
+        """
+        (internal) Hold the cache lock for the duration of the block
+        """
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def __read(self):
+        """
+        (internal) Load all entries; a missing or corrupt file is empty
+        """
+        try:
+            with open(self.path, 'r') as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def __write(self, entries):
+        """
+        (internal) Atomically replace the cache file
+        """
+        temp_path = '{0:}.{1:}.tmp'.format(self.path, os.getpid())
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def __token(auth_data):
+        """
+        (internal) Token id of an identity response, or None
+        """
+        try:
+            return auth_data['access']['token']['id']
+        except (LookupError, TypeError):
+            return None
+
+    @staticmethod
+    def __expired(auth_data, now):
+        """
+        (internal) True if the token of an identity response has expired
+        or its expiration time cannot be read
+        """
+        try:
+            return parse_expiration(
+                auth_data['access']['token']['expires']) <= now
+        except (LookupError, TypeError, ValueError):
+            return True
+
+    def Get(self, key):
+        """
+        Return the cached identity response for key, or None
+        """
+        with self.__locked(exclusive=False):
+            return self.__read().get(key)
+
+    def Put(self, key, auth_data):
+        """
+        Store the identity response for key
+        """
+        now = time.time()
+        with self.__locked(exclusive=True):
+            entries = dict((other, data)
+                           for other, data in self.__read().items()
+                           if not TokenCache.__expired(data, now))
+            entries[key] = auth_data
+            self.__write(entries)
+        self.log.debug('Cached token for key %s', key)
+
+    def Remove(self, key, token=None):
+        """
+        Drop the entry for key, e.g. after the server rejected its token
+          token - only drop the entry if it still holds this token, so that
+                  a token another process has since stored is kept
+        """
+        with self.__locked(exclusive=True):
+            entries = self.__read()
+            if key not in entries:
+                return
+            if token is not None and \
+                    TokenCache.__token(entries[key]) != token:
+                return
+            del entries[key]
+            self.__write(entries)
+        self.log.debug('Removed cached token for key %s', key)
@@ -0,0 +1,3 @@
+"""
+Deuce Client Benchmarks
+"""
@@ -0,0 +1,152 @@
+"""
+Run the Deuce Client benchmarks
+
+    python -m deuceclient.benchmark --output results.json
+    python -m deuceclient.benchmark --baseline previous.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import logging
+import sys
+
+from deuceclient.benchmark.runner import BenchmarkRunner, CHUNKERS
+from deuceclient.benchmark.runner import CompareResults
+
+
+def __size(value):
+    """
+    Parse a size, allowing K and M suffixes
+    """
+    value = value.strip().upper()
+    if value.endswith('K'):
+        return int(value[:-1]) * 1024
+    elif value.endswith('M'):
+        return int(value[:-1]) * 1024 * 1024
+    return int(value)
+
+
+def __int_list(value):
+    """
+    Parse a comma separated list of sizes
+    """
+    return [__size(item) for item in value.split(',')]
+
+
+def __float_list(value):
+    return [float(item) for item in value.split(',')]
+
+
+def __chunker_list(value):
+    """
+    Parse a comma separated list of chunker names
+    """
+    chunkers = [item.strip() for item in value.split(',')]
+    for chunker in chunkers:
+        if chunker not in CHUNKERS:
+            raise argparse.ArgumentTypeError(
+                'unknown chunker {0:}; choose from {1:}'.format(
+                    chunker, ', '.join(CHUNKERS)))
+    return chunkers
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Deuce Client Benchmarks')
+    arg_parser.add_argument('--block-sizes',
+                            default=[64 * 1024, 1024 * 1024],
+                            type=__int_list,
+                            dest='block_sizes',
+                            help='Comma separated block sizes, e.g. 64K,1M.'
+                                 ' Default: 64K,1M')
+    arg_parser.add_argument('--concurrency',
+                            default=[1, 8],
+                            type=__int_list,
+                            dest='concurrency',
+                            help='Comma separated numbers of parallel'
+                                 ' requests. Default: 1,8')
+    arg_parser.add_argument('--latency-ms',
+                            default=[0.0],
+                            type=__float_list,
+                            dest='latencies',
+                            help='Comma separated milliseconds the server'
+                                 ' adds to every request. Default: 0')
+    arg_parser.add_argument('--file-size',
+                            default=16 * 1024 * 1024,
+                            type=__size,
+                            dest='file_size',
+                            help='Size of the uploaded and downloaded file.'
+                                 ' Default: 16M')
+    arg_parser.add_argument('--chunkers',
+                            default=list(CHUNKERS),
+                            type=__chunker_list,
+                            dest='chunkers',
+                            help='Comma separated chunkers the file'
+                                 ' operations are measured with.'
+                                 ' Default: fixed,content-defined')
+    arg_parser.add_argument('--operations',
+                            default=200,
+                            type=int,
+                            dest='operations',
+                            help='Most calls per operation measured.'
+                                 ' Default: 200')
+    arg_parser.add_argument('--output',
+                            default=None,
+                            type=argparse.FileType('w'),
+                            dest='output',
+                            help='Write the JSON results to this file'
+                                 ' instead of stdout')
+    arg_parser.add_argument('--baseline',
+                            default=None,
+                            type=argparse.FileType('r'),
+                            dest='baseline',
+                            help='JSON results of an earlier run to compare'
+                                 ' against; exits with 1 on a regression')
+    arg_parser.add_argument('--threshold',
+                            default=0.10,
+                            type=float,
+                            dest='threshold',
+                            help='Fractional throughput drop reported as a'
+                                 ' regression. Default: 0.10')
+    arg_parser.add_argument('-v', '--verbose',
+                            default=False,
+                            action='store_true',
+                            dest='verbose',
+                            help='Log each measurement as it completes')
+    arguments = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if arguments.verbose else logging.WARNING)
+    # Failed calls are counted in the results, not logged
+    logging.getLogger('deuceclient.client').setLevel(logging.CRITICAL)
+
+    runner = BenchmarkRunner(
+        block_sizes=arguments.block_sizes,
+        concurrency=arguments.concurrency,
+        latencies=[latency / 1000.0 for latency in arguments.latencies],
+        file_size=arguments.file_size,
+        operations=arguments.operations,
+        chunkers=arguments.chunkers)
+    results = runner.Run()
+
+    output = arguments.output or sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+    if arguments.baseline is not None:
+        comparison = CompareResults(json.load(arguments.baseline), results,
+                                    threshold=arguments.threshold)
+        regressions = [entry for entry in comparison if entry['regression']]
+        for entry in regressions:
+            print('REGRESSION {operation} latency={latency} '
+                  'block_size={block_size} concurrency={concurrency} '
+                  'chunker={chunker}: '
+                  '{metric} {baseline:.2f} -> {current:.2f}'.format(**entry),
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
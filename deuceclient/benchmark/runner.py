@@ -0,0 +1,388 @@
+"""
+Deuce Client Benchmarks
+
+Measure the throughput of every DeuceClient operation, and of whole-file
+uploads and downloads with each chunker, against the in-process
+FakeDeuceServer across block sizes, concurrency levels and injected
+latencies.
+"""
+import concurrent.futures
+import hashlib
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+import deuceclient
+from deuceclient.benchmark.server import FakeDeuceServer
+from deuceclient.benchmark.server import StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient
+from deuceclient.common.chunker import build_assignment
+from deuceclient.common.chunker import ContentDefinedChunker
+from deuceclient.common.chunker import FixedSizeChunker
+from deuceclient.common.pool import ConnectionPool
+
+
+RESULTS_FORMAT = 1
+
+CHUNKERS = ('fixed', 'content-defined')
+
+# Operations measured once per chunker
+FILE_OPERATIONS = ('UploadFile', 'DownloadFile')
+
+
+def _percentile(samples, fraction):
+    """
+    Return the sample at the given fraction of the sorted samples
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class BenchmarkRunner(object):
+    """
+    Run the benchmark matrix and collect the results
+
+        runner = BenchmarkRunner(block_sizes=[65536], concurrency=[1, 8])
+        results = runner.Run()
+    """
+
+    def __init__(self, block_sizes=(64 * 1024, 1024 * 1024),
+                 concurrency=(1, 8), latencies=(0.0,),
+                 file_size=16 * 1024 * 1024, operations=200,
+                 chunkers=CHUNKERS):
+        """
+        Initialize the runner
+          block_sizes - block sizes, in bytes, to measure
+          concurrency - numbers of parallel requests to measure
+          latencies - seconds the server adds to every request
+          file_size - size of the file uploaded and downloaded; it also
+                      bounds the data used by the per-block operations
+          operations - most calls made per measurement of a single
+                       operation
+          chunkers - chunkers the file operations are measured with, from
+                     CHUNKERS. For 'content-defined' the block size,
+                     rounded down to a power of two, is the average, with
+                     blocks from a quarter to four times that
+        """
+        for chunker in chunkers:
+            if chunker not in CHUNKERS:
+                raise ValueError('Unknown chunker: {0:}'.format(chunker))
+        self.log = logging.getLogger(__name__)
+        self.block_sizes = list(block_sizes)
+        self.concurrency = list(concurrency)
+        self.latencies = list(latencies)
+        self.file_size = file_size
+        self.operations = operations
+        self.chunkers = list(chunkers)
+
+    @staticmethod
+    def __measure(operation, calls, concurrency, func):
+        """
+        (internal) Time calls of func spread over concurrency threads
+          calls - list of argument tuples, one per call
+          func - returns the number of bytes the call transferred
+
+        Returns the measurement as a dictionary
+        """
+        lock = threading.Lock()
+        latencies = []
+        errors = [0]
+        transferred = [0]
+
+        def timed(args):
+            start = time.time()
+            try:
+                size = func(*args)
+            except Exception:
+                size = None
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                if size is None:
+                    errors[0] += 1
+                else:
+                    transferred[0] += size
+
+        start = time.time()
+        if concurrency == 1:
+            for args in calls:
+                timed(args)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=concurrency) as executor:
+                list(executor.map(timed, calls))
+        elapsed = max(time.time() - start, 1e-9)
+
+        return {
+            'operation': operation,
+            'calls': len(calls),
+            'errors': errors[0],
+            'seconds': elapsed,
+            'bytes': transferred[0],
+            'ops_per_sec': len(calls) / elapsed,
+            'mb_per_sec': transferred[0] / elapsed / (1024 * 1024),
+            'latency_p50': _percentile(latencies, 0.50),
+            'latency_p99': _percentile(latencies, 0.99)
+        }
+
+    def __run_operations(self, client, vaultname, block_size, concurrency):
+        """
+        (internal) Measure every operation for one block size and
+        concurrency level
+        """
+        results = []
+        count = max(1, min(self.operations, self.file_size // block_size))
+        blocks = []
+        for offset in range(0, count * block_size, block_size):
+            data = os.urandom(block_size)
+            blocks.append((hashlib.sha1(data).hexdigest(), offset,
+                           block_size, data))
+
+        def measure(operation, calls, func):
+            result = BenchmarkRunner.__measure(operation, calls, concurrency,
+                                               func)
+            self.log.info('%s: %.1f ops/s %.2f MB/s', operation,
+                          result['ops_per_sec'], result['mb_per_sec'])
+            results.append(result)
+
+        def call(func):
+            def wrapper(*args):
+                func(*args)
+                return 0
+            return wrapper
+
+        names = ['{0:}-{1:}'.format(vaultname, i) for i in range(count)]
+        measure('CreateVault', [(name,) for name in names],
+                call(client.CreateVault))
+        # Against empty vaults: the server answers GETs of vaults holding
+        # blocks with their statistics, which VaultExists rejects (see
+        # FakeDeuceServer.get_vault)
+        measure('VaultExists', [(name,) for name in names],
+                call(client.VaultExists))
+        measure('DeleteVault', [(name,) for name in names],
+                call(client.DeleteVault))
+
+        client.CreateVault(vaultname)
+
+        def upload(blockid, data):
+            client.UploadBlock(vaultname, blockid, data)
+            return len(data)
+
+        def download(blockid, data):
+            return len(client.GetBlockData(vaultname, blockid))
+
+        buffers = threading.local()
+
+        def download_into(blockid, data):
+            if getattr(buffers, 'buffer', None) is None:
+                buffers.buffer = bytearray(block_size)
+            return client.GetBlockDataInto(vaultname, blockid,
+                                           buffers.buffer)
+
+        def upload_all():
+            transfer = client.UploadBlocks(vaultname, blocks,
+                                           concurrency=concurrency)
+            if not transfer.Succeeded:
+                raise RuntimeError('Upload failed')
+            return transfer.BytesTransferred
+
+        block_calls = [(block[0], block[3]) for block in blocks]
+        measure('UploadBlock', block_calls, upload)
+        # A single call uploading every block on its own workers
+        result = BenchmarkRunner.__measure('UploadBlocks', [()], 1,
+                                           upload_all)
+        result['ops_per_sec'] = result['ops_per_sec'] * count
+        self.log.info('UploadBlocks: %.1f blocks/s %.2f MB/s',
+                      result['ops_per_sec'], result['mb_per_sec'])
+        results.append(result)
+        measure('GetBlockData', block_calls, download)
+        measure('GetBlockDataInto', block_calls, download_into)
+        measure('GetVaultStatistics', [(vaultname,)] * count,
+                call(client.GetVaultStatistics))
+
+        # Listing: 100 entries per page
+        markers = [None] + sorted(block[0] for block in blocks)[::100][1:]
+        measure('GetBlockList', [(vaultname, marker, 100)
+                                 for marker in markers],
+                call(client.GetBlockList))
+
+        # Assignment: each call assigns 100 blocks to its own file
+        batches = [blocks[i:i + 100] for i in range(0, count, 100)]
+        fileids = [client.CreateFile(vaultname).rstrip('/').split('/')[-1]
+                   for batch in batches]
+        measure('AssignBlocksToFile',
+                [(vaultname, fileid, build_assignment(batch))
+                 for fileid, batch in zip(fileids, batches)],
+                call(client.AssignBlocksToFile))
+        measure('GetFileBlockList',
+                [(vaultname, fileid, None, 100) for fileid in fileids],
+                call(client.GetFileBlockList))
+        measure('FinalizeFile', [(vaultname, fileid) for fileid in fileids],
+                call(client.FinalizeFile))
+
+        measure('DeleteBlock', [(vaultname, block[0]) for block in blocks],
+                call(client.DeleteBlock))
+        return results
+
+    @staticmethod
+    def __chunker(name, block_size):
+        """
+        (internal) Build the chunker called name for a block size
+
+        Returns (chunker, average block size)
+        """
+        if name == 'content-defined':
+            avg_size = 1 << (block_size.bit_length() - 1)
+            return (ContentDefinedChunker(min_size=max(avg_size // 4, 1),
+                                          avg_size=avg_size,
+                                          max_size=avg_size * 4),
+                    avg_size)
+        return (FixedSizeChunker(block_size), block_size)
+
+    def __run_files(self, client, vaultname, source, workdir, block_size,
+                    concurrency, chunker_name):
+        """
+        (internal) Measure whole-file upload and download with a chunker
+        """
+        results = []
+        client.CreateVault(vaultname)
+        fileid = [None]
+        chunker, avg_size = BenchmarkRunner.__chunker(chunker_name,
+                                                      block_size)
+
+        def upload_file():
+            fileid[0] = client.UploadFile(vaultname, source, chunker=chunker,
+                                          concurrency=concurrency)
+            return self.file_size
+
+        def download_file():
+            transfer = client.DownloadFile(vaultname, fileid[0],
+                                           os.path.join(workdir, 'download'),
+                                           concurrency=concurrency)
+            if not transfer.Succeeded:
+                raise RuntimeError('Download failed')
+            return transfer.BytesTransferred
+
+        for operation, func in (('UploadFile', upload_file),
+                                ('DownloadFile', download_file)):
+            result = BenchmarkRunner.__measure(operation, [()], 1, func)
+            result['ops_per_sec'] = result['ops_per_sec'] * \
+                (self.file_size // avg_size or 1)
+            result['chunker'] = chunker_name
+            self.log.info('%s (%s): %.2f MB/s', operation, chunker_name,
+                          result['mb_per_sec'])
+            results.append(result)
+        return results
+
+    def Run(self):
+        """
+        Run every combination of latency, block size and concurrency
+
+        Returns a JSON-serializable dictionary; ops_per_sec of UploadBlocks
+        and of the file operations counts blocks
+        """
+        workdir = tempfile.mkdtemp(prefix='deuce-benchmark-')
+        server = FakeDeuceServer()
+        server.Start()
+        pool = ConnectionPool(pool_maxsize=max(self.concurrency))
+        client = DeuceClient(False, StaticAuthenticator(), server.ApiHost,
+                             pool=pool)
+        results = []
+        try:
+            source = os.path.join(workdir, 'source')
+            with open(source, 'wb') as source_file:
+                remaining = self.file_size
+                while remaining:
+                    piece = min(remaining, 4 * 1024 * 1024)
+                    source_file.write(os.urandom(piece))
+                    remaining = remaining - piece
+
+            for latency in self.latencies:
+                server.Latency = latency
+                for block_size in self.block_sizes:
+                    for concurrency in self.concurrency:
+                        self.log.info('latency %.3fs, block size %d, '
+                                      'concurrency %d', latency, block_size,
+                                      concurrency)
+                        server.Reset()
+                        measured = self.__run_operations(
+                            client, 'bench', block_size, concurrency)
+                        for chunker in self.chunkers:
+                            server.Reset()
+                            measured.extend(self.__run_files(
+                                client, 'bench-files', source, workdir,
+                                block_size, concurrency, chunker))
+                        for result in measured:
+                            result['latency'] = latency
+                            result['block_size'] = block_size
+                            result['concurrency'] = concurrency
+                        results.extend(measured)
+        finally:
+            pool.close()
+            server.Stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        return {
+            'format': RESULTS_FORMAT,
+            'client_version': deuceclient.version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+            'parameters': {
+                'block_sizes': self.block_sizes,
+                'concurrency': self.concurrency,
+                'latencies': self.latencies,
+                'file_size': self.file_size,
+                'operations': self.operations,
+                'chunkers': self.chunkers
+            },
+            'results': results
+        }
+
+
+def _result_key(result):
+    chunker = None
+    if result['operation'] in FILE_OPERATIONS:
+        # Results from before chunkers were measured used fixed blocks
+        chunker = result.get('chunker', 'fixed')
+    return (result['operation'], result['latency'], result['block_size'],
+            result['concurrency'], chunker)
+
+
+def CompareResults(baseline, current, threshold=0.10):
+    """
+    Compare two sets of results from BenchmarkRunner.Run()
+      threshold - fractional throughput drop reported as a regression
+
+    Returns a list of dictionaries, one per measurement present in both,
+    with the baseline and current throughput, their ratio and whether it
+    regressed. MB/s is compared where data was moved; otherwise ops/sec.
+    """
+    previous = dict((_result_key(result), result)
+                    for result in baseline['results'])
+    comparison = []
+    for result in current['results']:
+        before = previous.get(_result_key(result))
+        if before is None:
+            continue
+        metric = 'mb_per_sec' if before['bytes'] else 'ops_per_sec'
+        ratio = result[metric] / before[metric] if before[metric] else 1.0
+        comparison.append({
+            'operation': result['operation'],
+            'latency': result['latency'],
+            'block_size': result['block_size'],
+            'concurrency': result['concurrency'],
+            'chunker': _result_key(result)[-1],
+            'metric': metric,
+            'baseline': before[metric],
+            'current': result[metric],
+            'ratio': ratio,
+            'regression': ratio < 1.0 - threshold
+        })
+    return comparison
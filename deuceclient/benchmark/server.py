@@ -0,0 +1,324 @@
+"""
+In-process Deuce API Stand-in
+
+A small, thread-safe, in-memory implementation of the Deuce REST API
+(vaults, blocks, files, block assignment and pagination) for benchmarks
+and local experiments. It does not authenticate requests.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+class StaticAuthenticator(object):
+    """
+    Stand-in for deuceclient.auth.auth.Authentication that never expires
+    """
+
+    def __init__(self, token='fake-token', tenantid='fake-tenant'):
+        self.AuthToken = token
+        self.AuthTenantId = tenantid
+        self.MossoId = tenantid
+
+    def InvalidateToken(self, token=None):
+        pass
+
+
+class FakeVault(object):
+    """
+    Contents of a vault
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.files = {}
+        self.finalized = set()
+
+
+class FakeDeuceHandler(BaseHTTPRequestHandler):
+    """
+    Request handler dispatching to the owning FakeDeuceServer
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        (re.compile(r'^/v1\.0/(?P<vault>[^/]+)$'), 'vault'),
+        (re.compile(r'^/v1\.0/(?P<vault>[^/]+)/blocks$'), 'blocks'),
+        (re.compile(r'^/v1\.0/(?P<vault>[^/]+)/blocks/(?P<block>[^/]+)$'),
+         'block'),
+        (re.compile(r'^/v1\.0/(?P<vault>[^/]+)/files$'), 'files'),
+        (re.compile(r'^/v1\.0/(?P<vault>[^/]+)/files/(?P<file>[^/]+)$'),
+         'file'),
+        (re.compile(r'^/v1\.0/(?P<vault>[^/]+)/files/(?P<file>[^/]+)'
+                    r'/blocks$'), 'file_blocks'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def __dispatch(self, method):
+        url = urlparse(self.path)
+        query = dict((key, values[0])
+                     for key, values in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        for pattern, name in FakeDeuceHandler.ROUTES:
+            match = pattern.match(url.path)
+            if match is not None:
+                handler = getattr(self.server.deuce,
+                                  '{0:}_{1:}'.format(method, name), None)
+                if handler is None:
+                    break
+                status, headers, data = handler(query=query, body=body,
+                                                **match.groupdict())
+                return self.__respond(status, headers, data)
+        return self.__respond(404, {}, b'')
+
+    def __respond(self, status, headers, data):
+        if data is None:
+            data = b''
+        elif not isinstance(data, bytes):
+            data = json.dumps(data).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.__dispatch('get')
+
+    def do_PUT(self):
+        self.__dispatch('put')
+
+    def do_POST(self):
+        self.__dispatch('post')
+
+    def do_DELETE(self):
+        self.__dispatch('delete')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDeuceServer(object):
+    """
+    In-memory Deuce API served from a background thread
+
+        server = FakeDeuceServer(latency=0.002)
+        server.Start()
+        client = DeuceClient(False, StaticAuthenticator(), server.ApiHost)
+        ...
+        server.Stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 page_limit=1000):
+        """
+        Initialize the server
+          host - address to listen on
+          port - port to listen on; 0 picks a free one
+          latency - seconds added to every request
+          page_limit - entries returned by list calls without a limit
+        """
+        self.lock = threading.Lock()
+        self.vaults = {}
+        self.page_limit = page_limit
+        self.httpd = ThreadingHTTPServer((host, port), FakeDeuceHandler)
+        self.httpd.deuce = self
+        self.httpd.latency = latency
+        self.thread = None
+        self.next_file = 0
+
+    @property
+    def ApiHost(self):
+        """host:port to hand to DeuceClient"""
+        return '{0:}:{1:}'.format(*self.httpd.server_address[:2])
+
+    @property
+    def Latency(self):
+        """Seconds added to every request"""
+        return self.httpd.latency
+
+    @Latency.setter
+    def Latency(self, latency):
+        self.httpd.latency = latency
+
+    def Start(self):
+        """
+        Serve requests from a background thread
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='fake-deuce-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Stop(self):
+        """
+        Stop serving requests
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def Reset(self):
+        """
+        Drop all vaults
+        """
+        with self.lock:
+            self.vaults = {}
+
+    def __page(self, entries, query):
+        """
+        (internal) Apply marker/limit to sorted (key, entry) pairs
+        """
+        limit = int(query.get('limit', self.page_limit))
+        marker = query.get('marker')
+        if marker is not None:
+            entries = [(key, entry) for key, entry in entries
+                       if key >= marker]
+        page = entries[:limit]
+        headers = {}
+        if len(entries) > limit:
+            headers['X-Next-Batch'] = str(entries[limit][0])
+        return headers, [entry for key, entry in page]
+
+    # Vaults
+
+    def put_vault(self, vault, query, body):
+        with self.lock:
+            self.vaults.setdefault(vault, FakeVault())
+        return 201, {}, None
+
+    def get_vault(self, vault, query, body):
+        # VaultExists and GetVaultStatistics GET the same URL but expect
+        # 204 and 200 with the statistics respectively. An empty vault
+        # answers 204 and any other its statistics, so VaultExists fails
+        # here on a vault holding blocks or files, and GetVaultStatistics
+        # on an empty one
+        with self.lock:
+            contents = self.vaults.get(vault)
+            if contents is None:
+                return 404, {}, None
+            if not contents.blocks and not contents.files:
+                return 204, {}, None
+            return 200, {}, {
+                'blocks': {
+                    'count': len(contents.blocks),
+                    'bytes': sum(len(data)
+                                 for data in contents.blocks.values())
+                },
+                'files': {'count': len(contents.files)}
+            }
+
+    def delete_vault(self, vault, query, body):
+        with self.lock:
+            if self.vaults.pop(vault, None) is None:
+                return 404, {}, None
+        return 204, {}, None
+
+    # Blocks
+
+    def get_blocks(self, vault, query, body):
+        with self.lock:
+            contents = self.vaults.get(vault)
+            if contents is None:
+                return 404, {}, None
+            blockids = sorted(contents.blocks)
+        headers, page = self.__page([(blockid, blockid)
+                                     for blockid in blockids], query)
+        return 200, headers, page
+
+    def put_block(self, vault, block, query, body):
+        if hashlib.sha1(body).hexdigest() != block:
+            return 412, {}, b'Block id does not match its data'
+        with self.lock:
+            contents = self.vaults.get(vault)
+            if contents is None:
+                return 404, {}, None
+            contents.blocks[block] = body
+        return 201, {}, None
+
+    def get_block(self, vault, block, query, body):
+        with self.lock:
+            contents = self.vaults.get(vault)
+            data = None if contents is None else contents.blocks.get(block)
+        if data is None:
+            return 404, {}, None
+        return 200, {'Content-Type': 'application/octet-stream'}, data
+
+    def delete_block(self, vault, block, query, body):
+        with self.lock:
+            contents = self.vaults.get(vault)
+            if contents is None or contents.blocks.pop(block, None) is None:
+                return 404, {}, None
+        return 204, {}, None
+
+    # Files
+
+    def post_files(self, vault, query, body):
+        with self.lock:
+            contents = self.vaults.get(vault)
+            if contents is None:
+                return 404, {}, None
+            self.next_file = self.next_file + 1
+            fileid = 'file{0:}'.format(self.next_file)
+            contents.files[fileid] = {}
+        return 201, {'Location': '/v1.0/{0:}/files/{1:}'.format(vault,
+                                                                fileid)}, None
+
+    def post_file(self, vault, file, query, body):
+        with self.lock:
+            contents = self.vaults.get(vault)
+            if contents is None or file not in contents.files:
+                return 404, {}, None
+            if file in contents.finalized:
+                return 409, {}, b'File is finalized'
+
+            if not body:
+                # Finalize: every assigned block must have been uploaded
+                for entry in contents.files[file].values():
+                    if entry['id'] not in contents.blocks:
+                        return 409, {}, b'File has missing blocks'
+                contents.finalized.add(file)
+                return 200, {}, None
+
+            missing = []
+            for entry in json.loads(body.decode('utf-8'))['blocks']:
+                contents.files[file][int(entry['offset'])] = entry
+                if entry['id'] not in contents.blocks:
+                    missing.append(entry['id'])
+        return 200, {}, missing
+
+    def get_file_blocks(self, vault, file, query, body):
+        with self.lock:
+            contents = self.vaults.get(vault)
+            if contents is None or file not in contents.files:
+                return 404, {}, None
+            entries = sorted(contents.files[file].items())
+        if 'marker' in query:
+            query = dict(query)
+            query['marker'] = int(query['marker'])
+        headers, page = self.__page([(offset, [entry['id'], offset])
+                                     for offset, entry in entries], query)
+        return 200, headers, page
@@ -0,0 +1,476 @@
+"""
+Deuce API for asyncio
+
+Requires the optional aiohttp package (pip install deuce-client[async])
+"""
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import deuceclient
+from deuceclient.client.deuce import DeuceCircuitOpenError
+from deuceclient.client.deuce import DeuceConnectionError, error_for_status
+from deuceclient.common.retry import CircuitBreaker, RetryPolicy
+from deuceclient.common.transfer import TransferResults
+
+
+class AsyncDeuceClient(object):
+    """
+    Coroutine versions of the DeuceClient REST API calls
+
+    All calls share one aiohttp session (and so one connection pool) and at
+    most max_concurrency of them are in progress at any time; any number
+    of calls may be awaited together on the same event loop.
+
+        async with AsyncDeuceClient(False, auth, '127.0.0.1:8080') as deuce:
+            await deuce.CreateVault('vault')
+    """
+
+    def __init__(self, sslenabled, authenticator, apihost, usemossoid=False,
+                 max_concurrency=64, limit_per_host=0, session=None,
+                 timeout=60.0, retry_policy=None, circuit_breaker=None):
+        """
+        Initialize the Deuce Client access
+            sslenabled - True if using HTTPS; otherwise false
+            authenticator - instance of deuceclient.auth.Authentication to
+                            use; its cached token is read on the loop while
+                            valid, a new one is obtained on the default
+                            executor so the loop never waits on identity
+            apihost - server to use for API calls
+            usemossoid - True to use the MossoId as the Project Id
+            max_concurrency - most requests in progress at once
+            limit_per_host - most connections opened to the API host;
+                             0 lets max_concurrency decide
+            session - optional aiohttp.ClientSession to share with other
+                      clients; it is not closed by Close()
+            timeout - total seconds allowed per request
+            retry_policy - optional deuceclient.common.retry.RetryPolicy;
+                           defaults to RetryPolicy()
+            circuit_breaker - optional
+                              deuceclient.common.retry.CircuitBreaker;
+                              defaults to one of its own
+        """
+        if aiohttp is None:
+            raise ImportError('AsyncDeuceClient requires aiohttp')
+
+        self.log = logging.getLogger(__name__)
+        self.sslenabled = sslenabled
+        self.authenticator = authenticator
+        self.apihost = apihost
+        self.__use_mossoid = usemossoid
+        self.max_concurrency = max_concurrency
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.session = session
+        self.__owns_session = session is None
+        self.__semaphore = None
+        self.__renewal = None
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.Close()
+
+    @property
+    def Session(self):
+        """
+        The aiohttp.ClientSession used for requests, created on first use
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                limit_per_host=self.limit_per_host)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    @property
+    def ProjectId(self):
+        """
+        Return the project id to use
+        """
+        if self.__use_mossoid:
+            return self.authenticator.MossoId
+        else:
+            return self.authenticator.AuthTenantId
+
+    async def Close(self):
+        """
+        Close the session if it was created by this client
+        """
+        if self.__owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def __uri(self, uripath):
+        """
+        Build the full URI for a request
+        """
+        if self.sslenabled:
+            return 'https://' + self.apihost + uripath
+        else:
+            return 'http://' + self.apihost + uripath
+
+    async def __token(self):
+        """
+        Return the authentication token
+
+        Renewing the token contacts identity and may sleep between
+        retries, so it runs on the default executor; coroutines needing
+        the token meanwhile all wait for that one renewal.
+        """
+        authenticator = self.authenticator
+        is_expired = getattr(authenticator, 'IsExpired', None)
+        if is_expired is None or not is_expired(fuzz=2):
+            return authenticator.AuthToken
+
+        if self.__renewal is None:
+            self.__renewal = asyncio.get_event_loop().run_in_executor(
+                None, lambda: authenticator.AuthToken)
+        renewal = self.__renewal
+        try:
+            return await asyncio.shield(renewal)
+        finally:
+            if self.__renewal is renewal and renewal.done():
+                self.__renewal = None
+
+    async def __headers(self):
+        """
+        Build the headers for a request
+        """
+        headers = {}
+        headers['X-Deuce-User-Agent'] = 'Deuce-Client/{0:}'.format(
+            deuceclient.version())
+        headers['User-Agent'] = headers['X-Deuce-User-Agent']
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        headers['X-Auth-Token'] = await self.__token()
+        headers['X-Project-ID'] = self.ProjectId
+        return headers
+
+    async def __send(self, method, uripath, headers, data, params, read):
+        """
+        Issue a single request and return (status, response headers, body)
+            headers - complete headers, see __headers()
+            read - 'text', 'json' or 'bytes'; the body is only decoded as
+                   JSON for 2xx responses
+        """
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        uri = self.__uri(uripath)
+        self.log.debug('%s %s', method, uri)
+
+        async with self.__semaphore:
+            async with self.Session.request(method, uri,
+                                            headers=headers,
+                                            data=data,
+                                            params=params) as res:
+                if read == 'bytes' and res.status == 200:
+                    body = await res.read()
+                elif read == 'json' and 200 <= res.status < 300:
+                    body = await res.json(content_type=None)
+                else:
+                    body = await res.text()
+                return res.status, res.headers, body
+
+    async def __request(self, operation, method, uripath, headers=None,
+                        data=None, params=None, read='text'):
+        """
+        Issue a request, retrying it as the retry policy allows, and return
+        (status, response headers, body) of the final attempt
+
+        Raises DeuceConnectionError if no response was ever received
+        """
+        policy = self.retry_policy
+        started = time.time()
+        attempt = 0
+        while True:
+            # Authenticate first: a failure to do so must not hold the
+            # probe of a half-open circuit
+            request_headers = await self.__headers()
+            if headers is not None:
+                request_headers.update(headers)
+
+            wait = self.circuit_breaker.Allow(self.apihost)
+            while wait:
+                if not policy.WithinDeadline(started, wait):
+                    raise DeuceCircuitOpenError(
+                        'Failed to {0:}. Circuit for {1:} is open'.format(
+                            operation, self.apihost))
+                await asyncio.sleep(wait)
+                wait = self.circuit_breaker.Allow(self.apihost)
+
+            error = None
+            sent = True
+            try:
+                status, res_headers, body = await self.__send(
+                    method, uripath, request_headers, data, params, read)
+            except aiohttp.ClientConnectorError as ex:
+                status, error, sent = None, ex, False
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                status, error = None, ex
+            except BaseException:
+                # Including cancellation, which says nothing of the server
+                self.circuit_breaker.Release(self.apihost)
+                raise
+
+            if status is None or status >= 500:
+                self.circuit_breaker.Failure(self.apihost)
+            else:
+                self.circuit_breaker.Success(self.apihost)
+
+            if status is not None and status not in policy.retry_statuses:
+                return status, res_headers, body
+
+            retry_after = None
+            if status is not None:
+                retry_after = RetryPolicy.RetryAfter(res_headers)
+            delay = policy.Delay(attempt, retry_after)
+            if not policy.ShouldRetry(operation, method, attempt, status,
+                                      sent) or \
+                    not policy.WithinDeadline(started, delay):
+                if error is not None:
+                    raise DeuceConnectionError(
+                        'Failed to {0:}. Error: {1:}'.format(operation,
+                                                             error))
+                return status, res_headers, body
+
+            self.log.warning('%s attempt %d failed (%s); retrying in %.2fs',
+                             operation, attempt + 1,
+                             status if error is None else error, delay)
+            await asyncio.sleep(delay)
+            attempt = attempt + 1
+
+    async def CreateVault(self, vaultname):
+        """
+        Create a Vault
+            vaultname - name of vault to be created
+        """
+        url = '/v1.0/{0:}'.format(vaultname)
+        status, headers, body = await self.__request(
+            'CreateVault', 'PUT', url)
+        if status == 201:
+            return True
+        else:
+            raise error_for_status(
+                'Failed to create Vault.', status, body)
+
+    async def DeleteVault(self, vaultname):
+        """
+        Delete a Vault
+            vaultname - name of vault to be deleted
+        """
+        url = '/v1.0/{0:}'.format(vaultname)
+        status, headers, body = await self.__request(
+            'DeleteVault', 'DELETE', url)
+        if status == 204:
+            return True
+        else:
+            raise error_for_status(
+                'Failed to delete Vault.', status, body)
+
+    async def VaultExists(self, vaultname):
+        """
+        Determine whether a Vault exists
+            vaultname - name of vault to check
+        """
+        url = '/v1.0/{0:}'.format(vaultname)
+        status, headers, body = await self.__request(
+            'VaultExists', 'GET', url)
+        if status == 204:
+            return True
+        elif status == 404:
+            return False
+        else:
+            raise error_for_status(
+                'Failed to determine if Vault exists.', status, body)
+
+    async def GetVaultStatistics(self, vaultname):
+        """
+        Return the statistics on a Vault
+            vaultname - name of vault
+        """
+        url = '/v1.0/{0:}'.format(vaultname)
+        status, headers, body = await self.__request(
+            'GetVaultStatistics', 'GET', url, read='json')
+        if status == 200:
+            return body
+        else:
+            raise error_for_status(
+                'Failed to get Vault statistics.', status, body)
+
+    @staticmethod
+    def __list_params(marker, limit):
+        """
+        Query parameters for the list calls
+        """
+        params = {}
+        if marker is not None:
+            params['marker'] = str(marker)
+        if limit is not None:
+            params['limit'] = str(limit)
+        return params
+
+    async def GetBlockList(self, vaultname, marker=None, limit=None):
+        """
+        Return the list of blocks in the vault
+        """
+        url = '/v1.0/{0:}/blocks'.format(vaultname)
+        status, headers, body = await self.__request(
+            'GetBlockList', 'GET', url,
+            params=AsyncDeuceClient.__list_params(marker, limit),
+            read='json')
+        if status == 200:
+            return body
+        else:
+            raise error_for_status(
+                'Failed to get Block list for Vault .', status, body)
+
+    async def UploadBlock(self, vaultname, blockid, blockcontent):
+        """
+        Upload a block to the vault specified.
+            vaultname - name of the vault
+            blockid - the id (SHA-1) of the block to be uploaded
+            blockcontent - bytes-like data of the block
+        """
+        url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
+        status, headers, body = await self.__request(
+            'UploadBlock', 'PUT', url,
+            headers={'Content-Type': 'application/octet-stream'},
+            data=blockcontent)
+        if status == 201:
+            return True
+        else:
+            raise error_for_status(
+                'Failed to upload Block.', status, body)
+
+    async def UploadBlocks(self, vaultname, blocks):
+        """
+        Upload many blocks concurrently
+            vaultname - name of the vault to upload to
+            blocks - iterable of (blockid, offset, size, buffer) tuples as
+                     produced by deuceclient.common.chunker; it is consumed
+                     lazily, max_concurrency blocks at a time
+
+        Returns a deuceclient.common.transfer.TransferResults once every
+        block has either been stored or has failed
+        """
+        results = TransferResults()
+        pending = iter(blocks)
+
+        async def worker():
+            for block in pending:
+                blockid, buffer = block[0], block[-1]
+                try:
+                    await self.UploadBlock(vaultname, blockid, buffer)
+                    results.Success(blockid, len(buffer))
+                except Exception as ex:
+                    self.log.error('Failed to upload block %s: %s',
+                                   blockid, ex)
+                    results.Failure(blockid, ex)
+
+        await asyncio.gather(*[worker()
+                               for _ in range(self.max_concurrency)])
+        results.Finish()
+        return results
+
+    async def DeleteBlock(self, vaultname, blockid):
+        """
+        Delete the block from the vault.
+        """
+        url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
+        status, headers, body = await self.__request(
+            'DeleteBlock', 'DELETE', url)
+        if status == 204:
+            return True
+        else:
+            raise error_for_status(
+                'Failed to delete Block.', status, body)
+
+    async def GetBlockData(self, vaultname, blockid):
+        """
+        Gets the data associated with the block id provided
+        """
+        url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
+        status, headers, body = await self.__request(
+            'GetBlockData', 'GET', url,
+            read='bytes')
+        if status == 200:
+            return body
+        else:
+            raise error_for_status(
+                'Failed to get Block Content for Block Id .', status, body)
+
+    async def CreateFile(self, vaultname):
+        """
+        Creates a file in the specified vault, does not post data to it
+        Returns the location of the file which gives the file id
+        """
+        url = '/v1.0/{0:}/files'.format(vaultname)
+        status, headers, body = await self.__request(
+            'CreateFile', 'POST', url)
+        if status == 201:
+            return headers['location']
+        else:
+            raise error_for_status(
+                'Failed to create File.', status, body)
+
+    async def AssignBlocksToFile(self, vaultname, fileid, value):
+        """
+        Assigns the specified blocks to a file
+        Returns the ids of the blocks that have not been uploaded yet
+        See DeuceClient.AssignBlocksToFile for the format of value
+        """
+        url = '/v1.0/{0}/files/{1}'.format(vaultname, fileid)
+        status, headers, body = await self.__request(
+            'AssignBlocksToFile', 'POST', url,
+            data=json.dumps(value), read='json')
+        if status == 200:
+            return body
+        else:
+            raise error_for_status(
+                'Failed to Assign Blocks to the File.', status, body)
+
+    async def FinalizeFile(self, vaultname, fileid):
+        """
+        Finalize a file once all of its blocks have been assigned
+        and uploaded
+        """
+        url = '/v1.0/{0:}/files/{1:}'.format(vaultname, fileid)
+        status, headers, body = await self.__request(
+            'FinalizeFile', 'POST', url)
+        if status == 200:
+            return True
+        else:
+            raise error_for_status(
+                'Failed to finalize File.', status, body)
+
+    async def GetFileBlockList(self, vaultname, fileid, marker=None,
+                               limit=None):
+        """
+        Return the list of [blockid, offset] pairs assigned to the file
+        """
+        url = '/v1.0/{0:}/files/{1:}/blocks'.format(vaultname, fileid)
+        status, headers, body = await self.__request(
+            'GetFileBlockList', 'GET', url,
+            params=AsyncDeuceClient.__list_params(marker, limit),
+            read='json')
+        if status == 200:
+            return body
+        else:
+            raise error_for_status(
+                'Failed to get Block list for File .', status, body)
@@ -2,9 +2,111 @@
 Deuce API
 """
 from __future__ import print_function
+import concurrent.futures
+import hashlib
 import json
-import requests
 import logging
+import os
+import threading
+import time
+
+import requests.exceptions
+import urllib3.exceptions
+
+from deuceclient.common.chunker import build_assignment
+from deuceclient.common.chunker import ContentDefinedChunker
+from deuceclient.common.command import Command
+from deuceclient.common.hashing import BlockHasher
+from deuceclient.common.journal import UploadJournal
+from deuceclient.common.balancer import LoadBalancer
+from deuceclient.common.retry import CircuitBreaker, RetryPolicy
+from deuceclient.common.tracing import body_summary, redact_headers
+from deuceclient.common.transfer import InflightLimiter, PositionalWriter
+from deuceclient.common.transfer import TransferResults
+
+
+class DeuceError(RuntimeError):
+    """
+    Base class of the errors raised by DeuceClient
+      status - HTTP status of the failed response, or None
+      body - text of the failed response, or None
+    """
+
+    def __init__(self, message, status=None, body=None):
+        super(DeuceError, self).__init__(message)
+        self.status = status
+        self.body = body
+
+
+class DeuceClientError(DeuceError):
+    """
+    The server rejected the request (4xx)
+    """
+    pass
+
+
+class DeuceNotFoundError(DeuceClientError):
+    """
+    The vault, block or file does not exist (404)
+    """
+    pass
+
+
+class DeuceConflictError(DeuceClientError):
+    """
+    The request conflicts with the state of the resource (409)
+    """
+    pass
+
+
+class DeuceServerError(DeuceError):
+    """
+    The server failed to handle the request (5xx), even after retrying
+    """
+    pass
+
+
+class DeuceConnectionError(DeuceError):
+    """
+    No response was received, even after retrying
+    """
+    pass
+
+
+class DeuceCircuitOpenError(DeuceConnectionError):
+    """
+    The circuit breaker held the request back for longer than the retry
+    policy allows
+    """
+    pass
+
+
+class BlockVerificationError(DeuceError):
+    """
+    The data received for a block does not match its id
+    """
+    pass
+
+
+def error_for_status(message, status, body):
+    """
+    Return the DeuceError subclass instance matching an HTTP status
+      message - description of the failed call, e.g. 'Failed to create
+                Vault.'
+    """
+    if status == 404:
+        error_class = DeuceNotFoundError
+    elif status == 409:
+        error_class = DeuceConflictError
+    elif 400 <= status < 500:
+        error_class = DeuceClientError
+    elif status >= 500:
+        error_class = DeuceServerError
+    else:
+        error_class = DeuceError
+    return error_class(
+        '{0:} Error ({1:}): {2:}'.format(message, status, body),
+        status, body)
 
 
 class DeuceVault(Command):
@@ -12,52 +114,286 @@ class DeuceVault(Command):
     Deuce Vault Functionality
     """
 
-    def __init__(self, sslenabled, authenticator, apihost):
+    def __init__(self, sslenabled, authenticator, apihost, pool=None):
         """
         Initialize the Deuce Client access
             sslenabled - True if using HTTPS; otherwise false
             authenticator - instance of deuceclient.auth.Authentication to use
             apihost - server to use for API calls
+            pool - optional deuceclient.common.pool.ConnectionPool to share
         """
-        super(self.__class__, self).__init__(sslenabled, apihost, '/')
+        super(self.__class__, self).__init__(sslenabled, apihost, '/',
+                                             pool=pool)
         self.log = logging.getLogger(__name__)
-        self.sslenabled = sslenabled
         self.authenticator = authenticator
 
 
 class DeuceClient(Command):
     """
     Object defining HTTP REST API calls for interacting with Deuce.
+
+    Every call builds its own request, so a single instance (and its
+    connection pool) can be shared by any number of threads.
     """
 
-    def __init__(self, sslenabled, authenticator, apihost, usemossoid=False):
+    def __init__(self, sslenabled, authenticator, apihost, usemossoid=False,
+                 pool=None, block_index=None, instrumentation=None,
+                 retry_policy=None, circuit_breaker=None, block_cache=None,
+                 balancer=None):
         """
         Initialize the Deuce Client access
             sslenabled - True if using HTTPS; otherwise false
             authenticator - instance of deuceclient.auth.Authentication to use
-            apihost - server to use for API calls
+            apihost - server to use for API calls, or a list of servers
+                      sharing the same storage to spread the calls over
+            usemossoid - True to use the MossoId as the Project Id
+            pool - optional deuceclient.common.pool.ConnectionPool to share
+                   with other clients; defaults to a pool of its own
+            block_index - optional deuceclient.common.blockindex.BlockIndex
+                          of blocks known to exist; uploads of those blocks
+                          are skipped without contacting the server
+            instrumentation - optional
+                              deuceclient.common.instrumentation.Instrumentation
+                              notified of every request, e.g. a
+                              MetricsRecorder
+            retry_policy - optional deuceclient.common.retry.RetryPolicy
+                           deciding which failed requests are retried;
+                           defaults to RetryPolicy(). Use
+                           RetryPolicy(max_attempts=1) to disable retries
+            circuit_breaker - optional
+                              deuceclient.common.retry.CircuitBreaker to
+                              share with other clients; defaults to one of
+                              its own
+            block_cache - optional deuceclient.common.blockcache.BlockCache
+                          serving block downloads without contacting the
+                          server when it holds the block
+            balancer - optional deuceclient.common.balancer.LoadBalancer
+                       picking the server for each call; defaults to
+                       LoadBalancer(apihost) when apihost is a list
         """
-        super(self.__class__, self).__init__(sslenabled, apihost, '/')
+        if isinstance(apihost, (list, tuple)):
+            hosts = list(apihost)
+        else:
+            hosts = [apihost]
+        if balancer is None and len(hosts) > 1:
+            balancer = LoadBalancer(hosts)
+        super(self.__class__, self).__init__(sslenabled, hosts[0], '/',
+                                             pool=pool,
+                                             instrumentation=instrumentation)
         self.log = logging.getLogger(__name__)
-        self.sslenabled = sslenabled
         self.authenticator = authenticator
         self.__use_mossoid = usemossoid
+        self.block_index = block_index
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker
+        self.block_cache = block_cache
+        self.balancer = balancer
+
+    @property
+    def Balancer(self):
+        """LoadBalancer spreading the calls over the servers, or None"""
+        return self.balancer
+
+    def __headers(self, headers=None):
+        """
+        Build the headers of a Deuce API call, including the
+        authentication headers; may renew the token
+        """
+        request_headers = {}
+        request_headers['X-Auth-Token'] = self.authenticator.AuthToken
+        request_headers['X-Project-ID'] = self.ProjectId
+        if headers is not None:
+            request_headers.update(headers)
+        return request_headers
+
+    def __request(self, operation, method, uripath, headers, body=None,
+                  apihost=None):
+        """
+        Build the Request for a single Deuce API call
+          headers - complete headers, see __headers()
+        """
+        request = self.BuildRequest(method, uripath, headers, body,
+                                    operation, apihost)
+        self.__log_request_data(request)
+        return request
+
+    @staticmethod
+    def __was_sent(error):
+        """
+        (internal) False if a transport failure happened before the request
+        could reach the server
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return False
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return not isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    @staticmethod
+    def __resendable(body):
+        """
+        (internal) True if the body can be sent again; file-like and
+        generator bodies are consumed by the first attempt
+        """
+        return not hasattr(body, 'read') and not hasattr(body, '__next__')
+
+    def __wait_for_circuit(self, operation, started):
+        """
+        (internal) Block while the circuit of the API host is open
+        """
+        wait = self.circuit_breaker.Allow(self.apihost)
+        while wait:
+            if not self.retry_policy.WithinDeadline(started, wait):
+                raise DeuceCircuitOpenError(
+                    'Failed to {0:}. Circuit for {1:} is open'.format(
+                        operation, self.apihost))
+            time.sleep(wait)
+            wait = self.circuit_breaker.Allow(self.apihost)
+        return self.apihost
 
-    def __update_headers(self):
+    def __acquire_host(self, operation, started, failed):
         """
-        Update common headers
+        (internal) Pick a server from the balancer whose circuit is not
+        open, preferring those that have not failed the call already;
+        block while every circuit is open
+
+        The host returned must be given back to the balancer
+        """
+        if failed.issuperset(self.balancer.Hosts):
+            failed = set()
+        exclude = set(failed)
+        wait = None
+        while True:
+            host = self.balancer.Acquire(exclude)
+            if host is None:
+                # Every circuit is open
+                if not self.retry_policy.WithinDeadline(started, wait):
+                    raise DeuceCircuitOpenError(
+                        'Failed to {0:}. Circuits for {1:} are '
+                        'open'.format(operation,
+                                      ', '.join(self.balancer.Hosts)))
+                time.sleep(wait)
+                exclude = set(failed)
+                wait = None
+                continue
+
+            host_wait = self.circuit_breaker.Allow(host)
+            if not host_wait:
+                return host
+            self.balancer.Release(host)
+            exclude.add(host)
+            wait = host_wait if wait is None else min(wait, host_wait)
+
+    def __execute(self, operation, method, uripath, headers=None, body=None,
+                  **kwargs):
+        """
+        Send a Deuce API call, retrying it as the retry policy allows, and
+        return the final response
+          kwargs - passed through to Send()
+
+        Raises DeuceConnectionError if no response was ever received
+        """
+        policy = self.retry_policy
+        balancer = self.balancer
+        started = time.time()
+        attempt = 0
+        failed = set()
+        reauthenticated = False
+        while True:
+            # Authenticate first: a failure to do so must not hold a host
+            # or the probe of a half-open circuit
+            request_headers = self.__headers(headers)
+            if balancer is None:
+                host = self.__wait_for_circuit(operation, started)
+            else:
+                host = self.__acquire_host(operation, started, failed)
+            sent_at = time.time()
+            try:
+                request = self.__request(operation, method, uripath,
+                                         request_headers, body, host)
+                res = self.Send(request, **kwargs)
+                error = None
+                status = res.status_code
+            except requests.exceptions.RequestException as ex:
+                res = None
+                error = ex
+                status = None
+            except Exception:
+                self.circuit_breaker.Release(host)
+                raise
+            finally:
+                if balancer is not None:
+                    balancer.Release(host)
+
+            if status is None or status >= 500:
+                self.circuit_breaker.Failure(host)
+                if balancer is not None:
+                    balancer.Failure(host)
+                    failed.add(host)
+            else:
+                self.circuit_breaker.Success(host)
+                if balancer is not None:
+                    balancer.Success(host, time.time() - sent_at)
+
+            # A rejected token is renewed and the call sent once more
+            invalidate = getattr(self.authenticator, 'InvalidateToken', None)
+            if status == 401 and invalidate is not None and \
+                    not reauthenticated and DeuceClient.__resendable(body):
+                self.log.warning('%s was refused authentication; renewing '
+                                 'the token', operation)
+                res.close()
+                invalidate(request.headers['X-Auth-Token'])
+                reauthenticated = True
+                continue
+
+            if status is not None and status not in policy.retry_statuses:
+                return res
+
+            retry_after = None
+            if res is not None:
+                retry_after = RetryPolicy.RetryAfter(res.headers)
+            delay = policy.Delay(attempt, retry_after)
+            sent = error is None or DeuceClient.__was_sent(error)
+            if not policy.ShouldRetry(operation, method, attempt, status,
+                                      sent) or \
+                    not DeuceClient.__resendable(body) or \
+                    not policy.WithinDeadline(started, delay):
+                if error is not None:
+                    raise DeuceConnectionError(
+                        'Failed to {0:}. Error: {1:}'.format(operation,
+                                                             error))
+                return res
+
+            self.log.warning('%s attempt %d failed (%s); retrying in %.2fs',
+                             operation, attempt + 1,
+                             status if error is None else error, delay)
+            if res is not None:
+                res.close()
+            if self.instrumentation is not None:
+                self.instrumentation.RequestRetried(operation)
+            time.sleep(delay)
+            attempt = attempt + 1
+
+    @staticmethod
+    def __error(message, res):
         """
-        self.headers['X-Auth-Token'] = self.authenticator.AuthToken
-        self.headers['X-Project-ID'] = self.ProjectId
+        (internal) Build the typed error for an unexpected response
+        """
+        return error_for_status(message, res.status_code, res.text)
 
-    def __log_request_data(self):
+    def __log_request_data(self, request):
         """
-        Log the information about the request
+        Log the information about the request, without its credentials or
+        body data; nothing is formatted unless debug logging is enabled
         """
-        self.log.debug('host: %s', self.apihost)
-        self.log.debug('body: %s', self.Body)
-        self.log.debug('headers: %s', self.Headers)
-        self.log.debug('uri: %s', self.Uri)
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return
+        self.log.debug('%s %s body: %s headers: %s', request.method,
+                       request.uri, body_summary(request.body),
+                       redact_headers(request.headers))
 
     @property
     def ProjectId(self):
@@ -65,112 +401,184 @@ class DeuceClient(Command):
         Return the project id to use
         """
         if self.__use_mossoid:
-            self.projectid = self.authenticator.MossoId
+            return self.authenticator.MossoId
         else:
-            self.projectid = self.authenticator.AuthTenantId
-        return self.projectid
+            return self.authenticator.AuthTenantId
 
     def CreateVault(self, vaultname):
         """
         Create a Vault
             vaultname - name of vault to be created
         """
-        self.ReInit(self.sslenabled, '/v1.0/{0:}'.format(vaultname))
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.put(self.Uri, headers=self.Headers)
+        url = '/v1.0/{0:}'.format(vaultname)
+        res = self.__execute('CreateVault', 'PUT', url)
 
         if res.status_code == 201:
             return True
         else:
-            raise RuntimeError(
-                'Failed to create Vault. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error('Failed to create Vault.', res)
 
     def DeleteVault(self, vaultname):
         """
         Delete a Vault
             vaultname - name of vault to be deleted
         """
-        self.ReInit(self.sslenabled, '/v1.0/{0:}'.format(vaultname))
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.delete(self.Uri, headers=self.Headers)
+        url = '/v1.0/{0:}'.format(vaultname)
+        res = self.__execute('DeleteVault', 'DELETE', url)
+
+        # Neither a deleted nor a missing vault holds any block; a vault
+        # recreated under the same name must not skip its uploads
+        if res.status_code in (204, 404) and self.block_index is not None:
+            self.block_index.Invalidate(vaultname)
 
         if res.status_code == 204:
             return True
         else:
-            raise RuntimeError(
-                'Failed to delete Vault. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error('Failed to delete Vault.', res)
 
     def VaultExists(self, vaultname):
         """
         Return the statistics on a Vault
             vaultname - name of vault to be deleted
         """
-        self.ReInit(self.sslenabled, '/v1.0/{0:}'.format(vaultname))
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.get(self.Uri, headers=self.Headers)
+        url = '/v1.0/{0:}'.format(vaultname)
+        res = self.__execute('VaultExists', 'GET', url)
 
         if res.status_code == 204:
             return True
         elif res.status_code == 404:
             return False
         else:
-            raise RuntimeError(
-                'Failed to determine if Vault exists. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error(
+                'Failed to determine if Vault exists.', res)
 
     def GetVaultStatistics(self, vaultname):
         """
         Return the statistics on a Vault
             vaultname - name of vault to be deleted
         """
-        self.ReInit(self.sslenabled, '/v1.0/{0:}'.format(vaultname))
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.get(self.Uri, headers=self.Headers)
+        url = '/v1.0/{0:}'.format(vaultname)
+        res = self.__execute('GetVaultStatistics', 'GET', url)
 
         if res.status_code == 200:
             return res.json()
         else:
-            raise RuntimeError(
-                'Failed to get Vault statistics. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error('Failed to get Vault statistics.', res)
+
+    @staticmethod
+    def __list_uri(url, marker, limit):
+        """
+        Append the marker and limit query parameters of the list calls
+        """
+        parameters = []
+        if marker is not None:
+            parameters.append('marker={0:}'.format(marker))
+        if limit is not None:
+            parameters.append('limit={0:}'.format(limit))
+        if parameters:
+            url = url + '?' + '&'.join(parameters)
+        return url
+
+    def __iter_pages(self, fetch, marker_of, limit, prefetch):
+        """
+        Walk every page of a list call, yielding its entries
+            fetch - callable taking a marker and returning one page
+            marker_of - callable returning the marker of an entry
+            limit - page size requested; a shorter page ends the walk
+            prefetch - True to request the next page in the background
+                       while the entries of the current one are consumed
+        """
+        executor = None
+        if prefetch:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            marker = None
+            next_page = None
+            page = fetch(marker)
+            while True:
+                last_page = limit is not None and len(page) < limit
+                # The marker itself is returned again at the start of the page
+                if marker is not None and page and \
+                        marker_of(page[0]) == marker:
+                    page = page[1:]
+                if not page:
+                    return
+                marker = marker_of(page[-1])
+
+                if executor is not None and not last_page:
+                    next_page = executor.submit(fetch, marker)
+
+                for entry in page:
+                    yield entry
+
+                if last_page:
+                    return
+                elif next_page is not None:
+                    page = next_page.result()
+                else:
+                    page = fetch(marker)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
 
     def GetBlockList(self, vaultname, marker=None, limit=None):
         """
-        Return the list of blocks in the vault
+        Return one page of the list of blocks in the vault
+        See IterBlockList() to walk all of them
         """
         url = '/v1.0/{0:}/blocks'.format(vaultname)
-        if marker is not None or limit is not None:
-            # add the separator between the URL and the parameters
-            url = url + '?'
-
-            # Apply the marker
-            if marker is not None:
-                url = '{0:}marker={1:}'.format(url, marker)
-                # Apply a comma if the next item is not none
-                if limit is not None:
-                    url = url + ','
-
-            # Apply the limit
-            if limit is not None:
-                url = '{-1:}limit={1:}'.format(url, limit)
-
-        self.ReInit(self.sslenabled, url)
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.get(self.Uri, headers=self.Headers)
+        url = DeuceClient.__list_uri(url, marker, limit)
+        res = self.__execute('GetBlockList', 'GET', url)
 
         if res.status_code == 200:
             return res.json()
         else:
-            raise RuntimeError(
-                'Failed to get Block list for Vault . '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error(
+                'Failed to get Block list for Vault .', res)
+
+    def IterBlockList(self, vaultname, limit=1000, prefetch=True):
+        """
+        Generate the id of every block in the vault
+            vaultname - vault to list
+            limit - block ids requested per page
+            prefetch - True to fetch the next page in the background while
+                       the current one is consumed
+
+        Only one or two pages are held in memory at a time.
+        """
+        return self.__iter_pages(
+            lambda marker: self.GetBlockList(vaultname, marker=marker,
+                                             limit=limit),
+            lambda blockid: blockid,
+            limit, prefetch)
+
+    def SyncBlockIndex(self, vaultname, limit=1000):
+        """
+        Replace the block index entries of a vault with the vault's
+        current block list
+            vaultname - vault to resynchronize
+            limit - block ids requested per page
+
+        Returns the number of blocks recorded
+        """
+        if self.block_index is None:
+            raise RuntimeError('No block index configured')
+
+        self.block_index.Invalidate(vaultname)
+        count = 0
+        batch = []
+        for blockid in self.IterBlockList(vaultname, limit=limit):
+            batch.append(blockid)
+            if len(batch) == limit:
+                self.block_index.AddMany(vaultname, batch)
+                count = count + len(batch)
+                batch = []
+        if batch:
+            self.block_index.AddMany(vaultname, batch)
+            count = count + len(batch)
+
+        self.block_index.Flush()
+        return count
 
     def UploadBlock(self, vaultname, blockid, blockcontent):
         """
@@ -178,24 +586,74 @@ class DeuceClient(Command):
             vaultname - name of the vault to be created
             blockid - the id (SHA-1) of the block to be uploaded
                       f.e 74bdda817d796333e9fe359e283d5643ee1a1397
-            blockcontent - data present in the block to uploaded
+            blockcontent - data present in the block to uploaded; any
+                           bytes-like object, including memoryview slices
+                           of an mmap, which are sent without being copied
+
+        If the block index records the block as already in the vault
+        nothing is sent.
         """
-        url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
-        print('url{0:}'.format(url))
-        self.ReInit(self.sslenabled, url)
-        self.__update_headers()
-        self.__log_request_data()
+        if self.block_index is not None and \
+                self.block_index.Contains(vaultname, blockid):
+            self.log.debug('Block %s already in vault %s', blockid, vaultname)
+            return True
+
         headers = {}
-        headers.update(self.Headers)
-        headers['content-type'] = 'application/octet-stream'
-        headers['content-length'] = len(blockcontent)
-        res = requests.put(self.Uri, headers=self.Headers, data=blockcontent)
+        headers['Content-Type'] = 'application/octet-stream'
+        headers['Content-Length'] = str(memoryview(blockcontent).nbytes)
+        url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
+        res = self.__execute('UploadBlock', 'PUT', url, headers=headers,
+                             body=blockcontent)
         if res.status_code == 201:
+            if self.block_index is not None:
+                self.block_index.Add(vaultname, blockid)
             return True
         else:
-            raise RuntimeError(
-                'Failed to upload Block. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error('Failed to upload Block.', res)
+
+    def UploadBlocks(self, vaultname, blocks, concurrency=8,
+                     max_inflight_bytes=64 * 1024 * 1024):
+        """
+        Upload many blocks to the vault in parallel
+            vaultname - name of the vault to upload to
+            blocks - iterable of (blockid, offset, size, buffer) tuples as
+                     produced by deuceclient.common.chunker; it is consumed
+                     lazily so only the blocks in flight are held in memory
+            concurrency - number of blocks uploaded at the same time
+            max_inflight_bytes - most block data queued or being uploaded
+                                 at any one time
+
+        Returns a deuceclient.common.transfer.TransferResults once every
+        block has either been stored or has failed; failed blocks are in
+        its Errors.
+        """
+        limiter = InflightLimiter(max_inflight_bytes)
+        results = TransferResults()
+
+        def upload(blockid, buffer):
+            try:
+                self.UploadBlock(vaultname, blockid, buffer)
+                results.Success(blockid, len(buffer))
+            except Exception as ex:
+                self.log.error('Failed to upload block %s: %s', blockid, ex)
+                results.Failure(blockid, ex)
+            finally:
+                limiter.Release(len(buffer))
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=concurrency) as executor:
+                for block in blocks:
+                    blockid, buffer = block[0], block[-1]
+                    limiter.Acquire(len(buffer))
+                    executor.submit(upload, blockid, buffer)
+        finally:
+            # Keep what was learnt even if the caller exits right away
+            if self.block_index is not None:
+                self.block_index.Flush()
+
+        results.Finish()
+        return results
 
     def DeleteBlock(self, vaultname, blockid):
         """
@@ -203,16 +661,13 @@ class DeuceClient(Command):
         This funciton has not been tested
         """
         url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
-        self.ReInit(self.sslenabled, url)
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.delete(self.Uri, headers=self.Headers)
+        res = self.__execute('DeleteBlock', 'DELETE', url)
+        if res.status_code in (204, 404) and self.block_index is not None:
+            self.block_index.Discard(vaultname, blockid)
         if res.status_code == 204:
             return True
         else:
-            raise RuntimeError(
-                'Failed to delete Vault. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error('Failed to delete Vault.', res)
 
     def GetBlockData(self, vaultname, blockid):
         """
@@ -220,18 +675,117 @@ class DeuceClient(Command):
         vaultname - exisiting vault, eg 'v1'
         block id - sha1 of block, eg - 74bdda817d796333e9fe359e283d5643ee1a1397
         """
+        if self.block_cache is not None:
+            data = self.block_cache.Get(blockid)
+            if data is not None:
+                return data
+
         url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
-        self.ReInit(self.sslenabled, url)
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.get(self.Uri, headers=self.Headers)
+        res = self.__execute('GetBlockData', 'GET', url)
 
         if res.status_code == 200:
+            if self.block_cache is not None:
+                # Only data that matches its id may be served from the cache
+                if hashlib.sha1(res.content).hexdigest() == blockid:
+                    self.block_cache.Put(blockid, res.content)
             return res.content
         else:
-            raise RuntimeError(
-                'Failed to get Block Content for Block Id . '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error(
+                'Failed to get Block Content for Block Id .', res)
+
+    def GetBlockDataInto(self, vaultname, blockid, destination, verify=True,
+                         chunk_size=1024 * 1024):
+        """
+        Stream the data of a block into a caller-supplied destination
+        without materializing the whole block
+            vaultname - exisiting vault, eg 'v1'
+            blockid - sha1 of the block
+            destination - either a writable buffer (bytearray, memoryview,
+                          mmap, ...) large enough for the block, which is
+                          filled from its start, or an object with a write()
+                          method such as a binary file
+            verify - True to check the data against blockid as it arrives
+            chunk_size - most bytes read from the connection at a time
+
+        Returns the number of bytes received
+
+        Blocks held by the block cache are copied from it; verified blocks
+        that are downloaded are added to it.
+        """
+        if self.block_cache is not None:
+            data = self.block_cache.Get(blockid)
+            if data is not None:
+                if hasattr(destination, 'write'):
+                    destination.write(data)
+                else:
+                    view = memoryview(destination).cast('B')
+                    if len(data) > len(view):
+                        raise BlockVerificationError(
+                            'Block {0:} is larger than the supplied '
+                            'buffer ({1:} bytes)'.format(blockid, len(view)))
+                    view[:len(data)] = data
+                return len(data)
+
+        # Keep a copy of streamed data for the cache only when it is verified
+        copy = None
+        if self.block_cache is not None and verify:
+            copy = bytearray()
+
+        url = '/v1.0/{0:}/blocks/{1:}'.format(vaultname, blockid)
+        # Raw reads bypass content decoding, so ask for the plain body
+        res = self.__execute('GetBlockData', 'GET', url,
+                             headers={'Accept-Encoding': 'identity'},
+                             stream=True)
+        try:
+            if res.status_code != 200:
+                raise DeuceClient.__error(
+                    'Failed to get Block Content for Block Id .', res)
+
+            digest = hashlib.sha1() if verify else None
+            received = 0
+            if hasattr(destination, 'write'):
+                scratch = memoryview(bytearray(chunk_size))
+                while True:
+                    count = res.raw.readinto(scratch)
+                    if not count:
+                        break
+                    if digest is not None:
+                        digest.update(scratch[:count])
+                    if copy is not None:
+                        copy.extend(scratch[:count])
+                    destination.write(scratch[:count])
+                    received = received + count
+            else:
+                view = memoryview(destination).cast('B')
+                while True:
+                    if received == len(view):
+                        if res.raw.read(1):
+                            raise BlockVerificationError(
+                                'Block {0:} is larger than the supplied '
+                                'buffer ({1:} bytes)'.format(blockid,
+                                                             len(view)))
+                        break
+                    # Bounded reads: urllib3 reads into a temporary of
+                    # the requested size before copying it into view
+                    count = res.raw.readinto(
+                        view[received:received + chunk_size])
+                    if not count:
+                        break
+                    if digest is not None:
+                        digest.update(view[received:received + count])
+                    received = received + count
+                if copy is not None:
+                    copy = view[:received]
+        finally:
+            res.close()
+
+        if digest is not None and digest.hexdigest() != blockid:
+            raise BlockVerificationError(
+                'Block {0:} failed verification: data hashes to '
+                '{1:}'.format(blockid, digest.hexdigest()))
+        if copy is not None:
+            self.block_cache.Put(blockid, copy)
+        return received
 
     def CreateFile(self, vaultname):
         """
@@ -239,16 +793,11 @@ class DeuceClient(Command):
         Returns the location of the file which gives the file id
         """
         url = '/v1.0/{0:}/files'.format(vaultname)
-        self.ReInit(self.sslenabled, url)
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.post(self.Uri, headers=self.Headers)
+        res = self.__execute('CreateFile', 'POST', url)
         if res.status_code == 201:
             return res.headers['location']
         else:
-            raise RuntimeError(
-                'Failed to create File. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error('Failed to create File.', res)
 
     def AssignBlocksToFile(self, vaultname, fileid, value):
         """
@@ -280,51 +829,292 @@ class DeuceClient(Command):
         Mandatory to supply block size and offset along with the block id
         """
         url = '/v1.0/{0}/files/{1}'.format(vaultname, fileid)
-        self.ReInit(self.sslenabled, url)
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.post(self.Uri,
-                            data=json.dumps(value),
-                            headers=self.Headers)
+        res = self.__execute('AssignBlocksToFile', 'POST', url,
+                             body=json.dumps(value))
         if res.status_code == 200:
             return res.json()
         else:
-            raise RuntimeError(
-                'Failed to Assign Blocks to the File. '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            raise DeuceClient.__error(
+                'Failed to Assign Blocks to the File.', res)
+
+    def FinalizeFile(self, vaultname, fileid):
+        """
+        Finalize a file once all of its blocks have been assigned
+        and uploaded
+        """
+        url = '/v1.0/{0:}/files/{1:}'.format(vaultname, fileid)
+        res = self.__execute('FinalizeFile', 'POST', url)
+        if res.status_code == 200:
+            return True
+        else:
+            raise DeuceClient.__error('Failed to finalize File.', res)
 
     def GetFileBlockList(self, vaultname, fileid, marker=None, limit=None):
         """
-        Return the list of blocks assigned to the file
+        Return one page of the list of blocks assigned to the file
         This does not finalize the file.
-        This function is returning a 404
+        Each entry is a [blockid, offset] pair
+        See IterFileBlockList() to walk all of them
         """
 
-        url = '/v1.0/{0:}/files/{1:}/blocks/'.format(vaultname, fileid)
+        url = '/v1.0/{0:}/files/{1:}/blocks'.format(vaultname, fileid)
+        url = DeuceClient.__list_uri(url, marker, limit)
+        res = self.__execute('GetFileBlockList', 'GET', url)
 
-        if marker is not None or limit is not None:
-            # add the separator between the URL and the parameters
-            url = url + '?'
+        if res.status_code == 200:
+            return res.json()
+        else:
+            raise DeuceClient.__error(
+                'Failed to get Block list for File .', res)
 
-            # Apply the marker
-            if marker is not None:
-                url = '{0:}marker={1:}'.format(url, marker)
-                # Apply a comma if the next item is not none
-                if limit is not None:
-                    url = url + ','
+    def __upload_batch(self, vaultname, fileid, batch, concurrency,
+                       max_inflight_bytes, max_rounds, journal):
+        """
+        Assign a batch of blocks to the file and upload the ones the
+        server reports it does not have, until it has all of them,
+        recording the progress in the journal if there is one
+        """
+        blocks = {}
+        for block in batch:
+            blocks.setdefault(block[0], block)
 
-            # Apply the limit
-            if limit is not None:
-                url = '{-1:}limit={1:}'.format(url, limit)
+        missing = self.AssignBlocksToFile(vaultname, fileid,
+                                          build_assignment(batch))
+        rounds = 0
+        while missing:
+            if rounds == max_rounds:
+                raise DeuceError(
+                    'Failed to upload File. {0:} blocks still missing after '
+                    '{1:} attempts'.format(len(missing), max_rounds))
+            rounds = rounds + 1
 
-        self.ReInit(self.sslenabled, url)
-        self.__update_headers()
-        self.__log_request_data()
-        res = requests.get(self.Uri, headers=self.Headers)
+            missing = set(missing)
+            if self.block_index is not None:
+                # The server is authoritative; forget any stale entries
+                for blockid in missing:
+                    self.block_index.Discard(vaultname, blockid)
+            self.log.debug('Uploading %d of %d blocks in batch',
+                           len(missing), len(blocks))
+            results = self.UploadBlocks(vaultname,
+                                        [blocks[blockid]
+                                         for blockid in missing],
+                                        concurrency=concurrency,
+                                        max_inflight_bytes=max_inflight_bytes)
+            if not results.Succeeded:
+                raise DeuceError(
+                    'Failed to upload File. {0:} blocks failed to '
+                    'upload'.format(len(results.Errors)))
 
-        if res.status_code == 200:
-            return True
+            missing = self.AssignBlocksToFile(
+                vaultname, fileid,
+                build_assignment([block for block in batch
+                                  if block[0] in missing]))
+
+        if journal is not None:
+            journal.Assigned(batch)
+
+    def UploadFile(self, vaultname, filepath, chunker=None, batch_size=500,
+                   concurrency=8, max_inflight_bytes=64 * 1024 * 1024,
+                   max_rounds=3, mapped=True, hasher=None,
+                   journal_path=None):
+        """
+        Upload a local file to the vault, only sending the blocks the
+        server does not already have
+            vaultname - name of the vault to upload to
+            filepath - path of the local file
+            chunker - deuceclient.common.chunker.Chunker to split the file
+                      with; defaults to a ContentDefinedChunker, which is
+                      slow without numpy (see deuceclient.common.chunker)
+            batch_size - most blocks assigned to the file per request
+            concurrency - number of blocks uploaded at the same time
+            max_inflight_bytes - most block data held in memory for a batch
+                                 and its uploads
+            max_rounds - times a batch is re-assigned and its missing blocks
+                         re-uploaded before giving up
+            mapped - True to memory-map the file and upload blocks straight
+                     from the mapping; otherwise the file is read into
+                     buffers
+            hasher - deuceclient.common.hashing.BlockHasher computing the
+                     block ids; on machines with several CPUs defaults to
+                     a thread pool with one worker per CPU for the
+                     duration of the upload
+            journal_path - optional file journaling the progress of the
+                           upload (see deuceclient.common.journal); if it
+                           records an unfinished upload of the same,
+                           unchanged file with the same chunking, the
+                           upload resumes where it stopped without
+                           reading the blocks already assigned. It is
+                           deleted once the file is finalized
+
+        Returns the id of the finalized file
+        """
+        if chunker is None:
+            chunker = ContentDefinedChunker()
+        owned_hasher = None
+        if hasher is None and (os.cpu_count() or 1) > 1:
+            hasher = owned_hasher = BlockHasher()
+
+        journal = None
+        start = 0
+        resumed = False
+        if journal_path is not None:
+            journal = UploadJournal(journal_path)
+            identity = UploadJournal.Identity(vaultname, filepath,
+                                              chunker.Signature)
+
+        if journal is not None and journal.Matches(identity):
+            fileid = journal.FileId
+            start = journal.ResumeOffset
+            resumed = True
+            self.log.info('Resuming upload of %s to file %s at offset %d',
+                          filepath, fileid, start)
         else:
-            raise RuntimeError(
-                'Failed to get Block list for File . '
-                'Error ({0:}): {1:}'.format(res.status_code, res.text))
+            location = self.CreateFile(vaultname)
+            fileid = location.rstrip('/').split('/')[-1]
+            self.log.info('Uploading %s to file %s', filepath, fileid)
+            if journal is not None:
+                journal.Begin(identity, fileid)
+
+        batch = []
+        batch_bytes = 0
+        try:
+            if mapped:
+                blocks = chunker.ChunkMapped(filepath, hasher=hasher,
+                                             start=start)
+            else:
+                blocks = chunker.ChunkFile(filepath, hasher=hasher,
+                                           start=start)
+
+            for block in blocks:
+                batch.append(block)
+                batch_bytes = batch_bytes + block[2]
+                if len(batch) >= batch_size or \
+                        batch_bytes >= max_inflight_bytes:
+                    self.__upload_batch(vaultname, fileid, batch,
+                                        concurrency, max_inflight_bytes,
+                                        max_rounds, journal)
+                    resumed = False
+                    batch = []
+                    batch_bytes = 0
+
+            if batch:
+                self.__upload_batch(vaultname, fileid, batch, concurrency,
+                                    max_inflight_bytes, max_rounds, journal)
+                resumed = False
+
+            if journal is not None:
+                # Every assigned range must be on disk before the file
+                # can no longer be assigned to
+                journal.Flush()
+            try:
+                self.FinalizeFile(vaultname, fileid)
+            except DeuceConflictError:
+                # The server confirmed every journaled block as stored, so
+                # a conflict on a resumed upload with nothing left to
+                # assign means an earlier run finalized the file but died
+                # or timed out before journaling it
+                if not resumed:
+                    raise
+                self.log.info('File %s was already finalized', fileid)
+            if journal is not None:
+                journal.Finalize()
+                journal.Remove()
+        finally:
+            if owned_hasher is not None:
+                owned_hasher.Close()
+            if journal is not None:
+                journal.Close()
+            if self.block_index is not None:
+                self.block_index.Flush()
+
+        return fileid
+
+    @staticmethod
+    def __file_block_entry(entry):
+        """
+        (internal) Normalize a GetFileBlockList entry to
+        (blockid, offset, size) where size may be None
+        """
+        if isinstance(entry, dict):
+            return (entry['id'], int(entry['offset']), entry.get('size'))
+        else:
+            return (entry[0], int(entry[1]),
+                    entry[2] if len(entry) > 2 else None)
+
+    def IterFileBlockList(self, vaultname, fileid, limit=1000,
+                          prefetch=True):
+        """
+        Generate every [blockid, offset] entry assigned to the file
+            vaultname - vault holding the file
+            fileid - file to list
+            limit - entries requested per page
+            prefetch - True to fetch the next page in the background while
+                       the current one is consumed
+        """
+        return self.__iter_pages(
+            lambda marker: self.GetFileBlockList(vaultname, fileid,
+                                                 marker=marker, limit=limit),
+            lambda entry: DeuceClient.__file_block_entry(entry)[1],
+            limit, prefetch)
+
+    def DownloadFile(self, vaultname, fileid, filepath, concurrency=8):
+        """
+        Download a file from the vault into a local file
+            vaultname - name of the vault holding the file
+            fileid - id of the file to download
+            filepath - local file to write; created if needed
+            concurrency - number of blocks downloaded at the same time
+
+        Blocks are fetched in parallel and streamed straight to their
+        offsets in the local file as they arrive, verifying each against its
+        id, so no block is ever held in memory as a whole. The block list is
+        consumed as the downloads progress, with its next page fetched in
+        the background, and at most a few blocks per worker are queued.
+
+        Returns a deuceclient.common.transfer.TransferResults once every
+        block has either been written or has failed; failed blocks are in
+        its Errors.
+        """
+        results = TransferResults()
+        queued = threading.Semaphore(concurrency * 4)
+
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, 0)
+            file_size = [0]
+            write_lock = threading.Lock()
+
+            def download(blockid, offset):
+                try:
+                    size = self.GetBlockDataInto(
+                        vaultname, blockid,
+                        PositionalWriter(fd, offset, write_lock))
+                    with write_lock:
+                        file_size[0] = max(file_size[0], offset + size)
+                    results.Success(blockid, size)
+                except Exception as ex:
+                    self.log.error('Failed to download block %s: %s',
+                                   blockid, ex)
+                    results.Failure(blockid, ex)
+                finally:
+                    queued.release()
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=concurrency) as executor:
+                for entry in self.IterFileBlockList(vaultname, fileid):
+                    blockid, offset, size = \
+                        DeuceClient.__file_block_entry(entry)
+                    if size is not None:
+                        # Keep the full size even if the block fails
+                        with write_lock:
+                            file_size[0] = max(file_size[0],
+                                               offset + int(size))
+                    queued.acquire()
+                    executor.submit(download, blockid, offset)
+
+            os.ftruncate(fd, file_size[0])
+        finally:
+            os.close(fd)
+
+        results.Finish()
+        return results
@@ -0,0 +1,182 @@
+"""
+Client-side Load Balancing
+
+Spreads the requests of one client over several Deuce API hosts serving
+the same storage. Hosts that keep failing are ejected for a while, for
+longer each time they fail again right after being readmitted, so that
+requests go to the hosts that are up.
+"""
+import threading
+import time
+
+
+class HostState(object):
+    """
+    What the balancer knows about a single host
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def Snapshot(self, now):
+        """
+        Return the state as a dictionary
+        """
+        return {
+            'outstanding': self.outstanding,
+            'latency': self.latency,
+            'failures': self.failures,
+            'ejections': self.ejections,
+            'ejected': self.ejected_until > now
+        }
+
+
+class LoadBalancer(object):
+    """
+    Pick the host for each request
+
+    Hosts are chosen by fewest requests outstanding, or by outstanding
+    requests weighted with each host's recent latency. Ties go to the
+    hosts in turn.
+    """
+
+    LEAST_OUTSTANDING = 'least-outstanding'
+    LATENCY_WEIGHTED = 'latency-weighted'
+
+    def __init__(self, hosts, strategy=LEAST_OUTSTANDING,
+                 failure_threshold=3, eject_time=10.0, max_eject_time=300.0,
+                 latency_decay=0.2):
+        """
+        Initialize the balancer
+          hosts - list of API hosts ('host:port')
+          strategy - LEAST_OUTSTANDING or LATENCY_WEIGHTED
+          failure_threshold - consecutive failures that eject a host
+          eject_time - seconds a host is first ejected for; doubled every
+                       time it fails again as soon as it is readmitted
+          max_eject_time - longest ejection
+          latency_decay - weight of the newest sample in the moving
+                          average of each host's latency
+        """
+        if not hosts:
+            raise ValueError('At least one host is required')
+        if strategy not in (LoadBalancer.LEAST_OUTSTANDING,
+                            LoadBalancer.LATENCY_WEIGHTED):
+            raise ValueError('Unknown strategy: {0:}'.format(strategy))
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.latency_decay = latency_decay
+        self.lock = threading.Lock()
+        self.hosts = [HostState(host) for host in hosts]
+        self.states = dict((state.host, state) for state in self.hosts)
+        self.turn = 0
+
+    @property
+    def Hosts(self):
+        """List of the hosts"""
+        return [state.host for state in self.hosts]
+
+    @property
+    def Stats(self):
+        """
+        Dictionary of host to its outstanding requests, latency average,
+        consecutive failures, ejection count and whether it is ejected
+        """
+        now = time.time()
+        with self.lock:
+            return dict((state.host, state.Snapshot(now))
+                        for state in self.hosts)
+
+    def __score(self, state):
+        """
+        (internal) Load of a host; lower is better
+        """
+        if self.strategy == LoadBalancer.LATENCY_WEIGHTED:
+            # Hosts without a sample yet go first so they get one
+            return (state.outstanding + 1) * (state.latency or 0.0)
+        return state.outstanding
+
+    def Acquire(self, exclude=()):
+        """
+        Pick the host for a request and count it as outstanding
+          exclude - hosts not to pick, e.g. those that already failed the
+                    request being retried
+
+        Ejected hosts are only picked when every other host is ejected as
+        well, the one readmitted soonest first. Returns None only if every
+        host is excluded. Every host returned must be given back with
+        Release().
+        """
+        now = time.time()
+        with self.lock:
+            count = len(self.hosts)
+            best = None
+            best_ejected = None
+            for index in range(count):
+                state = self.hosts[(self.turn + index) % count]
+                if state.host in exclude:
+                    continue
+                if state.ejected_until > now:
+                    if best_ejected is None or \
+                            state.ejected_until < best_ejected.ejected_until:
+                        best_ejected = state
+                elif best is None or \
+                        self.__score(state) < self.__score(best):
+                    best = state
+
+            if best is None:
+                best = best_ejected
+            if best is None:
+                return None
+            self.turn = (self.turn + 1) % count
+            best.outstanding = best.outstanding + 1
+            return best.host
+
+    def Release(self, host):
+        """
+        Give back a host returned by Acquire() once its request is over
+        """
+        with self.lock:
+            state = self.states[host]
+            state.outstanding = state.outstanding - 1
+
+    def Success(self, host, latency=None):
+        """
+        Record a request to host that got a response from a healthy server
+          latency - seconds the request took, if it should be sampled
+        """
+        with self.lock:
+            state = self.states[host]
+            state.failures = 0
+            state.ejections = 0
+            if latency is not None:
+                if state.latency is None:
+                    state.latency = latency
+                else:
+                    state.latency = state.latency + self.latency_decay * \
+                        (latency - state.latency)
+
+    def Failure(self, host):
+        """
+        Record a request to host that failed in transport or with a 5xx
+        """
+        now = time.time()
+        with self.lock:
+            state = self.states[host]
+            if state.ejected_until > now:
+                # Requests sent before the host was ejected
+                return
+            state.failures = state.failures + 1
+            readmitted = state.ejections > 0
+            if readmitted or state.failures >= self.failure_threshold:
+                eject_time = min(self.eject_time * (2 ** state.ejections),
+                                 self.max_eject_time)
+                state.ejections = state.ejections + 1
+                state.ejected_until = now + eject_time
+                state.failures = 0
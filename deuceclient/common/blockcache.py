@@ -0,0 +1,261 @@
+"""
+Local Block Cache
+
+Keeps the data of recently fetched blocks so that blocks shared by many
+files are only downloaded once.
+
+Blocks are immutable and named by the SHA-1 digest of their data, so the
+cache is keyed by block id alone, whatever vault a block came from, and
+anything read back from disk is checked against its id before use.
+There are two tiers, each bounded in bytes and evicting the least
+recently used blocks: memory, and optionally a directory on disk.
+"""
+import collections
+import hashlib
+import logging
+import os
+import re
+import threading
+
+
+class BlockCache(object):
+    """
+    Two-tier (memory, then disk) LRU cache of block data
+    """
+
+    BLOCKID = re.compile(r'^[0-9a-f]{40}$')
+
+    def __init__(self, memory_bytes=64 * 1024 * 1024, disk_path=None,
+                 disk_bytes=1024 * 1024 * 1024):
+        """
+        Initialize the cache
+          memory_bytes - most block data held in memory; 0 disables the
+                         memory tier
+          disk_path - directory for the disk tier; None disables it
+          disk_bytes - most block data kept in disk_path
+
+        Blocks already in disk_path from earlier runs are kept, oldest
+        first in line for eviction.
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.memory_bytes = memory_bytes
+        self.memory = collections.OrderedDict()
+        self.memory_used = 0
+        self.disk_path = disk_path
+        self.disk_bytes = disk_bytes
+        self.disk = collections.OrderedDict()
+        self.disk_used = 0
+        self.counters = dict.fromkeys(['memory_hits', 'disk_hits', 'misses',
+                                       'memory_evictions', 'disk_evictions',
+                                       'corrupt'], 0)
+
+        if disk_path is not None:
+            if not os.path.isdir(disk_path):
+                os.makedirs(disk_path, 0o700)
+            self.__load_disk()
+
+    def __load_disk(self):
+        """
+        (internal) Index the blocks already on disk by modification time
+        """
+        entries = []
+        for directory, subdirs, files in os.walk(self.disk_path):
+            for name in files:
+                path = os.path.join(directory, name)
+                if not BlockCache.BLOCKID.match(name):
+                    # Left over from an interrupted write
+                    if name.endswith('.tmp'):
+                        os.unlink(path)
+                    continue
+                info = os.stat(path)
+                entries.append((info.st_mtime, name, info.st_size))
+        for mtime, blockid, size in sorted(entries):
+            self.disk[blockid] = size
+            self.disk_used = self.disk_used + size
+        self.__evict_disk()
+
+    def __disk_file(self, blockid):
+        """
+        (internal) Path of a block in the disk tier
+        """
+        return os.path.join(self.disk_path, blockid[:2], blockid)
+
+    @property
+    def Stats(self):
+        """
+        Dictionary of the hit, miss, eviction and corruption counters plus
+        the bytes held by each tier
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['memory_bytes'] = self.memory_used
+            stats['memory_blocks'] = len(self.memory)
+            stats['disk_bytes'] = self.disk_used
+            stats['disk_blocks'] = len(self.disk)
+        return stats
+
+    def __evict_memory(self):
+        """
+        (internal) Drop least recently used blocks until the memory tier
+        fits; the lock must be held
+        """
+        while self.memory_used > self.memory_bytes:
+            blockid, data = self.memory.popitem(last=False)
+            self.memory_used = self.memory_used - len(data)
+            self.counters['memory_evictions'] += 1
+
+    def __evict_disk(self):
+        """
+        (internal) Delete least recently used blocks until the disk tier
+        fits; the lock must be held
+        """
+        while self.disk_used > self.disk_bytes:
+            blockid, size = self.disk.popitem(last=False)
+            self.disk_used = self.disk_used - size
+            self.counters['disk_evictions'] += 1
+            try:
+                os.unlink(self.__disk_file(blockid))
+            except OSError:
+                pass
+
+    def __remember(self, blockid, data):
+        """
+        (internal) Put data in the memory tier; the lock must be held
+        """
+        if len(data) > self.memory_bytes:
+            return
+        if blockid in self.memory:
+            self.memory.move_to_end(blockid)
+            return
+        self.memory[blockid] = data
+        self.memory_used = self.memory_used + len(data)
+        self.__evict_memory()
+
+    def __read_disk(self, blockid):
+        """
+        (internal) Return the verified data of a block on disk, or None
+        """
+        path = self.__disk_file(blockid)
+        try:
+            with open(path, 'rb') as block_file:
+                data = block_file.read()
+        except (IOError, OSError):
+            data = None
+
+        if data is not None and hashlib.sha1(data).hexdigest() == blockid:
+            try:
+                # Mark it recently used for the next run's eviction order
+                os.utime(path, None)
+            except OSError:
+                pass
+            return data
+
+        self.log.warning('Dropping unreadable cached block %s', blockid)
+        with self.lock:
+            self.counters['corrupt'] += 1
+            size = self.disk.pop(blockid, None)
+            if size is not None:
+                self.disk_used = self.disk_used - size
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+
+    def Get(self, blockid):
+        """
+        Return the data of a block, or None if it is not cached
+        """
+        with self.lock:
+            data = self.memory.get(blockid)
+            if data is not None:
+                self.memory.move_to_end(blockid)
+                self.counters['memory_hits'] += 1
+                return data
+            on_disk = blockid in self.disk
+            if on_disk:
+                self.disk.move_to_end(blockid)
+
+        if on_disk:
+            data = self.__read_disk(blockid)
+            if data is not None:
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+                    self.__remember(blockid, data)
+                return data
+
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def Put(self, blockid, data):
+        """
+        Cache the data of a block
+          blockid - SHA-1 hex digest of data; the caller must have checked
+                    it, the data is not hashed again
+          data - bytes of the block
+        """
+        if not BlockCache.BLOCKID.match(blockid):
+            return
+        data = bytes(data)
+        with self.lock:
+            self.__remember(blockid, data)
+            to_disk = self.disk_path is not None and \
+                blockid not in self.disk and len(data) <= self.disk_bytes
+
+        if not to_disk:
+            return
+        path = self.__disk_file(blockid)
+        temp_path = '{0:}.{1:}.{2:}.tmp'.format(path, os.getpid(),
+                                                threading.current_thread()
+                                                .ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+            with open(temp_path, 'wb') as block_file:
+                block_file.write(data)
+            os.replace(temp_path, path)
+        except (IOError, OSError) as ex:
+            self.log.warning('Failed to cache block %s on disk: %s',
+                             blockid, ex)
+            return
+
+        with self.lock:
+            if blockid not in self.disk:
+                self.disk[blockid] = len(data)
+                self.disk_used = self.disk_used + len(data)
+                self.__evict_disk()
+
+    def Discard(self, blockid):
+        """
+        Drop a block from both tiers
+        """
+        with self.lock:
+            data = self.memory.pop(blockid, None)
+            if data is not None:
+                self.memory_used = self.memory_used - len(data)
+            size = self.disk.pop(blockid, None)
+            if size is not None:
+                self.disk_used = self.disk_used - size
+        if size is not None:
+            try:
+                os.unlink(self.__disk_file(blockid))
+            except OSError:
+                pass
+
+    def Clear(self):
+        """
+        Drop every block from both tiers
+        """
+        with self.lock:
+            blockids = list(self.disk)
+            self.memory.clear()
+            self.memory_used = 0
+            self.disk.clear()
+            self.disk_used = 0
+        for blockid in blockids:
+            try:
+                os.unlink(self.__disk_file(blockid))
+            except OSError:
+                pass
@@ -0,0 +1,243 @@
+"""
+Local Block Existence Index
+
+Remembers which blocks are known to be stored in which vault so uploads
+can skip blocks without asking the server.
+
+The index is an SQLite database of (vault, SHA-1 digest) pairs fronted by
+a Bloom filter kept in a memory-mapped file next to it. The Bloom filter
+has a fixed size, so memory use does not grow with the number of blocks;
+it answers most "not present" lookups without touching the database.
+"""
+import binascii
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+
+
+class BloomFilter(object):
+    """
+    Fixed-size Bloom filter stored in a memory-mapped file
+    """
+
+    def __init__(self, path, bits=2 ** 27, hashes=7):
+        """
+        Open (or create) the Bloom filter
+          path - file backing the filter
+          bits - number of bits in the filter; 2 ** 27 bits (16 MiB) keeps
+                 false positives near 1% for ~14 million entries
+          hashes - number of bits set per entry
+
+        The filter is emptied if the file does not match the requested size.
+        """
+        self.bits = bits
+        self.hashes = hashes
+        size = (bits + 7) // 8
+
+        self.created = not os.path.exists(path) or \
+            os.path.getsize(path) != size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if self.created:
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    @property
+    def Created(self):
+        """True if the filter was created empty when opened"""
+        return self.created
+
+    def __positions(self, key):
+        """
+        (internal) bit positions for a key using double hashing
+        """
+        first, second = struct.unpack_from('<QQ', hashlib.sha1(key).digest())
+        second = second | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def Add(self, key):
+        """
+        Add a key (bytes) to the filter
+        """
+        for position in self.__positions(key):
+            index = position >> 3
+            self.map[index] = self.map[index] | (1 << (position & 7))
+
+    def __contains__(self, key):
+        for position in self.__positions(key):
+            if not self.map[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def Clear(self):
+        """
+        Remove all keys
+        """
+        self.map[:] = bytes(len(self.map))
+
+    def Flush(self):
+        """
+        Write the filter to disk
+        """
+        self.map.flush()
+
+    def Close(self):
+        """
+        Close the filter
+        """
+        self.map.close()
+        os.close(self.fd)
+
+
+class BlockIndex(object):
+    """
+    Persistent index of the blocks known to exist in each vault
+    """
+
+    def __init__(self, path, bloom_bits=2 ** 27, bloom_hashes=7,
+                 commit_interval=1000):
+        """
+        Open (or create) the index
+          path - SQLite database file; the Bloom filter is kept in
+                 path + '.bloom'
+          bloom_bits - size of the Bloom filter in bits
+          bloom_hashes - number of bits set per block in the Bloom filter
+          commit_interval - number of additions batched per transaction
+        """
+        self.lock = threading.Lock()
+        self.commit_interval = commit_interval
+        self.pending = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blocks ('
+                        ' vault TEXT NOT NULL,'
+                        ' blockid BLOB NOT NULL,'
+                        ' PRIMARY KEY (vault, blockid)'
+                        ') WITHOUT ROWID')
+        self.db.commit()
+
+        self.bloom = BloomFilter(path + '.bloom', bloom_bits, bloom_hashes)
+        if self.bloom.Created:
+            self.__rebuild_bloom()
+
+    @staticmethod
+    def __key(vaultname, digest):
+        """
+        (internal) Bloom filter key for a block
+        """
+        return vaultname.encode('utf-8') + b'/' + digest
+
+    def __rebuild_bloom(self):
+        """
+        (internal) Refill the Bloom filter from the database
+        """
+        self.bloom.Clear()
+        for vaultname, digest in self.db.execute(
+                'SELECT vault, blockid FROM blocks'):
+            self.bloom.Add(BlockIndex.__key(vaultname, digest))
+        self.bloom.Flush()
+
+    def __commit(self, force=False):
+        """
+        (internal) Commit once enough additions are pending
+        """
+        if self.pending and (force or self.pending >= self.commit_interval):
+            self.db.commit()
+            self.bloom.Flush()
+            self.pending = 0
+
+    def Contains(self, vaultname, blockid):
+        """
+        Return True if the block is known to exist in the vault
+            blockid - SHA-1 hex digest of the block
+        """
+        digest = binascii.unhexlify(blockid)
+        if BlockIndex.__key(vaultname, digest) not in self.bloom:
+            return False
+        with self.lock:
+            row = self.db.execute(
+                'SELECT 1 FROM blocks WHERE vault = ? AND blockid = ?',
+                (vaultname, digest)).fetchone()
+        return row is not None
+
+    def Add(self, vaultname, blockid):
+        """
+        Record that the block exists in the vault
+        """
+        self.AddMany(vaultname, [blockid])
+
+    def AddMany(self, vaultname, blockids):
+        """
+        Record that several blocks exist in the vault
+        """
+        digests = [binascii.unhexlify(blockid) for blockid in blockids]
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO blocks (vault, blockid) VALUES (?, ?)',
+                [(vaultname, digest) for digest in digests])
+            for digest in digests:
+                self.bloom.Add(BlockIndex.__key(vaultname, digest))
+            self.pending = self.pending + len(digests)
+            self.__commit()
+
+    def Discard(self, vaultname, blockid):
+        """
+        Forget a block, e.g. after the server reported it missing
+
+        Committed right away: an entry surviving a crash would make a
+        later UploadBlock skip a block the vault does not hold.
+        """
+        with self.lock:
+            self.db.execute(
+                'DELETE FROM blocks WHERE vault = ? AND blockid = ?',
+                (vaultname, binascii.unhexlify(blockid)))
+            self.pending = self.pending + 1
+            self.__commit(force=True)
+
+    def Invalidate(self, vaultname=None):
+        """
+        Forget every block of the vault, or of all vaults if None
+
+        The Bloom filter is only emptied when all vaults are invalidated;
+        bits left behind by a single vault merely cost a database lookup.
+        """
+        with self.lock:
+            if vaultname is None:
+                self.db.execute('DELETE FROM blocks')
+                self.bloom.Clear()
+                self.bloom.Flush()
+            else:
+                self.db.execute('DELETE FROM blocks WHERE vault = ?',
+                                (vaultname,))
+            self.db.commit()
+            self.pending = 0
+
+    def Count(self, vaultname):
+        """
+        Number of blocks recorded for the vault
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM blocks WHERE vault = ?',
+                (vaultname,)).fetchone()[0]
+
+    def Flush(self):
+        """
+        Commit all pending additions to disk
+        """
+        with self.lock:
+            self.__commit(force=True)
+
+    def Close(self):
+        """
+        Flush and close the index
+        """
+        self.Flush()
+        with self.lock:
+            self.bloom.Close()
+            self.db.close()
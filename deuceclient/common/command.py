@@ -1,29 +1,69 @@
 """
 Basic HTTP Command Interface
 """
+import collections
+import types
 
-import deuce
+import deuceclient
+from deuceclient.common.pool import ConnectionPool
+
+
+class Request(collections.namedtuple('Request',
+                                     ['method', 'uri', 'headers', 'body',
+                                      'operation'])):
+    """
+    Immutable description of a single HTTP request
+      method - HTTP verb
+      uri - full URI of the resource
+      headers - read-only mapping of the HTTP headers
+      body - HTTP message body data, or None
+      operation - name of the API call the request belongs to
+    """
+    __slots__ = ()
 
 
 class Command(object):
     """
     Base class for defining HTTP REST API calls
+
+    A Command only holds configuration that does not change after it is
+    created plus the connection pool. Every call builds its own Request
+    with BuildRequest() and issues it with Send(), so one instance can be
+    used from any number of threads at once.
     """
 
-    def __init__(self, apihost, uripath, sslenabled=False):
+    def __init__(self, sslenabled, apihost, uripath, pool=None,
+                 instrumentation=None):
         """
         Initialize the Command Object
+          sslenabled - True if using HTTPS; otherwise False
           apihost - server to use for API calls
           uripath - HTTP(S) Path for the REST API being defined
-          sslenabled - True if using HTTPS; otherwise False
+          pool - optional deuceclient.common.pool.ConnectionPool to issue
+                 requests through; pass the same instance to several
+                 objects to share connections between them
+          instrumentation - optional
+                            deuceclient.common.instrumentation.Instrumentation
+                            notified of every request
         """
+        self.sslenabled = sslenabled
+        self.instrumentation = instrumentation
+        self.apihost = apihost
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+
+        self.base_headers = {}
+        self.base_headers['X-Deuce-User-Agent'] = 'Deuce-Client/{0:}'.format(
+            deuceclient.version())
+        self.base_headers['User-Agent'] = \
+            self.base_headers['X-Deuce-User-Agent']
+        # By default we set the HTTP Content Type
+        self.base_headers['Content-Type'] = 'application/json; charset=utf-8'
+
         self.body = {}
         self.headers = {}
-        self.headers['X-Deuce-User-Agent'] = 'Deuce-Client/{0:}'.format(
-            deuce.version())
-        self.headers['User-Agent'] = self.headers['X-Deuce-User-Agent']
         self.uri = ''
-        self.apihost = apihost
         self.__ReInit(sslenabled, uripath)
 
     @property
@@ -31,6 +71,16 @@ class Command(object):
         """API Host"""
         return self.apihost
 
+    @property
+    def Pool(self):
+        """HTTP Connection Pool"""
+        return self.pool
+
+    @property
+    def Instrumentation(self):
+        """Instrumentation notified of every request, or None"""
+        return self.instrumentation
+
     @property
     def Body(self):
         """HTTP Message Body Data"""
@@ -46,16 +96,89 @@ class Command(object):
         """HTTP URI"""
         return self.uri
 
+    def BuildUri(self, uripath, apihost=None):
+        """
+        Return the full URI of a path on the API host, or on apihost
+        """
+        if apihost is None:
+            apihost = self.apihost
+        if self.sslenabled:
+            return 'https://' + apihost + uripath
+        else:
+            return 'http://' + apihost + uripath
+
+    def BuildRequest(self, method, uripath, headers=None, body=None,
+                     operation=None, apihost=None):
+        """
+        Build the Request for a single call
+          method - HTTP verb
+          uripath - HTTP(S) Path of the resource
+          headers - headers to add to (or override) the common ones
+          body - HTTP message body data
+          operation - name of the API call, used by the instrumentation
+          apihost - server to send the request to instead of the API host
+        """
+        request_headers = dict(self.base_headers)
+        if headers is not None:
+            request_headers.update(headers)
+        return Request(method, self.BuildUri(uripath, apihost),
+                       types.MappingProxyType(request_headers), body,
+                       operation or method)
+
+    @staticmethod
+    def __body_size(body):
+        """
+        (internal) Size of a request body when it can be known up front
+        """
+        if body is None:
+            return 0
+        elif isinstance(body, str):
+            return len(body)
+        try:
+            return memoryview(body).nbytes
+        except TypeError:
+            # File-like or generator bodies
+            return 0
+
+    def Send(self, request, **kwargs):
+        """
+        Issue a Request over the connection pool and return the response
+          kwargs - passed through to requests (e.g. stream=True)
+        """
+        if self.instrumentation is None:
+            return self.pool.request(request.method, request.uri,
+                                     headers=request.headers,
+                                     data=request.body, **kwargs)
+
+        started = self.instrumentation.RequestStarted(request.operation)
+        bytes_sent = Command.__body_size(request.body)
+        status = None
+        bytes_received = 0
+        try:
+            res = self.pool.request(request.method, request.uri,
+                                    headers=request.headers,
+                                    data=request.body, **kwargs)
+            status = res.status_code
+            if kwargs.get('stream'):
+                bytes_received = int(res.headers.get('Content-Length', 0))
+            else:
+                bytes_received = len(res.content)
+            return res
+        finally:
+            self.instrumentation.RequestFinished(request.operation, started,
+                                                 status, bytes_sent,
+                                                 bytes_received)
+
     def ReInit(self, sslenabled, uripath):
         """
         Reinitialize the HTTP URI with the new specification
-        Useful for objects that provide access to multiple HTTP REST API calls
+
+        Note: This changes state shared by every user of the object; use
+              BuildRequest() instead where several threads are involved
         """
         # By default there is no HTTP Body Data
         self.body = None
-        # By default we set the HTTP Content Type
-        self.headers = {}
-        self.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.headers = dict(self.base_headers)
         # HTTP or HTTPS
         if (sslenabled):
             self.uri = "https://" + self.apihost + uripath
@@ -0,0 +1,169 @@
+"""
+Parallel Block Hashing
+
+Computes the SHA-1 block ids of a stream of blocks on several cores while
+keeping the blocks in their original order.
+
+hashlib releases the GIL while hashing large buffers, so a thread pool
+scales across cores without copying any data. A process pool is also
+available for interpreters where that is not enough; its workers read
+each block straight from the file with os.pread rather than having the
+data pickled over to them.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import os
+
+
+def _sha1_hex(buffer):
+    """
+    Return the SHA-1 hex digest of a buffer
+    """
+    return hashlib.sha1(buffer).hexdigest()
+
+
+# Descriptors kept open by each process pool worker, by path, as
+# (file identity, descriptor); a replaced or modified file is reopened
+_worker_files = collections.OrderedDict()
+
+# Most descriptors a worker keeps open
+WORKER_FILES_MAX = 8
+
+
+def _file_identity(path):
+    """
+    Return what changes when the file at path is replaced or modified
+    """
+    info = os.stat(path)
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+def _worker_file(path, identity):
+    """
+    Return a descriptor of path as it was when identity was taken; run in
+    a process pool worker
+    """
+    cached = _worker_files.pop(path, None)
+    if cached is not None:
+        if cached[0] == identity:
+            _worker_files[path] = cached
+            return cached[1]
+        os.close(cached[1])
+
+    fd = os.open(path, os.O_RDONLY)
+    info = os.fstat(fd)
+    if (info.st_dev, info.st_ino, info.st_size,
+            info.st_mtime_ns) != identity:
+        os.close(fd)
+        raise IOError('{0:} changed while being hashed'.format(path))
+
+    while len(_worker_files) >= WORKER_FILES_MAX:
+        os.close(_worker_files.popitem(last=False)[1][1])
+    _worker_files[path] = (identity, fd)
+    return fd
+
+
+def _pread_sha1_hex(path, identity, offset, size):
+    """
+    Return the SHA-1 hex digest of size bytes of path at offset; run in a
+    process pool worker
+      identity - _file_identity() of path when hashing started
+    """
+    fd = _worker_file(path, identity)
+
+    digest = hashlib.sha1()
+    while size:
+        piece = os.pread(fd, min(size, 4 * 1024 * 1024), offset)
+        if not piece:
+            raise IOError('{0:} is shorter than expected'.format(path))
+        digest.update(piece)
+        offset = offset + len(piece)
+        size = size - len(piece)
+    return digest.hexdigest()
+
+
+class BlockHasher(object):
+    """
+    Hash blocks on a pool of workers
+
+        with BlockHasher() as hasher:
+            for blockid, offset, size, buffer in \\
+                    chunker.ChunkMapped(path, hasher=hasher):
+                ...
+    """
+
+    def __init__(self, workers=None, window=None, processes=False):
+        """
+        Initialize the hasher
+          workers - number of workers; defaults to the number of CPUs
+          window - most blocks being hashed or waiting to be consumed at
+                   once, which bounds the memory held; defaults to four
+                   per worker
+          processes - True to hash in a process pool reading the blocks
+                      from the file with os.pread; otherwise a thread pool
+                      hashes the buffers themselves
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if window is None:
+            window = workers * 4
+        self.workers = workers
+        self.window = max(window, 1)
+        self.processes = processes
+        if processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    @property
+    def Workers(self):
+        """Number of workers"""
+        return self.workers
+
+    def Hash(self, spans, path=None):
+        """
+        Generate block tuples with their ids filled in
+          spans - iterable of (offset, size, buffer) in file order
+          path - file the spans come from; required when hashing in
+                 processes
+
+        Yields (blockid, offset, size, buffer) in the order of spans
+        """
+        if self.processes and path is None:
+            raise ValueError('Hashing in processes requires the file path')
+
+        if self.processes:
+            identity = _file_identity(path)
+
+        pending = collections.deque()
+        for offset, size, buffer in spans:
+            if self.processes:
+                future = self.executor.submit(_pread_sha1_hex, path,
+                                              identity, offset, size)
+            else:
+                future = self.executor.submit(_sha1_hex, buffer)
+            pending.append((future, offset, size, buffer))
+
+            while len(pending) >= self.window or \
+                    (pending and pending[0][0].done()):
+                future, offset, size, buffer = pending.popleft()
+                yield (future.result(), offset, size, buffer)
+
+        while pending:
+            future, offset, size, buffer = pending.popleft()
+            yield (future.result(), offset, size, buffer)
+
+    def Close(self):
+        """
+        Shut the workers down
+        """
+        self.executor.shutdown(wait=True)
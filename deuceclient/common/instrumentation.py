@@ -0,0 +1,242 @@
+"""
+Request Instrumentation
+
+Objects that can be handed to DeuceClient and Authentication to observe
+every HTTP request they make. Nothing is recorded unless one is given.
+"""
+import bisect
+import os
+import threading
+import time
+
+
+class Instrumentation(object):
+    """
+    Base class for instrumentation hooks; every hook does nothing
+
+    Hooks are called from whichever thread issues the request.
+    """
+
+    def RequestStarted(self, operation):
+        """
+        Called before a request is sent
+          operation - name of the API call, e.g. 'UploadBlock'
+
+        Returns a value passed back to RequestFinished()
+        """
+        return None
+
+    def RequestFinished(self, operation, started, status, bytes_sent,
+                        bytes_received):
+        """
+        Called once a request has completed or failed
+          operation - name of the API call
+          started - value returned by RequestStarted()
+          status - HTTP status code, or None if no response was received
+          bytes_sent - size of the request body
+          bytes_received - size of the response body, when known
+        """
+        pass
+
+    def RequestRetried(self, operation):
+        """
+        Called when a request is about to be retried
+        """
+        pass
+
+
+class InstrumentationGroup(Instrumentation):
+    """
+    Forward every hook to several instrumentation objects, e.g. to record
+    metrics and trace requests at the same time
+    """
+
+    def __init__(self, *members):
+        self.members = tuple(member for member in members
+                             if member is not None)
+
+    def RequestStarted(self, operation):
+        return [member.RequestStarted(operation) for member in self.members]
+
+    def RequestFinished(self, operation, started, status, bytes_sent,
+                        bytes_received):
+        for member, member_started in zip(self.members, started):
+            member.RequestFinished(operation, member_started, status,
+                                   bytes_sent, bytes_received)
+
+    def RequestRetried(self, operation):
+        for member in self.members:
+            member.RequestRetried(operation)
+
+
+class OperationMetrics(object):
+    """
+    Counters collected for a single operation
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = {}
+        self.retries = 0
+        self.in_flight = 0
+
+    def Snapshot(self):
+        """
+        Return the counters as a dictionary
+        """
+        return {
+            'count': self.count,
+            'latency_sum': self.latency_sum,
+            'latency_buckets': list(zip(self.buckets + (float('inf'),),
+                                        self.bucket_counts)),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'statuses': dict(self.statuses),
+            'retries': self.retries,
+            'in_flight': self.in_flight
+        }
+
+
+class MetricsRecorder(Instrumentation):
+    """
+    In-process metrics: per-operation latency histograms, bytes sent and
+    received, status codes, retries and requests in flight
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Initialize the recorder
+          buckets - upper bounds, in seconds, of the latency histogram
+                    buckets; an unbounded bucket is always added
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def __operation(self, operation):
+        """
+        (internal) Counters of an operation; the lock must be held
+        """
+        metrics = self.operations.get(operation)
+        if metrics is None:
+            metrics = OperationMetrics(self.buckets)
+            self.operations[operation] = metrics
+        return metrics
+
+    def RequestStarted(self, operation):
+        with self.lock:
+            self.__operation(operation).in_flight += 1
+        return time.time()
+
+    def RequestFinished(self, operation, started, status, bytes_sent,
+                        bytes_received):
+        latency = time.time() - started
+        bucket = bisect.bisect_left(self.buckets, latency)
+        with self.lock:
+            metrics = self.__operation(operation)
+            metrics.in_flight -= 1
+            metrics.count += 1
+            metrics.latency_sum += latency
+            metrics.bucket_counts[bucket] += 1
+            metrics.bytes_sent += bytes_sent
+            metrics.bytes_received += bytes_received
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+
+    def RequestRetried(self, operation):
+        with self.lock:
+            self.__operation(operation).retries += 1
+
+    def Snapshot(self):
+        """
+        Return a dictionary of operation name to its counters
+        """
+        with self.lock:
+            return dict((operation, metrics.Snapshot())
+                        for operation, metrics in self.operations.items())
+
+    def Reset(self):
+        """
+        Drop all counters except requests currently in flight
+        """
+        with self.lock:
+            for operation, metrics in list(self.operations.items()):
+                in_flight = metrics.in_flight
+                self.operations[operation] = OperationMetrics(self.buckets)
+                self.operations[operation].in_flight = in_flight
+
+    def PrometheusText(self, prefix='deuce_client'):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.Snapshot()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append('# HELP {0:}_{1:} {2:}'.format(prefix, name,
+                                                        help_text))
+            lines.append('# TYPE {0:}_{1:} {2:}'.format(prefix, name, kind))
+
+        def value(name, labels, number):
+            lines.append('{0:}_{1:}{{{2:}}} {3:}'.format(
+                prefix, name,
+                ','.join('{0:}="{1:}"'.format(k, v) for k, v in labels),
+                repr(number) if isinstance(number, float) else number))
+
+        metric('request_duration_seconds', 'histogram',
+               'Latency of Deuce requests')
+        for operation in sorted(snapshot):
+            counts = snapshot[operation]
+            cumulative = 0
+            for bound, count in counts['latency_buckets']:
+                cumulative = cumulative + count
+                value('request_duration_seconds_bucket',
+                      [('operation', operation),
+                       ('le', '+Inf' if bound == float('inf') else bound)],
+                      cumulative)
+            value('request_duration_seconds_sum',
+                  [('operation', operation)], counts['latency_sum'])
+            value('request_duration_seconds_count',
+                  [('operation', operation)], counts['count'])
+
+        metric('requests_total', 'counter', 'Deuce requests by status code')
+        for operation in sorted(snapshot):
+            statuses = snapshot[operation]['statuses']
+            for status in sorted(statuses, key=str):
+                value('requests_total',
+                      [('operation', operation),
+                       ('status', 'none' if status is None else status)],
+                      statuses[status])
+
+        for name, key, kind, help_text in (
+                ('bytes_sent_total', 'bytes_sent', 'counter',
+                 'Request body bytes sent'),
+                ('bytes_received_total', 'bytes_received', 'counter',
+                 'Response body bytes received'),
+                ('retries_total', 'retries', 'counter',
+                 'Requests retried'),
+                ('requests_in_flight', 'in_flight', 'gauge',
+                 'Requests currently in progress')):
+            metric(name, kind, help_text)
+            for operation in sorted(snapshot):
+                value(name, [('operation', operation)],
+                      snapshot[operation][key])
+
+        return '\n'.join(lines) + '\n'
+
+    def WritePrometheusFile(self, path, prefix='deuce_client'):
+        """
+        Atomically write the metrics to a Prometheus text file, e.g. for
+        the node exporter textfile collector
+        """
+        temp_path = '{0:}.{1:}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.PrometheusText(prefix))
+        os.replace(temp_path, path)
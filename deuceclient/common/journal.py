@@ -0,0 +1,210 @@
+"""
+Upload Transfer Journal
+
+Records the progress of a file upload so that an interrupted upload can
+be resumed: the Deuce file id in use, the block ranges already assigned
+to it and whether it was finalized. Blocks uploaded for a range that was
+not assigned yet are not recorded; assigning the range again on resume
+has the server report only the blocks it still lacks.
+
+The journal is an append-only file of JSON records, one per line.
+Records are flushed to disk in batches; losing the last few in a crash
+only means redoing that bit of work, since a range is never recorded
+until the server has confirmed it. A torn final line is ignored.
+"""
+import json
+import logging
+import os
+import time
+
+
+class UploadJournal(object):
+    """
+    Journal of a single file upload
+    """
+
+    def __init__(self, path, sync_every=100, sync_interval=1.0):
+        """
+        Open (or create) the journal
+          path - journal file
+          sync_every - records written between two fsyncs
+          sync_interval - most seconds between two fsyncs
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+        self.header = None
+        self.resume_offset = 0
+        self.assigned_blocks = 0
+        self.finalized = False
+        self.__load()
+        self.journal_file = open(path, 'a')
+
+    def __load(self):
+        """
+        (internal) Replay the records of an existing journal
+        """
+        try:
+            journal_file = open(self.path, 'r')
+        except (IOError, OSError):
+            return
+
+        valid_bytes = 0
+        with journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if record is None or not line.endswith('\n'):
+                    self.log.warning('Ignoring torn record at the end of %s',
+                                     self.path)
+                    break
+                valid_bytes = valid_bytes + len(line.encode('utf-8'))
+                self.__apply(record)
+
+        # Drop the torn record so new ones start on a line of their own
+        if valid_bytes != os.path.getsize(self.path):
+            with open(self.path, 'r+') as journal_file:
+                journal_file.truncate(valid_bytes)
+
+    def __apply(self, record):
+        """
+        (internal) Update the state from a single record
+        """
+        kind = record.get('record')
+        if kind == 'start':
+            self.header = record
+            self.resume_offset = 0
+            self.assigned_blocks = 0
+            self.finalized = False
+        elif kind == 'assigned':
+            for blockid, offset, size in record['blocks']:
+                self.resume_offset = max(self.resume_offset, offset + size)
+            self.assigned_blocks = self.assigned_blocks + \
+                len(record['blocks'])
+        elif kind == 'finalized':
+            self.finalized = True
+
+    @staticmethod
+    def Identity(vaultname, filepath, chunker_signature):
+        """
+        Return what a journal must match to resume an upload: the vault,
+        the file's path, size and modification time, and how it is chunked
+        """
+        info = os.stat(filepath)
+        return {
+            'vault': vaultname,
+            'path': os.path.abspath(filepath),
+            'size': info.st_size,
+            'mtime_ns': info.st_mtime_ns,
+            'chunker': chunker_signature
+        }
+
+    @property
+    def Path(self):
+        """Journal file"""
+        return self.path
+
+    @property
+    def FileId(self):
+        """Deuce file id of the upload, or None if none was started"""
+        return None if self.header is None else self.header['fileid']
+
+    @property
+    def ResumeOffset(self):
+        """Offset up to which every block is assigned to the file"""
+        return self.resume_offset
+
+    @property
+    def AssignedBlocks(self):
+        """Number of blocks assigned to the file"""
+        return self.assigned_blocks
+
+    @property
+    def Finalized(self):
+        """True if the file was finalized"""
+        return self.finalized
+
+    def Matches(self, identity):
+        """
+        Return True if the journal records an unfinished upload of the
+        file described by identity (see Identity())
+        """
+        if self.header is None or self.finalized:
+            return False
+        return all(self.header.get(key) == value
+                   for key, value in identity.items())
+
+    def __append(self, record, sync=False):
+        """
+        (internal) Append a record, syncing it to disk when due
+        """
+        self.journal_file.write(json.dumps(record, separators=(',', ':')))
+        self.journal_file.write('\n')
+        self.__apply(record)
+        self.unsynced = self.unsynced + 1
+        if sync or self.unsynced >= self.sync_every or \
+                time.time() - self.last_sync >= self.sync_interval:
+            self.Flush()
+
+    def Begin(self, identity, fileid):
+        """
+        Start journaling a new upload, discarding any earlier records
+          identity - see Identity()
+          fileid - Deuce file id the blocks are assigned to
+        """
+        self.journal_file.close()
+        self.journal_file = open(self.path, 'w')
+        record = dict(identity)
+        record['record'] = 'start'
+        record['fileid'] = fileid
+        self.__append(record, sync=True)
+
+    def Assigned(self, blocks):
+        """
+        Record blocks the server confirmed are assigned to the file and
+        all stored
+          blocks - iterable of (blockid, offset, size[, buffer]) tuples
+        """
+        self.__append({
+            'record': 'assigned',
+            'blocks': [[block[0], block[1], block[2]] for block in blocks]
+        })
+
+    def Finalize(self):
+        """
+        Record that the file was finalized
+        """
+        self.__append({'record': 'finalized'}, sync=True)
+
+    def Flush(self):
+        """
+        Write every record to disk
+        """
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def Close(self):
+        """
+        Flush and close the journal
+        """
+        if not self.journal_file.closed:
+            self.Flush()
+            self.journal_file.close()
+
+    def Remove(self):
+        """
+        Close and delete the journal, e.g. once the upload has completed
+        """
+        self.journal_file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
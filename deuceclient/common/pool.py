@@ -0,0 +1,88 @@
+"""
+HTTP Connection Pool
+"""
+import requests
+import requests.adapters
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP connection pool shared by the REST API objects
+
+    A single instance may be handed to any number of DeuceClient and
+    Authentication objects so that they all reuse the same TCP (and TLS)
+    connections instead of opening a new one for every request.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, keepalive=True,
+                 connect_timeout=10.0, read_timeout=60.0, pool_block=False):
+        """
+        Initialize the Connection Pool
+          pool_connections - number of distinct hosts to cache pools for
+          pool_maxsize - maximum number of connections kept open per host
+          keepalive - True to keep connections open between requests;
+                      otherwise every request closes its connection
+          connect_timeout - seconds to wait for a connection to be
+                            established (None waits forever)
+          read_timeout - seconds to wait for response data
+                         (None waits forever)
+          pool_block - True to wait for a free connection when a host's
+                       pool is exhausted; otherwise an extra connection is
+                       opened and discarded after use
+        """
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not keepalive:
+            self.session.headers['Connection'] = 'close'
+        self.timeout = (connect_timeout, read_timeout)
+
+    @property
+    def Session(self):
+        """Underlying requests.Session"""
+        return self.session
+
+    @property
+    def Timeout(self):
+        """(connect, read) timeout applied to each request"""
+        return self.timeout
+
+    def request(self, method, uri, **kwargs):
+        """
+        Issue an HTTP request over a pooled connection
+          method - HTTP verb
+          uri - full URI of the resource
+          kwargs - passed through to requests.Session.request
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, uri, **kwargs)
+
+    def get(self, uri, **kwargs):
+        """HTTP GET"""
+        return self.request('GET', uri, **kwargs)
+
+    def head(self, uri, **kwargs):
+        """HTTP HEAD"""
+        return self.request('HEAD', uri, **kwargs)
+
+    def put(self, uri, **kwargs):
+        """HTTP PUT"""
+        return self.request('PUT', uri, **kwargs)
+
+    def post(self, uri, **kwargs):
+        """HTTP POST"""
+        return self.request('POST', uri, **kwargs)
+
+    def delete(self, uri, **kwargs):
+        """HTTP DELETE"""
+        return self.request('DELETE', uri, **kwargs)
+
+    def close(self):
+        """
+        Close all pooled connections
+        """
+        self.session.close()
@@ -0,0 +1,236 @@
+"""
+Request Retry Policy and Circuit Breaker
+
+RetryPolicy decides whether and when a failed request is tried again;
+CircuitBreaker stops every caller from hammering a host that keeps
+failing. Neither sends requests itself, so they serve both the threaded
+and the asyncio clients.
+"""
+import calendar
+import email.utils
+import random
+import threading
+import time
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter, bounded by attempts and elapsed time
+
+    Requests that are safe to repeat (idempotent HTTP methods, plus any
+    operation listed as idempotent) are retried on any retryable status or
+    transport failure. Other requests are only retried when the server
+    cannot have acted on them: the connection was never established, or
+    the server refused it with 429 or 503.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE',
+                                    'OPTIONS'])
+    RETRY_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+    NOT_PROCESSED_STATUSES = frozenset([429, 503])
+
+    def __init__(self, max_attempts=5, backoff=0.5, max_backoff=30.0,
+                 max_elapsed=300.0, jitter=True,
+                 retry_statuses=RETRY_STATUSES,
+                 idempotent_operations=('AssignBlocksToFile',),
+                 non_idempotent_operations=()):
+        """
+        Initialize the policy
+          max_attempts - most times a request is sent, including the first;
+                         1 disables retries
+          backoff - base delay in seconds; doubled for every further retry
+          max_backoff - largest delay between two attempts
+          max_elapsed - seconds after the first attempt beyond which no
+                        further attempt is started
+          jitter - True to pick each delay uniformly between 0 and the
+                   backoff so that many clients do not retry in lockstep
+          retry_statuses - HTTP status codes worth retrying
+          idempotent_operations - operations safe to repeat whatever their
+                                  HTTP method
+          non_idempotent_operations - operations never repeated once the
+                                      server may have acted on them
+        """
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_elapsed = max_elapsed
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+        self.idempotent_operations = frozenset(idempotent_operations)
+        self.non_idempotent_operations = frozenset(non_idempotent_operations)
+
+    @property
+    def MaxAttempts(self):
+        """Most times a request is sent"""
+        return self.max_attempts
+
+    def IsIdempotent(self, operation, method):
+        """
+        Return True if the request may safely be sent more than once
+        """
+        if operation in self.idempotent_operations:
+            return True
+        if operation in self.non_idempotent_operations:
+            return False
+        return method in RetryPolicy.IDEMPOTENT_METHODS
+
+    def ShouldRetry(self, operation, method, attempt, status=None,
+                    sent=True):
+        """
+        Return True if a failed attempt should be retried
+          operation - name of the API call
+          method - HTTP verb
+          attempt - number of the attempt that failed, starting at 0
+          status - HTTP status received, or None on a transport failure
+          sent - False if the request never reached the server
+        """
+        if attempt + 1 >= self.max_attempts:
+            return False
+        if status is None:
+            return not sent or self.IsIdempotent(operation, method)
+        if status not in self.retry_statuses:
+            return False
+        return status in RetryPolicy.NOT_PROCESSED_STATUSES or \
+            self.IsIdempotent(operation, method)
+
+    def Delay(self, attempt, retry_after=None):
+        """
+        Return the seconds to wait before retrying a failed attempt
+          attempt - number of the attempt that failed, starting at 0
+          retry_after - seconds the server asked us to wait, if any
+        """
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def WithinDeadline(self, started, delay):
+        """
+        Return True if another attempt may start after waiting delay
+          started - time.time() of the first attempt
+        """
+        return time.time() + delay - started <= self.max_elapsed
+
+    @staticmethod
+    def RetryAfter(headers):
+        """
+        Return the seconds requested by a Retry-After header, or None
+        """
+        value = headers.get('Retry-After')
+        if value is None:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        parsed = email.utils.parsedate(value)
+        if parsed is None:
+            return None
+        return max(0.0, calendar.timegm(parsed) - time.time())
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker
+
+    After failure_threshold consecutive failures against a host its
+    circuit opens and Allow() holds every caller back for reset_timeout
+    seconds. A single probe request is then let through: its success
+    closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 probe_interval=1.0):
+        """
+        Initialize the breaker
+          failure_threshold - consecutive failures that open the circuit
+          reset_timeout - seconds the circuit stays open before a probe
+          probe_interval - seconds other callers are held back while a
+                           probe is in progress
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def __host(self, host):
+        """
+        (internal) State of a host as [state, failures, changed at];
+        the lock must be held
+        """
+        state = self.hosts.get(host)
+        if state is None:
+            state = [CircuitBreaker.CLOSED, 0, 0.0]
+            self.hosts[host] = state
+        return state
+
+    def State(self, host):
+        """
+        Return the state of the circuit of a host
+        """
+        with self.lock:
+            return self.__host(host)[0]
+
+    def Allow(self, host):
+        """
+        Return 0 if a request to host may be sent now; otherwise the
+        seconds to wait before asking again
+        """
+        now = time.time()
+        with self.lock:
+            state = self.__host(host)
+            if state[0] == CircuitBreaker.CLOSED:
+                return 0.0
+            elif state[0] == CircuitBreaker.OPEN:
+                remaining = state[2] + self.reset_timeout - now
+                if remaining > 0:
+                    return remaining
+                state[0] = CircuitBreaker.HALF_OPEN
+                state[2] = now
+                return 0.0
+            else:
+                # A probe that never reports back does not block forever
+                if now - state[2] >= self.reset_timeout:
+                    state[2] = now
+                    return 0.0
+                return min(self.probe_interval, self.reset_timeout)
+
+    def Success(self, host):
+        """
+        Record a request to host that got a response from a healthy server
+        """
+        with self.lock:
+            state = self.__host(host)
+            state[0] = CircuitBreaker.CLOSED
+            state[1] = 0
+
+    def Release(self, host):
+        """
+        Record a request to host that ended without telling anything about
+        the server, e.g. on a local error; if it was the probe, the next
+        caller is let through to probe instead
+        """
+        with self.lock:
+            state = self.__host(host)
+            if state[0] == CircuitBreaker.HALF_OPEN:
+                state[2] = time.time() - self.reset_timeout
+
+    def Failure(self, host):
+        """
+        Record a request to host that failed in transport or with a 5xx
+        """
+        with self.lock:
+            state = self.__host(host)
+            state[1] = state[1] + 1
+            if state[0] == CircuitBreaker.HALF_OPEN or \
+                    state[1] >= self.failure_threshold:
+                state[0] = CircuitBreaker.OPEN
+                state[2] = time.time()
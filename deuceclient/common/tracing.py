@@ -0,0 +1,155 @@
+"""
+Request Tracing and Log Redaction
+
+RequestTracer emits a structured record for a sample of the requests made
+through DeuceClient and Authentication. Records are plain dictionaries
+logged on the 'deuceclient.trace' logger; start_queue_logging() hands
+them (or any other log records) to a background thread, so the threads
+issuing requests never format a record or wait on a disk write.
+"""
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+from deuceclient.common.instrumentation import Instrumentation
+
+
+REDACTED_HEADERS = frozenset(['x-auth-token', 'authorization'])
+
+
+def redact_headers(headers):
+    """
+    Return a copy of headers safe to log: credentials are replaced by a
+    short fingerprint that still tells different tokens apart
+    """
+    return dict((key, token_fingerprint(value)
+                 if key.lower() in REDACTED_HEADERS else value)
+                for key, value in headers.items())
+
+
+def token_fingerprint(token):
+    """
+    Return a loggable stand-in for a secret
+    """
+    if not token:
+        return token
+    return '<redacted:{0:}>'.format(
+        hashlib.sha1(token.encode('utf-8')).hexdigest()[:8])
+
+
+def body_summary(body):
+    """
+    Describe a request body for logging without including its content
+    """
+    if body is None:
+        return None
+    try:
+        return '<{0:} bytes>'.format(len(body))
+    except TypeError:
+        return '<streamed>'
+
+
+class RequestTracer(Instrumentation):
+    """
+    Log a structured record for a random sample of requests
+
+    Nothing is measured for requests that are not sampled, or at all while
+    the trace logger is disabled.
+    """
+
+    def __init__(self, sample_rate=1.0, logger=None):
+        """
+        Initialize the tracer
+          sample_rate - fraction of requests traced, from 0.0 to 1.0
+          logger - logger receiving the records; defaults to
+                   'deuceclient.trace'. Records are logged at INFO with the
+                   dictionary as the message
+        """
+        if logger is None:
+            logger = logging.getLogger('deuceclient.trace')
+        self.log = logger
+        self.sample_rate = sample_rate
+
+    def __sampled(self):
+        """
+        (internal) Decide whether to trace the next request
+        """
+        return self.log.isEnabledFor(logging.INFO) and \
+            (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def RequestStarted(self, operation):
+        if not self.__sampled():
+            return None
+        return (time.time(), time.perf_counter())
+
+    def RequestFinished(self, operation, started, status, bytes_sent,
+                        bytes_received):
+        if started is None:
+            return
+        timestamp, counter = started
+        self.log.info({
+            'event': 'request',
+            'time': timestamp,
+            'operation': operation,
+            'status': status,
+            'duration': time.perf_counter() - counter,
+            'bytes_sent': bytes_sent,
+            'bytes_received': bytes_received,
+            'thread': threading.current_thread().name
+        })
+
+    def RequestRetried(self, operation):
+        if not self.__sampled():
+            return
+        self.log.info({
+            'event': 'retry',
+            'time': time.time(),
+            'operation': operation,
+            'thread': threading.current_thread().name
+        })
+
+
+class TraceFormatter(logging.Formatter):
+    """
+    Format dictionary messages as one JSON object per line and any other
+    message as usual
+    """
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            return json.dumps(record.msg, sort_keys=True)
+        return super(TraceFormatter, self).format(record)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler leaving all formatting to the listener thread
+
+    The stock handler formats each record before queueing it, which is
+    only needed when the queue crosses a process boundary.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def start_queue_logging(logger, handler):
+    """
+    Deliver the records of logger to handler from a background thread
+      logger - logging.Logger whose records are queued
+      handler - logging.Handler doing the formatting and writing
+
+    Returns the logging.handlers.QueueListener; call its stop() method at
+    exit to write out the records still queued
+    """
+    records = queue.Queue()
+    logger.addHandler(_DeferredQueueHandler(records))
+    listener = logging.handlers.QueueListener(records, handler,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
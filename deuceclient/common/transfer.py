@@ -0,0 +1,162 @@
+"""
+Parallel Transfer Support
+"""
+import os
+import threading
+import time
+
+
+class InflightLimiter(object):
+    """
+    Bound the number of bytes handed to transfer workers at any one time
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Initialize the limiter
+          max_bytes - most bytes allowed in flight; a single item larger
+                      than this is still admitted once nothing else is
+                      in flight
+        """
+        if max_bytes <= 0:
+            raise ValueError('max_bytes must be positive')
+        self.max_bytes = max_bytes
+        self.inflight = 0
+        self.condition = threading.Condition()
+
+    @property
+    def InflightBytes(self):
+        """Bytes currently in flight"""
+        return self.inflight
+
+    def Acquire(self, size):
+        """
+        Block until size more bytes may be put in flight
+        """
+        with self.condition:
+            while self.inflight and self.inflight + size > self.max_bytes:
+                self.condition.wait()
+            self.inflight = self.inflight + size
+
+    def Release(self, size):
+        """
+        Return size bytes previously acquired
+        """
+        with self.condition:
+            self.inflight = self.inflight - size
+            self.condition.notify_all()
+
+
+class PositionalWriter(object):
+    """
+    File-like writer placing data at a fixed offset of a file descriptor
+
+    Several writers may share one descriptor from different threads; each
+    write lands at its own position regardless of the others.
+    """
+
+    def __init__(self, fd, offset, lock=None):
+        """
+        Initialize the writer
+          fd - file descriptor opened for writing
+          offset - position of the first byte written
+          lock - lock shared by all writers of fd; only used on platforms
+                 without os.pwrite, where writes need a seek
+        """
+        self.fd = fd
+        self.offset = offset
+        if lock is None:
+            lock = threading.Lock()
+        self.lock = lock
+
+    @property
+    def Offset(self):
+        """Position the next write lands at"""
+        return self.offset
+
+    def write(self, data):
+        """
+        Write data at the current position and advance past it
+        """
+        view = memoryview(data)
+        while len(view):
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.fd, view, self.offset)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, self.offset, os.SEEK_SET)
+                    written = os.write(self.fd, view)
+            self.offset = self.offset + written
+            view = view[written:]
+        return len(data)
+
+
+class TransferResults(object):
+    """
+    Per-block outcome of a parallel transfer
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.completed = []
+        self.errors = {}
+        self.bytes_transferred = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def Success(self, blockid, size):
+        """
+        Record a block that was transferred
+        """
+        with self.lock:
+            self.completed.append(blockid)
+            self.bytes_transferred = self.bytes_transferred + size
+
+    def Failure(self, blockid, error):
+        """
+        Record the exception a block failed with
+        """
+        with self.lock:
+            self.errors[blockid] = error
+
+    def Finish(self):
+        """
+        Mark the transfer as finished
+        """
+        self.end_time = time.time()
+
+    @property
+    def Completed(self):
+        """Ids of the blocks that were transferred"""
+        return self.completed
+
+    @property
+    def Errors(self):
+        """Dictionary of block id to the exception it failed with"""
+        return self.errors
+
+    @property
+    def Succeeded(self):
+        """True if every block was transferred"""
+        return not self.errors
+
+    @property
+    def BytesTransferred(self):
+        """Total bytes successfully transferred"""
+        return self.bytes_transferred
+
+    @property
+    def Elapsed(self):
+        """Seconds the transfer took (so far)"""
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.time()
+        return end_time - self.start_time
+
+    @property
+    def Throughput(self):
+        """Bytes per second successfully transferred"""
+        elapsed = self.Elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes_transferred / elapsed
@@ -4,21 +4,43 @@ Ben's Deuce Testing Client
 """
 from __future__ import print_function
 import argparse
+import concurrent.futures
+import hashlib
 import json
 import logging
+import logging.config
+import os
 import pprint
 import sys
-
-import deuceclient.deuce
+import threading
+import time
+
+import deuceclient.auth.auth
+from deuceclient.auth.tokencache import TokenCache
+import deuceclient.client.deuce
+from deuceclient.common.blockcache import BlockCache
+from deuceclient.common.blockindex import BlockIndex
+from deuceclient.common.chunker import ContentDefinedChunker
+from deuceclient.common.chunker import FixedSizeChunker
+from deuceclient.common.instrumentation import InstrumentationGroup
+from deuceclient.common.instrumentation import MetricsRecorder
+from deuceclient.common.pool import ConnectionPool
+from deuceclient.common.tracing import RequestTracer, TraceFormatter, \
+    start_queue_logging
+from deuceclient.common.transfer import TransferResults
 
 
 class ProgramArgumentError(ValueError):
     pass
 
 
-def __api_operation_prep(log, arguments):
+def __api_operation_prep(log, arguments, instrumentation=None,
+                         pool_size=10):
     """
     API Operation Common Functionality
+      instrumentation - optional Instrumentation for the Deuce client
+      pool_size - connections kept open to each host; at least the number
+                  of requests issued in parallel
     """
     # Parse the user data
     example_user_config_json = "{\n    'user': <username>," \
@@ -36,16 +58,46 @@ def __api_operation_prep(log, arguments):
             example_user_config_json))
         sys.exit(-2)
 
+    # Trace the requests of both Identity and Deuce when asked to
+    if arguments.tracer is not None:
+        instrumentation = InstrumentationGroup(instrumentation,
+                                               arguments.tracer)
+
+    # Identity and Deuce share one set of keep-alive connections
+    pool = ConnectionPool(pool_maxsize=max(pool_size, 10))
+
+    # Share tokens between invocations unless asked not to
+    token_cache = None
+    if not arguments.no_token_cache:
+        token_cache = TokenCache(arguments.token_cache)
+
     # Setup the Authentication
     datacenter = arguments.datacenter
-    auth_engine = rcbu.client.auth.Authentication(user_data['user'],
-                                                  user_data['apikey'],
-                                                  usertype='user',
-                                                  datacenter=datacenter)
+    auth_engine = deuceclient.auth.auth.Authentication(user_data['user'],
+                                                       user_data['apikey'],
+                                                       usertype='user',
+                                                       datacenter=datacenter,
+                                                       pool=pool,
+                                                       token_cache=token_cache,
+                                                       instrumentation=(
+                                                           arguments.tracer))
     uri = arguments.url
+    # Several servers sharing the same storage may be given at once
+    hosts = [host.strip() for host in uri.split(',') if host.strip()]
+    if len(hosts) > 1:
+        uri = hosts
+
+    # Optional local cache of downloaded block data
+    block_cache = None
+    if arguments.block_cache is not None:
+        block_cache = BlockCache(
+            disk_path=arguments.block_cache,
+            disk_bytes=arguments.block_cache_mb * 1024 * 1024)
 
     # Setup Agent Access
-    deuce = rcbu.client.deuce.DeuceClient(False, auth_engine, uri)
+    deuce = deuceclient.client.deuce.DeuceClient(
+        False, auth_engine, uri, pool=pool, block_index=arguments.index,
+        block_cache=block_cache, instrumentation=instrumentation)
 
     return (auth_engine, deuce, uri)
 
@@ -111,11 +163,36 @@ def block_upload(log, arguments):
     """
     auth_engine, deuceclient, api_url = __api_operation_prep(log, arguments)
 
-    block_list = deuceclient.UploadBlock(arguments.vault_name,
-                                         arguments.blockid,
-                                         arguments.blockcontent)
-    print('Block List:')
-    pprint.pprint(block_list)
+    blockcontent = arguments.blockcontent.read()
+    blockid = arguments.blockid
+    if blockid is None:
+        blockid = hashlib.sha1(blockcontent).hexdigest()
+
+    deuceclient.UploadBlock(arguments.vault_name, blockid, blockcontent)
+    print('Uploaded block {0:}'.format(blockid))
+
+
+def block_index_sync(log, arguments):
+    """
+    Rebuild the local block index of a vault from the server
+    """
+    auth_engine, deuceclient, api_url = __api_operation_prep(log, arguments)
+
+    count = deuceclient.SyncBlockIndex(arguments.vault_name)
+    print('Indexed {0:} blocks in vault {1:}'.format(count,
+                                                    arguments.vault_name))
+
+
+def block_index_invalidate(log, arguments):
+    """
+    Drop the local block index entries of a vault
+    """
+    if arguments.index is None:
+        raise ProgramArgumentError('--block-index is required')
+
+    arguments.index.Invalidate(arguments.vault_name)
+    print('Invalidated block index for vault {0:}'.format(
+        arguments.vault_name))
 
 
 def file_create(log, arguments):
@@ -131,17 +208,218 @@ def file_create(log, arguments):
 def file_assign_blocks(log, arguments):
     """
     Assign blocks to a file
-    NEED to check the way value is passed in the command line,
-    right now it does not accept it.
     """
     auth_engine, deuceclient, api_url = __api_operation_prep(log, arguments)
 
-    result = deuceclient.AssignBlocksToFile(arguments.vaultname,
+    result = deuceclient.AssignBlocksToFile(arguments.vault_name,
                                             arguments.fileid,
                                             arguments.value)
     print(result)
 
 
+def __throughput(size, elapsed):
+    """
+    Format a transfer rate
+    """
+    return '{0:.2f} MB/s'.format(size / max(elapsed, 1e-9) / (1024 * 1024))
+
+
+def __chunker(arguments):
+    """
+    Build the chunker selected on the command line
+    """
+    if arguments.fixed_blocks:
+        return FixedSizeChunker(arguments.block_size)
+    if arguments.block_size & (arguments.block_size - 1):
+        raise ProgramArgumentError('--block-size must be a power of two '
+                                   'unless --fixed-blocks is given')
+    return ContentDefinedChunker(min_size=arguments.block_size // 4,
+                                 avg_size=arguments.block_size,
+                                 max_size=arguments.block_size * 4)
+
+
+def file_upload(log, arguments):
+    """
+    Upload a local file, only sending the blocks the vault does not have
+    """
+    metrics = MetricsRecorder()
+    auth_engine, deuceclient, api_url = __api_operation_prep(
+        log, arguments, instrumentation=metrics,
+        pool_size=arguments.concurrency)
+
+    size = os.path.getsize(arguments.path)
+    start = time.time()
+    fileid = deuceclient.UploadFile(
+        arguments.vault_name, arguments.path,
+        chunker=__chunker(arguments),
+        concurrency=arguments.concurrency,
+        max_inflight_bytes=arguments.max_inflight_mb * 1024 * 1024,
+        journal_path=arguments.journal)
+    elapsed = time.time() - start
+
+    sent = metrics.Snapshot().get('UploadBlock', {}).get('bytes_sent', 0)
+    print('Uploaded {0:} as file {1:}'.format(arguments.path, fileid))
+    print('{0:} bytes in {1:.2f}s ({2:}); {3:} bytes of new blocks '
+          'sent'.format(size, elapsed, __throughput(size, elapsed), sent))
+
+
+def file_download(log, arguments):
+    """
+    Download a file from the vault into a local file
+    """
+    auth_engine, deuceclient, api_url = __api_operation_prep(
+        log, arguments, pool_size=arguments.concurrency)
+
+    results = deuceclient.DownloadFile(arguments.vault_name,
+                                       arguments.fileid,
+                                       arguments.destination,
+                                       concurrency=arguments.concurrency)
+    if not results.Succeeded:
+        for blockid, error in results.Errors.items():
+            print('Block {0:} failed: {1:}'.format(blockid, error),
+                  file=sys.stderr)
+        return 1
+
+    print('Downloaded file {0:} to {1:}'.format(arguments.fileid,
+                                                arguments.destination))
+    print('{0:} bytes in {1:.2f}s ({2:})'.format(
+        results.BytesTransferred, results.Elapsed,
+        __throughput(results.BytesTransferred, results.Elapsed)))
+
+
+# DeuceClient calls a batch manifest may name
+BATCH_OPERATIONS = frozenset([
+    'CreateVault', 'DeleteVault', 'VaultExists', 'GetVaultStatistics',
+    'GetBlockList', 'DeleteBlock', 'CreateFile', 'AssignBlocksToFile',
+    'FinalizeFile', 'GetFileBlockList', 'UploadFile', 'DownloadFile'
+])
+
+
+def __batch_result(value):
+    """
+    Convert the return value of a call to something JSON can encode
+    """
+    if isinstance(value, TransferResults):
+        return {
+            'succeeded': value.Succeeded,
+            'bytes': value.BytesTransferred,
+            'seconds': value.Elapsed,
+            'errors': dict((blockid, str(error))
+                           for blockid, error in value.Errors.items())
+        }
+    return value
+
+
+def __batch_barrier(line):
+    """
+    Return the manifest entry if it is a barrier; otherwise None
+    """
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(entry, dict) and entry.get('op') == 'Barrier':
+        return entry
+    return None
+
+
+def __batch_operation(deuceclient, number, line):
+    """
+    Run a single manifest entry and return its result record
+    """
+    record = {'line': number}
+    start = time.time()
+    try:
+        entry = json.loads(line)
+        if not isinstance(entry, dict):
+            raise ProgramArgumentError('Entry must be a JSON object')
+        record['id'] = entry.get('id')
+        record['op'] = entry.get('op')
+        if entry.get('op') not in BATCH_OPERATIONS:
+            raise ProgramArgumentError(
+                'Unknown operation {0:}'.format(entry.get('op')))
+        result = getattr(deuceclient, entry['op'])(**entry.get('args', {}))
+        if isinstance(result, TransferResults) and not result.Succeeded:
+            record['ok'] = False
+            record['error'] = '{0:} blocks failed'.format(
+                len(result.Errors))
+        else:
+            record['ok'] = True
+        record['result'] = __batch_result(result)
+    except Exception as ex:
+        record['ok'] = False
+        record['error'] = str(ex)
+        record['error_type'] = type(ex).__name__
+        if getattr(ex, 'status', None) is not None:
+            record['status'] = ex.status
+    record['seconds'] = time.time() - start
+    return record
+
+
+def batch_run(log, arguments):
+    """
+    Run the operations of a JSONL manifest over a single client
+
+    Each line of the manifest is an object such as
+        {"id": "a1", "op": "CreateVault", "args": {"vaultname": "v1"}}
+    naming a DeuceClient call and its keyword arguments. A JSON result is
+    written per line as its operation completes.
+
+    Operations start in manifest order, but with --parallel above 1 up to
+    that many run at once, so an operation may start before an earlier
+    one has finished, and their results are written as they complete. A
+    line {"op": "Barrier"} waits for every earlier operation to finish
+    before any later one starts, e.g. between creating vaults and
+    uploading files into them.
+    """
+    auth_engine, deuceclient, api_url = __api_operation_prep(
+        log, arguments, pool_size=arguments.parallel)
+
+    output = arguments.output
+    output_lock = threading.Lock()
+    failures = [0]
+
+    # Bound the manifest entries read ahead of the workers
+    read_ahead = arguments.parallel * 2
+    slots = threading.Semaphore(read_ahead)
+
+    def run(number, line):
+        try:
+            record = __batch_operation(deuceclient, number, line)
+            with output_lock:
+                if not record['ok']:
+                    failures[0] += 1
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+        finally:
+            slots.release()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=arguments.parallel) as executor:
+        for number, line in enumerate(arguments.manifest, 1):
+            if not line.strip():
+                continue
+            barrier = __batch_barrier(line)
+            if barrier is not None:
+                # Every slot is back once all earlier entries are done
+                for slot in range(read_ahead):
+                    slots.acquire()
+                for slot in range(read_ahead):
+                    slots.release()
+                with output_lock:
+                    output.write(json.dumps({'line': number,
+                                             'id': barrier.get('id'),
+                                             'op': 'Barrier',
+                                             'ok': True}) + '\n')
+                    output.flush()
+                continue
+            slots.acquire()
+            executor.submit(run, number, line)
+
+    if failures[0]:
+        return 1
+
+
 def main():
     arg_parser = argparse.ArgumentParser(
         description="Cloud Backup Agent Status")
@@ -154,13 +432,36 @@ def main():
                             default='127.0.0.1:8080',
                             type=str,
                             required=False,
-                            help="Network Address for the Deuce Server."
+                            help="Network Address for the Deuce Server, or "
+                                 "a comma separated list of servers to "
+                                 "balance the requests over."
                                  " Default: 127.0.0.1:8080")
     arg_parser.add_argument('-lg', '--log-config',
                             default=None,
                             type=str,
                             dest='logconfig',
                             help='log configuration file')
+    arg_parser.add_argument('--log-level',
+                            default='WARNING',
+                            type=str.upper,
+                            dest='log_level',
+                            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                            help='Level of the messages written to '
+                                 '.deuce_client-py.log when no log '
+                                 'configuration is given. Default: WARNING')
+    arg_parser.add_argument('--trace',
+                            default=None,
+                            type=str,
+                            dest='trace',
+                            required=False,
+                            help='File receiving a JSON record per request')
+    arg_parser.add_argument('--trace-sample',
+                            default=1.0,
+                            type=float,
+                            dest='trace_sample',
+                            required=False,
+                            help='Fraction of the requests traced. '
+                                 'Default: 1.0')
     arg_parser.add_argument('-dc', '--datacenter',
                             default='ord',
                             type=str,
@@ -168,6 +469,38 @@ def main():
                             required=True,
                             help='Datacenter the system is in',
                             choices=['lon', 'syd', 'hkg', 'ord', 'iad', 'dfw'])
+    arg_parser.add_argument('--block-index',
+                            default=None,
+                            type=str,
+                            dest='block_index',
+                            required=False,
+                            help='Local block index file used to skip '
+                                 'uploading blocks already in the vault')
+    arg_parser.add_argument('--block-cache',
+                            default=None,
+                            type=str,
+                            dest='block_cache',
+                            required=False,
+                            help='Directory caching downloaded blocks')
+    arg_parser.add_argument('--block-cache-mb',
+                            default=1024,
+                            type=int,
+                            dest='block_cache_mb',
+                            required=False,
+                            help='Most MB of blocks kept in the block cache.'
+                                 ' Default: 1024')
+    arg_parser.add_argument('--token-cache',
+                            default=None,
+                            type=str,
+                            dest='token_cache',
+                            required=False,
+                            help='File caching authentication tokens between '
+                                 'runs. Default: ~/.deuceclient/tokens.json')
+    arg_parser.add_argument('--no-token-cache',
+                            default=False,
+                            action='store_true',
+                            dest='no_token_cache',
+                            help='Always authenticate against identity')
     sub_argument_parser = arg_parser.add_subparsers(title='subcommands')
 
     vault_parser = sub_argument_parser.add_parser('vault')
@@ -216,16 +549,25 @@ def main():
     block_upload_parser = block_subparsers.add_parser('upload')
     block_upload_parser.add_argument('--blockid',
                                      default=None,
-                                     required=True,
+                                     required=False,
                                      type=str,
-                                     help="sha1 of the block to be uploaded.")
+                                     help="sha1 of the block to be uploaded."
+                                          " Computed from the content when"
+                                          " not given.")
     block_upload_parser.add_argument('--blockcontent',
                                      default=None,
                                      required=True,
-                                     type=argparse.FileType('r'),
+                                     type=argparse.FileType('rb'),
                                      help="The block to be uploaded")
     block_upload_parser.set_defaults(func=block_upload)
 
+    block_index_sync_parser = block_subparsers.add_parser('index-sync')
+    block_index_sync_parser.set_defaults(func=block_index_sync)
+
+    block_index_invalidate_parser = block_subparsers.add_parser(
+        'index-invalidate')
+    block_index_invalidate_parser.set_defaults(func=block_index_invalidate)
+
     file_parser = sub_argument_parser.add_parser('files')
     file_parser.add_argument('--vault-name',
                              default=None,
@@ -246,29 +588,130 @@ def main():
     file_assign_parser.add_argument('--value',
                                     default=None,
                                     required=True,
-                                    type=dict,
-                                    help="Value passed in as a dict "
-                                         "with offset and size")
+                                    type=json.loads,
+                                    help="JSON object of the blocks, e.g. "
+                                         "'{\"blocks\": [{\"id\": ..., "
+                                         "\"size\": ..., \"offset\": ...}]}'")
     file_assign_parser.set_defaults(func=file_assign_blocks)
+
+    file_upload_parser = file_subparsers.add_parser('upload')
+    file_upload_parser.add_argument('path',
+                                    type=str,
+                                    help="Local file to upload")
+    file_upload_parser.add_argument('--block-size',
+                                    default=1024 * 1024,
+                                    type=int,
+                                    dest='block_size',
+                                    help="Average block size in bytes; a "
+                                         "power of two. Default: 1048576")
+    file_upload_parser.add_argument('--fixed-blocks',
+                                    default=False,
+                                    action='store_true',
+                                    dest='fixed_blocks',
+                                    help="Cut blocks of exactly --block-size "
+                                         "bytes instead of on content-defined "
+                                         "boundaries")
+    file_upload_parser.add_argument('--journal',
+                                    default=None,
+                                    type=str,
+                                    dest='journal',
+                                    help="Journal file; an interrupted upload "
+                                         "of the same file resumes from it")
+    file_upload_parser.set_defaults(func=file_upload)
+
+    file_download_parser = file_subparsers.add_parser('download')
+    file_download_parser.add_argument('fileid',
+                                      type=str,
+                                      help="File to download")
+    file_download_parser.add_argument('destination',
+                                      type=str,
+                                      help="Local file to write")
+    file_download_parser.set_defaults(func=file_download)
+
+    for transfer_parser in (file_upload_parser, file_download_parser):
+        transfer_parser.add_argument('--concurrency',
+                                     default=8,
+                                     type=int,
+                                     dest='concurrency',
+                                     help="Blocks transferred in parallel. "
+                                          "Default: 8")
+    file_upload_parser.add_argument('--max-inflight-mb',
+                                    default=64,
+                                    type=int,
+                                    dest='max_inflight_mb',
+                                    help="Most MB of block data held in "
+                                         "memory at once. Default: 64")
+
+    batch_parser = sub_argument_parser.add_parser(
+        'batch', help='Run many operations from a JSONL manifest')
+    batch_parser.add_argument('manifest',
+                              nargs='?',
+                              default=sys.stdin,
+                              type=argparse.FileType('r'),
+                              help="JSONL manifest of operations. "
+                                   "Default: stdin")
+    batch_parser.add_argument('--parallel',
+                              default=1,
+                              type=int,
+                              dest='parallel',
+                              help="Operations run at the same time; above "
+                                   "1 an operation may start before earlier "
+                                   "ones finish unless a Barrier entry "
+                                   "separates them. Default: 1")
+    batch_parser.add_argument('--output',
+                              default=sys.stdout,
+                              type=argparse.FileType('w'),
+                              dest='output',
+                              help="File the JSONL results are written to. "
+                                   "Default: stdout")
+    batch_parser.set_defaults(func=batch_run)
     arguments = arg_parser.parse_args()
 
     # If the caller provides a log configuration then use it
-    # Otherwise we'll add our own little configuration as a default
-    # That captures stdout and outputs to output/integration-slave-server.out
+    # Otherwise we'll add our own little configuration as a default;
+    # records are written from a background thread so that logging never
+    # stalls the threads doing the transfers
+    listeners = []
     if arguments.logconfig is not None:
         logging.config.fileConfig(arguments.logconfig)
     else:
-        lf = logging.FileHandler('.deuce_client-py.log')
-        lf.setLevel(logging.DEBUG)
+        lf = logging.FileHandler('.deuce_client-py.log', delay=True)
+        lf.setFormatter(logging.Formatter(
+            '%(asctime)s %(threadName)s %(name)s %(levelname)s '
+            '%(message)s'))
 
         log = logging.getLogger()
-        log.addHandler(lf)
-        log.setLevel(logging.DEBUG)
+        log.setLevel(getattr(logging, arguments.log_level))
+        listeners.append(start_queue_logging(log, lf))
+
+    arguments.tracer = None
+    if arguments.trace is not None:
+        tf = logging.FileHandler(arguments.trace)
+        tf.setFormatter(TraceFormatter())
+
+        trace_log = logging.getLogger('deuceclient.trace')
+        trace_log.setLevel(logging.INFO)
+        trace_log.propagate = False
+        listeners.append(start_queue_logging(trace_log, tf))
+        arguments.tracer = RequestTracer(sample_rate=arguments.trace_sample,
+                                         logger=trace_log)
+
+    # Optional local index of the blocks already in each vault; it batches
+    # its commits, so it must be closed for the last ones to be kept
+    arguments.index = None
+    if arguments.block_index is not None:
+        arguments.index = BlockIndex(arguments.block_index)
 
     # Build the logger
     log = logging.getLogger()
 
-    arguments.func(log, arguments)
+    try:
+        return arguments.func(log, arguments)
+    finally:
+        if arguments.index is not None:
+            arguments.index.Close()
+        for listener in listeners:
+            listener.stop()
 
 
 if __name__ == "__main__":
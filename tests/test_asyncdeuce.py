@@ -0,0 +1,197 @@
+"""
+Tests for deuceclient.client.asyncdeuce against the fake Deuce server
+"""
+import asyncio
+import hashlib
+import threading
+import time
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client import asyncdeuce
+from deuceclient.client.deuce import DeuceClientError, DeuceNotFoundError
+from deuceclient.client.deuce import DeuceServerError
+from deuceclient.common.retry import CircuitBreaker, RetryPolicy
+
+
+class FlakyDeuceServer(FakeDeuceServer):
+    """
+    Fake server answering the first requests for a block with a 503
+    """
+
+    def __init__(self):
+        super(FlakyDeuceServer, self).__init__()
+        self.failures = 0
+
+    def get_block(self, vault, block, query, body):
+        with self.lock:
+            if self.failures:
+                self.failures = self.failures - 1
+                return 503, {'Retry-After': '0'}, b'Try again'
+        return super(FlakyDeuceServer, self).get_block(vault, block, query,
+                                                       body)
+
+
+class ExpiringAuthenticator(StaticAuthenticator):
+    """
+    Authenticator whose token can be expired; renewing it blocks
+    """
+
+    def __init__(self, renewal_time):
+        super(ExpiringAuthenticator, self).__init__()
+        self.renewal_time = renewal_time
+        self.renewals = 0
+        self.expired = False
+        self.token_lock = threading.Lock()
+
+    def IsExpired(self, fuzz=0):
+        return self.expired
+
+    @property
+    def AuthToken(self):
+        with self.token_lock:
+            if self.expired:
+                time.sleep(self.renewal_time)
+                self.renewals = self.renewals + 1
+                self.expired = False
+            return 'fake-token'
+
+    @AuthToken.setter
+    def AuthToken(self, token):
+        pass
+
+
+def block(data):
+    return (hashlib.sha1(data).hexdigest(), 0, len(data), data)
+
+
+@unittest.skipIf(asyncdeuce.aiohttp is None, 'aiohttp is not installed')
+class AsyncDeuceClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FlakyDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        self.server.failures = 0
+
+    def run_client(self, test, authenticator=None, **kwargs):
+        """
+        Run test(client) on a fresh loop
+        """
+        async def run():
+            async with asyncdeuce.AsyncDeuceClient(
+                    False, authenticator or StaticAuthenticator(),
+                    self.server.ApiHost, **kwargs) as client:
+                return await test(client)
+        return asyncio.run(run())
+
+    def test_vaults(self):
+        async def test(client):
+            self.assertFalse(await client.VaultExists('vault'))
+            self.assertTrue(await client.CreateVault('vault'))
+            self.assertTrue(await client.VaultExists('vault'))
+            self.assertTrue(await client.DeleteVault('vault'))
+            with self.assertRaises(DeuceNotFoundError):
+                await client.DeleteVault('vault')
+        self.run_client(test)
+
+    def test_blocks(self):
+        blocks = [block(str(i).encode('utf-8') * 100) for i in range(20)]
+
+        async def test(client):
+            await client.CreateVault('vault')
+            results = await client.UploadBlocks('vault', iter(blocks))
+            self.assertEqual(sorted(results.Completed),
+                             sorted(entry[0] for entry in blocks))
+            self.assertEqual(results.Errors, {})
+
+            self.assertEqual(await client.GetBlockList('vault'),
+                             sorted(entry[0] for entry in blocks))
+            self.assertEqual(len(await client.GetBlockList('vault',
+                                                           limit=5)), 5)
+            self.assertEqual(await client.GetBlockData('vault',
+                                                       blocks[3][0]),
+                             blocks[3][3])
+            statistics = await client.GetVaultStatistics('vault')
+            self.assertEqual(statistics['blocks']['count'], 20)
+
+            self.assertTrue(await client.DeleteBlock('vault', blocks[3][0]))
+            with self.assertRaises(DeuceNotFoundError):
+                await client.GetBlockData('vault', blocks[3][0])
+            with self.assertRaises(DeuceClientError):
+                await client.UploadBlock('vault', blocks[0][0], b'wrong')
+        self.run_client(test, max_concurrency=4)
+
+    def test_files(self):
+        data = block(b'file data')
+
+        async def test(client):
+            await client.CreateVault('vault')
+            location = await client.CreateFile('vault')
+            fileid = location.rsplit('/', 1)[1]
+            value = {'blocks': [{'id': data[0], 'size': data[2],
+                                 'offset': 0}]}
+            self.assertEqual(
+                await client.AssignBlocksToFile('vault', fileid, value),
+                [data[0]])
+            await client.UploadBlock('vault', data[0], data[3])
+            self.assertEqual(
+                await client.AssignBlocksToFile('vault', fileid, value), [])
+            self.assertTrue(await client.FinalizeFile('vault', fileid))
+            self.assertEqual(await client.GetFileBlockList('vault', fileid),
+                             [[data[0], 0]])
+        self.run_client(test)
+
+    def test_retry(self):
+        data = block(b'retried')
+
+        async def test(client):
+            await client.CreateVault('vault')
+            await client.UploadBlock('vault', data[0], data[3])
+            self.server.failures = 2
+            self.assertEqual(await client.GetBlockData('vault', data[0]),
+                             data[3])
+            self.assertEqual(self.server.failures, 0)
+
+            self.server.failures = 5
+            with self.assertRaises(DeuceServerError):
+                await client.GetBlockData('vault', data[0])
+        self.run_client(test,
+                        retry_policy=RetryPolicy(max_attempts=3,
+                                                 backoff=0.01,
+                                                 jitter=False),
+                        circuit_breaker=CircuitBreaker(failure_threshold=10))
+
+    def test_token_renewal_does_not_block_loop(self):
+        authenticator = ExpiringAuthenticator(renewal_time=0.3)
+        gaps = []
+
+        async def ticker(done):
+            last = time.time()
+            while not done.is_set():
+                await asyncio.sleep(0.01)
+                now = time.time()
+                gaps.append(now - last)
+                last = now
+
+        async def test(client):
+            await client.CreateVault('vault')
+            done = asyncio.Event()
+            tick = asyncio.ensure_future(ticker(done))
+            authenticator.expired = True
+            await asyncio.gather(*[client.GetBlockList('vault')
+                                   for i in range(8)])
+            done.set()
+            await tick
+        self.run_client(test, authenticator=authenticator)
+
+        # One renewal shared by every waiting request
+        self.assertEqual(authenticator.renewals, 1)
+        self.assertTrue(max(gaps) < 0.2)
@@ -0,0 +1,256 @@
+"""
+Tests for deuceclient.auth.auth against a fake identity service
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from deuceclient.auth.auth import Authentication, AuthCredentialsErrors
+from deuceclient.auth.auth import AuthenticationError
+from deuceclient.auth.tokencache import TokenCache
+
+CATALOG = [
+    {
+        'name': 'cloudFiles',
+        'endpoints': [
+            {'region': 'DFW', 'tenantId': 'MossoCloudFS_1',
+             'publicURL': 'https://dfw.example.com/1',
+             'internalURL': 'https://snet-dfw.example.com/1'},
+            {'region': 'ORD', 'tenantId': 'MossoCloudFS_1',
+             'publicURL': 'https://ord.example.com/1',
+             'internalURL': 'https://snet-ord.example.com/1'},
+            {'region': 'DFW', 'tenantId': 'MossoCloudFS_1',
+             'publicURL': 'https://dfw2.example.com/1',
+             'internalURL': 'https://snet-dfw2.example.com/1'}
+        ]
+    },
+    {
+        'name': 'cloudServers',
+        'endpoints': [
+            {'region': 'IAD', 'publicURL': 'https://iad.example.com/1'}
+        ]
+    }
+]
+
+
+class IdentityHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, data = self.server.identity.Respond()
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeIdentity(object):
+    """
+    Identity service issuing a new token for every request
+      lifetime - seconds the tokens are valid for
+      delay - seconds taken to answer
+      status - HTTP status to answer with
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.lifetime = 3600
+        self.delay = 0.0
+        self.status = 200
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), IdentityHandler)
+        self.httpd.identity = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def ApiHost(self):
+        return '{0:}:{1:}'.format(*self.httpd.server_address[:2])
+
+    def Stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def Respond(self):
+        with self.lock:
+            self.requests = self.requests + 1
+            token = 'token-{0:}'.format(self.requests)
+        time.sleep(self.delay)
+        if self.status != 200:
+            return self.status, {'unauthorized': {'code': self.status}}
+        expires = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                time.gmtime(time.time() + self.lifetime))
+        return 200, {
+            'access': {
+                'token': {
+                    'id': token,
+                    'expires': expires,
+                    'tenant': {'id': '1'}
+                },
+                'serviceCatalog': CATALOG
+            }
+        }
+
+
+class IdentityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.identity = FakeIdentity()
+
+    def tearDown(self):
+        self.identity.Stop()
+
+    def authenticator(self, **kwargs):
+        """
+        Authentication pointed at the fake identity service
+        """
+        auth = Authentication('user', 'apikey', **kwargs)
+        auth.apihost = self.identity.ApiHost
+        auth.sslenabled = False
+        return auth
+
+
+class ServiceCatalogTest(IdentityTestCase):
+
+    def test_catalog(self):
+        auth = self.authenticator()
+        self.assertEqual(auth.AuthToken, 'token-1')
+        self.assertEqual(auth.AuthTenantId, '1')
+        self.assertEqual(auth.MossoId, 'MossoCloudFS_1')
+        # One data center per endpoint, in catalog order
+        self.assertEqual(auth.GetCloudFilesDataCenters(),
+                         ['DFW', 'ORD', 'DFW'])
+        self.assertEqual(auth.GetCloudFilesUri('DFW'),
+                         [{'name': 'public',
+                           'uri': 'https://dfw.example.com/1'},
+                          {'name': 'snet',
+                           'uri': 'https://snet-dfw.example.com/1'},
+                          {'name': 'public',
+                           'uri': 'https://dfw2.example.com/1'},
+                          {'name': 'snet',
+                           'uri': 'https://snet-dfw2.example.com/1'}])
+        self.assertEqual(auth.GetCloudFilesUri('SYD'), [])
+        self.assertEqual(self.identity.requests, 1)
+
+
+class TokenCacheAuthenticationTest(IdentityTestCase):
+
+    def setUp(self):
+        super(TokenCacheAuthenticationTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.cache = TokenCache(os.path.join(self.directory, 'tokens.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TokenCacheAuthenticationTest, self).tearDown()
+
+    def test_shared_token(self):
+        self.assertEqual(self.authenticator(token_cache=self.cache)
+                         .AuthToken, 'token-1')
+        # Another process with the same credentials reuses the token
+        auth = self.authenticator(token_cache=self.cache)
+        self.assertEqual(auth.AuthToken, 'token-1')
+        self.assertEqual(auth.GetCloudFilesDataCenters(),
+                         ['DFW', 'ORD', 'DFW'])
+        self.assertEqual(self.identity.requests, 1)
+
+    def test_expired_token_renewed(self):
+        self.identity.lifetime = 1
+        self.assertEqual(self.authenticator(token_cache=self.cache)
+                         .AuthToken, 'token-1')
+        self.identity.lifetime = 3600
+        self.assertEqual(self.authenticator(token_cache=self.cache)
+                         .AuthToken, 'token-2')
+        self.assertEqual(self.authenticator(token_cache=self.cache)
+                         .AuthToken, 'token-2')
+
+    def test_invalidated_token(self):
+        auth = self.authenticator(token_cache=self.cache)
+        self.assertEqual(auth.AuthToken, 'token-1')
+        # A token that was already replaced is not discarded again
+        auth.InvalidateToken('token-0')
+        self.assertEqual(auth.AuthToken, 'token-1')
+
+        auth.InvalidateToken('token-1')
+        self.assertIsNone(self.cache.Get(auth.token_cache_key))
+        self.assertEqual(auth.AuthToken, 'token-2')
+        self.assertEqual(self.authenticator(token_cache=self.cache)
+                         .AuthToken, 'token-2')
+
+    def test_rejected_credentials_evicted(self):
+        auth = self.authenticator(token_cache=self.cache)
+        self.assertEqual(auth.AuthToken, 'token-1')
+        self.identity.status = 401
+        self.assertRaises(AuthCredentialsErrors, auth.GetToken)
+        self.assertIsNone(self.cache.Get(auth.token_cache_key))
+
+
+class SingleFlightTest(IdentityTestCase):
+
+    def test_concurrent_renewal(self):
+        auth = self.authenticator()
+        self.identity.delay = 0.2
+        tokens = []
+
+        def read_token():
+            tokens.append(auth.AuthToken)
+
+        threads = [threading.Thread(target=read_token) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ['token-1'] * 8)
+        self.assertEqual(self.identity.requests, 1)
+
+    def test_valid_token_used_during_renewal(self):
+        # Within the 2 second fuzz of AuthToken, but not yet expired
+        self.identity.lifetime = 2
+        auth = self.authenticator()
+        self.assertEqual(auth.GetToken(), 'token-1')
+
+        self.identity.lifetime = 3600
+        self.identity.delay = 0.5
+        renewal = threading.Thread(target=lambda: auth.AuthToken)
+        renewal.start()
+        time.sleep(0.1)
+        started = time.time()
+        self.assertEqual(auth.AuthToken, 'token-1')
+        self.assertTrue(time.time() - started < 0.2)
+        renewal.join()
+        self.assertEqual(auth.AuthToken, 'token-2')
+        self.assertEqual(self.identity.requests, 2)
+
+    def test_unavailable_identity_retried_with_backoff(self):
+        auth = self.authenticator()
+        self.identity.status = 503
+        started = time.time()
+        self.assertRaises(AuthenticationError, auth.GetToken, retry=2,
+                          backoff=0.05)
+        self.assertEqual(self.identity.requests, 3)
+        # 0.05 + 0.1 seconds of backoff
+        self.assertTrue(time.time() - started >= 0.15)
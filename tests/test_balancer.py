@@ -0,0 +1,87 @@
+"""
+Tests for deuceclient.common.balancer
+"""
+import time
+import unittest
+
+from deuceclient.common.balancer import LoadBalancer
+
+
+class LoadBalancerTest(unittest.TestCase):
+
+    def test_requires_hosts(self):
+        self.assertRaises(ValueError, LoadBalancer, [])
+        self.assertRaises(ValueError, LoadBalancer, ['a'], strategy='nope')
+
+    def test_least_outstanding(self):
+        balancer = LoadBalancer(['a', 'b', 'c'])
+        picked = [balancer.Acquire() for i in range(3)]
+        self.assertEqual(sorted(picked), ['a', 'b', 'c'])
+
+        balancer.Release('b')
+        self.assertEqual(balancer.Acquire(), 'b')
+        self.assertEqual(balancer.Stats['b']['outstanding'], 1)
+
+    def test_ties_rotate(self):
+        balancer = LoadBalancer(['a', 'b', 'c'])
+        picked = []
+        for i in range(6):
+            host = balancer.Acquire()
+            picked.append(host)
+            balancer.Release(host)
+        self.assertEqual(sorted(picked), ['a', 'a', 'b', 'b', 'c', 'c'])
+
+    def test_latency_weighted(self):
+        balancer = LoadBalancer(['fast', 'slow'],
+                                strategy=LoadBalancer.LATENCY_WEIGHTED)
+        balancer.Success('fast', 0.01)
+        balancer.Success('slow', 0.1)
+        counts = {'fast': 0, 'slow': 0}
+        for i in range(110):
+            counts[balancer.Acquire()] += 1
+        self.assertTrue(counts['fast'] > counts['slow'] * 5)
+
+    def test_exclude(self):
+        balancer = LoadBalancer(['a', 'b'])
+        self.assertEqual(balancer.Acquire(exclude=['a']), 'b')
+        self.assertEqual(balancer.Acquire(exclude=['a']), 'b')
+        self.assertIsNone(balancer.Acquire(exclude=['a', 'b']))
+
+    def test_ejection_and_readmission(self):
+        balancer = LoadBalancer(['a', 'b'], failure_threshold=2,
+                                eject_time=0.1, max_eject_time=0.15)
+        balancer.Failure('a')
+        self.assertFalse(balancer.Stats['a']['ejected'])
+        balancer.Failure('a')
+        self.assertTrue(balancer.Stats['a']['ejected'])
+        for i in range(4):
+            self.assertEqual(balancer.Acquire(), 'b')
+
+        # Failures of requests sent before the ejection are ignored
+        balancer.Failure('a')
+        self.assertEqual(balancer.Stats['a']['ejections'], 1)
+
+        # Once readmitted a single failure ejects it again, for longer
+        time.sleep(0.11)
+        self.assertFalse(balancer.Stats['a']['ejected'])
+        balancer.Failure('a')
+        self.assertTrue(balancer.Stats['a']['ejected'])
+        self.assertEqual(balancer.Stats['a']['ejections'], 2)
+        time.sleep(0.11)
+        self.assertTrue(balancer.Stats['a']['ejected'])
+        time.sleep(0.05)
+
+        # A success clears its record
+        balancer.Success('a', 0.01)
+        balancer.Failure('a')
+        self.assertFalse(balancer.Stats['a']['ejected'])
+        self.assertEqual(balancer.Stats['a']['ejections'], 0)
+
+    def test_all_ejected_falls_back(self):
+        balancer = LoadBalancer(['a', 'b'], failure_threshold=1,
+                                eject_time=10.0)
+        balancer.Failure('a')
+        time.sleep(0.01)
+        balancer.Failure('b')
+        # a is readmitted first
+        self.assertEqual(balancer.Acquire(), 'a')
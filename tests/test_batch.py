@@ -0,0 +1,113 @@
+"""
+Tests for the batch mode of the shell
+"""
+import argparse
+import io
+import json
+import unittest
+from unittest import mock
+
+import deuceclient.auth.auth
+from deuceclient import shell
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+
+
+class BatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        # Every operation of a batch shares one authenticator
+        self.authenticators = []
+
+        def authenticator(*args, **kwargs):
+            self.authenticators.append(StaticAuthenticator())
+            return self.authenticators[-1]
+
+        patcher = mock.patch.object(deuceclient.auth.auth, 'Authentication',
+                                    authenticator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_batch(self, entries, parallel=1):
+        output = io.StringIO()
+        arguments = argparse.Namespace(
+            user_config=io.StringIO(json.dumps({'user': 'user',
+                                                'apikey': 'key'})),
+            tracer=None, no_token_cache=True, token_cache=None,
+            datacenter='ord', url=self.server.ApiHost, block_cache=None,
+            block_cache_mb=1024, index=None, parallel=parallel,
+            manifest=io.StringIO(''.join(
+                entry if isinstance(entry, str) else json.dumps(entry) + '\n'
+                for entry in entries)),
+            output=output)
+        status = shell.batch_run(None, arguments)
+        records = [json.loads(line)
+                   for line in output.getvalue().splitlines()]
+        return status, records
+
+    def test_batch(self):
+        status, records = self.run_batch([
+            {'id': 'create', 'op': 'CreateVault',
+             'args': {'vaultname': 'v1'}},
+            {'op': 'Barrier'},
+            {'id': 'exists', 'op': 'VaultExists',
+             'args': {'vaultname': 'v1'}},
+            {'id': 'list', 'op': 'GetBlockList',
+             'args': {'vaultname': 'v1'}},
+        ])
+        self.assertIsNone(status)
+        self.assertEqual(len(self.authenticators), 1)
+        self.assertEqual([record['op'] for record in records],
+                         ['CreateVault', 'Barrier', 'VaultExists',
+                          'GetBlockList'])
+        self.assertTrue(all(record['ok'] for record in records))
+        self.assertEqual(records[2]['result'], True)
+        self.assertEqual(records[3]['result'], [])
+        self.assertIn('v1', self.server.vaults)
+
+    def test_failures(self):
+        status, records = self.run_batch([
+            '\n',
+            'not json\n',
+            {'id': 'unknown', 'op': 'Shutdown'},
+            {'id': 'missing', 'op': 'DeleteBlock',
+             'args': {'vaultname': 'none', 'blockid': 'a' * 40}},
+            {'id': 'create', 'op': 'CreateVault',
+             'args': {'vaultname': 'v1'}},
+        ])
+        self.assertEqual(status, 1)
+        records = dict((record['line'], record) for record in records)
+        self.assertEqual(sorted(records), [2, 3, 4, 5])
+        self.assertFalse(records[2]['ok'])
+        self.assertFalse(records[3]['ok'])
+        self.assertEqual(records[3]['error_type'], 'ProgramArgumentError')
+        self.assertFalse(records[4]['ok'])
+        self.assertEqual(records[4]['status'], 404)
+        self.assertTrue(records[5]['ok'])
+
+    def test_barrier(self):
+        # Without the barriers the files could be created before the
+        # vaults they go into
+        entries = [{'op': 'CreateVault', 'args': {'vaultname': 'v1'}},
+                   {'op': 'CreateVault', 'args': {'vaultname': 'v2'}},
+                   {'op': 'Barrier'}]
+        entries.extend({'id': number, 'op': 'CreateFile',
+                        'args': {'vaultname': 'v{0:}'.format(number % 2 + 1)}}
+                       for number in range(8))
+        status, records = self.run_batch(entries, parallel=4)
+        self.assertIsNone(status)
+        self.assertEqual(len(records), 11)
+        self.assertTrue(all(record['ok'] for record in records))
+        barrier = [record['op'] for record in records].index('Barrier')
+        self.assertEqual(barrier, 2)
+        self.assertEqual(len(self.server.vaults['v1'].files), 4)
+        self.assertEqual(len(self.server.vaults['v2'].files), 4)
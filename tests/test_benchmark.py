@@ -0,0 +1,44 @@
+"""
+Tests for deuceclient.benchmark
+"""
+import copy
+import unittest
+
+from deuceclient.benchmark.runner import BenchmarkRunner, CompareResults
+
+
+class BenchmarkRunnerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = BenchmarkRunner(block_sizes=[16 * 1024],
+                                      concurrency=[2],
+                                      file_size=256 * 1024,
+                                      operations=8).Run()
+
+    def test_every_operation_measured(self):
+        measured = [(result['operation'], result.get('chunker'))
+                    for result in self.results['results']]
+        for operation in ('CreateVault', 'VaultExists', 'DeleteVault',
+                          'UploadBlock', 'UploadBlocks', 'GetBlockData',
+                          'GetBlockDataInto', 'GetVaultStatistics',
+                          'GetBlockList', 'AssignBlocksToFile',
+                          'GetFileBlockList', 'FinalizeFile', 'DeleteBlock'):
+            self.assertIn((operation, None), measured)
+        for chunker in ('fixed', 'content-defined'):
+            self.assertIn(('UploadFile', chunker), measured)
+            self.assertIn(('DownloadFile', chunker), measured)
+        for result in self.results['results']:
+            self.assertEqual(result['errors'], 0, result['operation'])
+
+    def test_compare(self):
+        self.assertFalse(any(entry['regression'] for entry in
+                             CompareResults(self.results, self.results)))
+
+        slower = copy.deepcopy(self.results)
+        for result in slower['results']:
+            result['ops_per_sec'] = result['ops_per_sec'] / 2
+            result['mb_per_sec'] = result['mb_per_sec'] / 2
+        comparison = CompareResults(self.results, slower)
+        self.assertEqual(len(comparison), len(self.results['results']))
+        self.assertTrue(all(entry['regression'] for entry in comparison))
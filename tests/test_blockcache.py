@@ -0,0 +1,146 @@
+"""
+Tests for deuceclient.common.blockcache and its use by DeuceClient
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient
+from deuceclient.common.blockcache import BlockCache
+
+
+def block(data):
+    return hashlib.sha1(data).hexdigest(), data
+
+
+class BlockCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.disk_path = os.path.join(self.directory, 'blocks')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_lru(self):
+        cache = BlockCache(memory_bytes=300)
+        a, b, c = [block(letter * 100) for letter in (b'a', b'b', b'c')]
+        for blockid, data in (a, b, c):
+            cache.Put(blockid, bytearray(data))
+        self.assertEqual(cache.Get(a[0]), a[1])
+
+        # b is now the least recently used
+        d = block(b'd' * 100)
+        cache.Put(*d)
+        self.assertIsNone(cache.Get(b[0]))
+        self.assertEqual(cache.Get(a[0]), a[1])
+        stats = cache.Stats
+        self.assertEqual(stats['memory_bytes'], 300)
+        self.assertEqual(stats['memory_evictions'], 1)
+        self.assertEqual(stats['memory_hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+        # Larger than the whole tier, or not a block id
+        cache.Put(*block(b'e' * 301))
+        cache.Put('not-a-block-id', b'x')
+        self.assertEqual(cache.Stats['memory_blocks'], 3)
+
+    def test_disk_tier_persists(self):
+        cache = BlockCache(memory_bytes=0, disk_path=self.disk_path,
+                           disk_bytes=250)
+        a, b, c = [block(letter * 100) for letter in (b'a', b'b', b'c')]
+        for blockid, data in (a, b, c):
+            cache.Put(blockid, data)
+        self.assertIsNone(cache.Get(a[0]))
+        self.assertEqual(cache.Stats['disk_evictions'], 1)
+
+        # Leftovers of an interrupted write are cleaned up
+        with open(os.path.join(self.disk_path, 'x.tmp'), 'wb') as leftover:
+            leftover.write(b'partial')
+        cache = BlockCache(memory_bytes=1024, disk_path=self.disk_path)
+        self.assertEqual(cache.Get(b[0]), b[1])
+        self.assertEqual(cache.Get(c[0]), c[1])
+        self.assertEqual(cache.Stats['disk_hits'], 2)
+        self.assertFalse(os.path.exists(os.path.join(self.disk_path,
+                                                     'x.tmp')))
+        # Served from memory once read from disk
+        cache.Get(b[0])
+        self.assertEqual(cache.Stats['memory_hits'], 1)
+
+    def test_corrupt_block_dropped(self):
+        cache = BlockCache(memory_bytes=0, disk_path=self.disk_path)
+        blockid, data = block(b'a' * 100)
+        cache.Put(blockid, data)
+        with open(os.path.join(self.disk_path, blockid[:2], blockid),
+                  'wb') as block_file:
+            block_file.write(b'b' * 100)
+        self.assertIsNone(cache.Get(blockid))
+        stats = cache.Stats
+        self.assertEqual(stats['corrupt'], 1)
+        self.assertEqual(stats['disk_blocks'], 0)
+
+    def test_discard_and_clear(self):
+        cache = BlockCache(disk_path=self.disk_path)
+        a, b = block(b'a'), block(b'b')
+        cache.Put(*a)
+        cache.Put(*b)
+        cache.Discard(a[0])
+        self.assertIsNone(cache.Get(a[0]))
+        cache.Clear()
+        self.assertIsNone(cache.Get(b[0]))
+        self.assertEqual(cache.Stats['disk_bytes'], 0)
+
+
+class DeuceClientBlockCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        self.cache = BlockCache()
+        self.client = DeuceClient(False, StaticAuthenticator(),
+                                  self.server.ApiHost,
+                                  block_cache=self.cache)
+        self.client.CreateVault('vault')
+
+    def forget(self, blockid):
+        del self.server.vaults['vault'].blocks[blockid]
+
+    def test_get_block_data(self):
+        blockid, data = block(b'cached' * 100)
+        self.client.UploadBlock('vault', blockid, data)
+        self.assertEqual(self.client.GetBlockData('vault', blockid), data)
+        self.forget(blockid)
+        self.assertEqual(self.client.GetBlockData('vault', blockid), data)
+
+    def test_get_block_data_into(self):
+        blockid, data = block(b'streamed' * 100)
+        self.client.UploadBlock('vault', blockid, data)
+        buffer = bytearray(len(data))
+        self.client.GetBlockDataInto('vault', blockid, buffer)
+        # The cache holds its own copy, not the caller's buffer
+        buffer[:] = bytes(len(data))
+        self.forget(blockid)
+        self.assertEqual(self.client.GetBlockDataInto('vault', blockid,
+                                                      buffer), len(data))
+        self.assertEqual(buffer, data)
+
+    def test_unverified_data_not_cached(self):
+        blockid, data = block(b'good' * 100)
+        self.client.UploadBlock('vault', blockid, data)
+        self.server.vaults['vault'].blocks[blockid] = b'evil' * 100
+        self.assertEqual(self.client.GetBlockData('vault', blockid),
+                         b'evil' * 100)
+        self.client.GetBlockDataInto('vault', blockid, bytearray(400),
+                                     verify=False)
+        self.assertIsNone(self.cache.Get(blockid))
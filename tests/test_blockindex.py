@@ -0,0 +1,135 @@
+"""
+Tests for deuceclient.common.blockindex and its use by DeuceClient
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient
+from deuceclient.common.blockindex import BlockIndex
+
+
+def block(data):
+    return hashlib.sha1(data).hexdigest(), data
+
+
+class BlockIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add_discard_invalidate(self):
+        index = BlockIndex(self.path, bloom_bits=2 ** 16)
+        a, b = block(b'a')[0], block(b'b')[0]
+        index.AddMany('v1', [a, b])
+        index.Add('v2', a)
+        self.assertTrue(index.Contains('v1', a))
+        self.assertFalse(index.Contains('v2', b))
+        self.assertEqual(index.Count('v1'), 2)
+
+        index.Discard('v1', a)
+        self.assertFalse(index.Contains('v1', a))
+        index.Invalidate('v1')
+        self.assertEqual(index.Count('v1'), 0)
+        self.assertTrue(index.Contains('v2', a))
+        index.Invalidate()
+        self.assertFalse(index.Contains('v2', a))
+        index.Close()
+
+    def test_persistence(self):
+        a, b = block(b'a')[0], block(b'b')[0]
+        index = BlockIndex(self.path, bloom_bits=2 ** 16,
+                           commit_interval=1000)
+        index.AddMany('v1', [a, b])
+        index.Close()
+
+        index = BlockIndex(self.path, bloom_bits=2 ** 16)
+        self.assertTrue(index.Contains('v1', a))
+        # A discard is durable without a Flush()
+        index.Discard('v1', b)
+        index.db.close()
+
+        # The Bloom filter is rebuilt from the database if it is lost
+        os.unlink(self.path + '.bloom')
+        index = BlockIndex(self.path, bloom_bits=2 ** 16)
+        self.assertTrue(index.Contains('v1', a))
+        self.assertFalse(index.Contains('v1', b))
+        index.Close()
+
+
+class DeuceClientBlockIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        self.directory = tempfile.mkdtemp()
+        self.index = BlockIndex(os.path.join(self.directory, 'index.db'),
+                                bloom_bits=2 ** 16)
+        self.client = DeuceClient(False, StaticAuthenticator(),
+                                  self.server.ApiHost,
+                                  block_index=self.index)
+        self.client.CreateVault('vault')
+
+    def tearDown(self):
+        self.index.Close()
+        shutil.rmtree(self.directory)
+
+    def stored(self, blockid):
+        return blockid in self.server.vaults['vault'].blocks
+
+    def test_upload_skips_known_blocks(self):
+        blockid, data = block(b'known')
+        self.assertTrue(self.client.UploadBlock('vault', blockid, data))
+        self.assertTrue(self.index.Contains('vault', blockid))
+        del self.server.vaults['vault'].blocks[blockid]
+        self.client.UploadBlock('vault', blockid, data)
+        self.assertFalse(self.stored(blockid))
+
+    def test_delete_block_forgets_block(self):
+        blockid, data = block(b'deleted')
+        self.client.UploadBlock('vault', blockid, data)
+        self.assertTrue(self.client.DeleteBlock('vault', blockid))
+        self.assertFalse(self.index.Contains('vault', blockid))
+        self.client.UploadBlock('vault', blockid, data)
+        self.assertTrue(self.stored(blockid))
+
+    def test_delete_vault_forgets_blocks(self):
+        blockid, data = block(b'recreated')
+        self.client.UploadBlock('vault', blockid, data)
+        self.assertTrue(self.client.DeleteVault('vault'))
+        self.assertEqual(self.index.Count('vault'), 0)
+        self.client.CreateVault('vault')
+        self.client.UploadBlock('vault', blockid, data)
+        self.assertTrue(self.stored(blockid))
+
+    def test_sync_block_index(self):
+        stale = block(b'stale')[0]
+        self.index.Add('vault', stale)
+        other = DeuceClient(False, StaticAuthenticator(),
+                            self.server.ApiHost)
+        blockids = []
+        for i in range(25):
+            blockid, data = block(str(i).encode('utf-8'))
+            other.UploadBlock('vault', blockid, data)
+            blockids.append(blockid)
+
+        self.assertEqual(self.client.SyncBlockIndex('vault', limit=10), 25)
+        self.assertEqual(self.index.Count('vault'), 25)
+        self.assertFalse(self.index.Contains('vault', stale))
+        for blockid in blockids:
+            self.assertTrue(self.index.Contains('vault', blockid))
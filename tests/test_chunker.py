@@ -0,0 +1,90 @@
+"""
+Tests for deuceclient.common.chunker
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from deuceclient.common import chunker
+from deuceclient.common.chunker import ContentDefinedChunker
+from deuceclient.common.chunker import FixedSizeChunker
+
+
+class ChunkerResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+        data = random.Random(42).getrandbits(8 * 300 * 1024)
+        with open(self.path, 'wb') as data_file:
+            data_file.write(data.to_bytes(300 * 1024, 'little'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def __blocks(generator):
+        return [(blockid, offset, size)
+                for blockid, offset, size, buffer in generator]
+
+    def __check_resume(self, block_chunker):
+        blocks = self.__blocks(block_chunker.ChunkFile(self.path))
+        self.assertTrue(len(blocks) > 4)
+        self.assertEqual(sum(size for blockid, offset, size in blocks),
+                         300 * 1024)
+        self.assertEqual(self.__blocks(block_chunker.ChunkMapped(self.path)),
+                         blocks)
+
+        for index in (1, len(blocks) // 2, len(blocks) - 1):
+            start = blocks[index][1]
+            self.assertEqual(
+                self.__blocks(block_chunker.ChunkFile(self.path,
+                                                      start=start)),
+                blocks[index:])
+            self.assertEqual(
+                self.__blocks(block_chunker.ChunkMapped(self.path,
+                                                        start=start)),
+                blocks[index:])
+
+        end = os.path.getsize(self.path)
+        self.assertEqual(list(block_chunker.ChunkFile(self.path, start=end)),
+                         [])
+        self.assertEqual(list(block_chunker.ChunkMapped(self.path,
+                                                        start=end)), [])
+
+    def test_fixed_size_resume(self):
+        # Small read size so that blocks span several reads
+        self.__check_resume(FixedSizeChunker(block_size=24 * 1024,
+                                             read_size=10 * 1024))
+
+    def test_content_defined_resume(self):
+        self.__check_resume(ContentDefinedChunker(min_size=4 * 1024,
+                                                  avg_size=16 * 1024,
+                                                  max_size=64 * 1024,
+                                                  read_size=10 * 1024))
+
+
+@unittest.skipIf(chunker.numpy is None, 'numpy is not installed')
+class VectorizedBoundaryTest(unittest.TestCase):
+
+    def test_same_boundaries_as_loop(self):
+        data = bytearray(random.Random(7).getrandbits(8 * 200 * 1024)
+                         .to_bytes(200 * 1024, 'little'))
+        # A run of zeros never matches a mask and hits max_size
+        data[50000:150000] = bytes(100000)
+        for min_size, avg_size, max_size in ((64, 256, 1024),
+                                             (2048, 8192, 32768),
+                                             (1, 1, 1),
+                                             (1024, 65536, 65536)):
+            block_chunker = ContentDefinedChunker(min_size, avg_size,
+                                                  max_size)
+            start = 0
+            while start < len(data):
+                cut = block_chunker.FindBoundary(data, start, len(data))
+                self.assertEqual(
+                    cut, ContentDefinedChunker.FindBoundary(
+                        block_chunker, data, start, len(data)))
+                self.assertTrue(start < cut <= start + max_size)
+                start = cut
@@ -0,0 +1,102 @@
+"""
+Tests for DeuceClient.DownloadFile
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient
+from deuceclient.common.chunker import FixedSizeChunker
+
+
+class RecordingDeuceServer(FakeDeuceServer):
+    """
+    Fake server recording the order of list pages and block downloads,
+    which are slowed down
+    """
+
+    def __init__(self):
+        super(RecordingDeuceServer, self).__init__()
+        self.requests = []
+
+    def get_file_blocks(self, vault, file, query, body):
+        self.requests.append('page')
+        return super(RecordingDeuceServer, self).get_file_blocks(
+            vault, file, query, body)
+
+    def get_block(self, vault, block, query, body):
+        self.requests.append('block')
+        time.sleep(0.005)
+        return super(RecordingDeuceServer, self).get_block(vault, block,
+                                                           query, body)
+
+
+class DownloadFileTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = RecordingDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        self.directory = tempfile.mkdtemp()
+        self.client = DeuceClient(False, StaticAuthenticator(),
+                                  self.server.ApiHost)
+        self.client.CreateVault('vault')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, data):
+        path = os.path.join(self.directory, 'source')
+        with open(path, 'wb') as source:
+            source.write(data)
+        return self.client.UploadFile('vault', path,
+                                      chunker=FixedSizeChunker(1024))
+
+    def test_download(self):
+        # Repeated blocks are stored once but written at every offset
+        data = os.urandom(20 * 1024) + b'\0' * 10 * 1024 + os.urandom(500)
+        fileid = self.upload(data)
+        path = os.path.join(self.directory, 'copy')
+        with open(path, 'wb') as copy:
+            copy.write(b'x' * 100 * 1024)
+
+        # Small pages, so that the list spans several of them
+        list_pages = self.client.IterFileBlockList
+        self.client.IterFileBlockList = \
+            lambda vaultname, fileid: list_pages(vaultname, fileid, limit=5)
+        self.server.requests = []
+        results = self.client.DownloadFile('vault', fileid, path,
+                                           concurrency=1)
+        self.assertTrue(results.Succeeded)
+        with open(path, 'rb') as copy:
+            self.assertEqual(hashlib.sha1(copy.read()).hexdigest(),
+                             hashlib.sha1(data).hexdigest())
+
+        # Only a few blocks are queued ahead of the downloads, so most of
+        # them are downloaded before the last page of the list is read
+        last_page = len(self.server.requests) - 1 - \
+            self.server.requests[::-1].index('page')
+        self.assertTrue(
+            self.server.requests[:last_page].count('block') > 10)
+
+    def test_failed_block(self):
+        data = os.urandom(4 * 1024)
+        fileid = self.upload(data)
+        blockid = hashlib.sha1(data[1024:2048]).hexdigest()
+        del self.server.vaults['vault'].blocks[blockid]
+
+        results = self.client.DownloadFile(
+            'vault', fileid, os.path.join(self.directory, 'copy'))
+        self.assertFalse(results.Succeeded)
+        self.assertEqual(list(results.Errors), [blockid])
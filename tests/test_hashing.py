@@ -0,0 +1,59 @@
+"""
+Tests for deuceclient.common.hashing
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from deuceclient.common.chunker import FixedSizeChunker
+from deuceclient.common.hashing import BlockHasher
+
+
+class BlockHasherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+        self.chunker = FixedSizeChunker(block_size=16 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, data):
+        # Replace the file rather than rewriting it, giving a new inode
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as data_file:
+            data_file.write(data)
+        os.replace(temp_path, self.path)
+
+    def check(self, hasher, data):
+        blocks = list(self.chunker.ChunkFile(self.path, hasher=hasher))
+        self.assertEqual(
+            [(blockid, offset, size) for blockid, offset, size, buffer
+             in blocks],
+            [(hashlib.sha1(data[offset:offset + 16 * 1024]).hexdigest(),
+              offset, len(data[offset:offset + 16 * 1024]))
+             for offset in range(0, len(data), 16 * 1024)])
+
+    def test_threads_keep_order(self):
+        data = os.urandom(1024 * 1024 + 100)
+        self.write(data)
+        with BlockHasher(workers=4, window=3) as hasher:
+            self.check(hasher, data)
+
+    def test_processes(self):
+        data = os.urandom(256 * 1024 + 100)
+        self.write(data)
+        with BlockHasher(workers=2, processes=True) as hasher:
+            self.check(hasher, data)
+            self.assertRaises(ValueError, list,
+                              hasher.Hash([(0, 1, b'x')]))
+
+    def test_processes_file_replaced(self):
+        with BlockHasher(workers=1, processes=True) as hasher:
+            for i in range(3):
+                data = os.urandom(64 * 1024)
+                self.write(data)
+                self.check(hasher, data)
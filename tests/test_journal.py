@@ -0,0 +1,210 @@
+"""
+Tests for deuceclient.common.journal and resumed DeuceClient.UploadFile
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient, DeuceServerError
+from deuceclient.common.chunker import FixedSizeChunker
+from deuceclient.common.journal import UploadJournal
+from deuceclient.common.retry import RetryPolicy
+
+
+class UploadJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'upload.journal')
+        self.data_path = os.path.join(self.directory, 'data')
+        with open(self.data_path, 'wb') as data_file:
+            data_file.write(b'x' * 300)
+        self.identity = UploadJournal.Identity('vault', self.data_path,
+                                               'fixed:100')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def __write_upload(self):
+        journal = UploadJournal(self.path)
+        journal.Begin(self.identity, 'file-1')
+        journal.Assigned([('a', 0, 100), ('b', 100, 100)])
+        journal.Close()
+
+    def test_resume(self):
+        self.__write_upload()
+        journal = UploadJournal(self.path)
+        self.assertTrue(journal.Matches(self.identity))
+        self.assertEqual(journal.FileId, 'file-1')
+        self.assertEqual(journal.ResumeOffset, 200)
+        self.assertEqual(journal.AssignedBlocks, 2)
+        self.assertFalse(journal.Finalized)
+        journal.Close()
+
+    def test_identity_mismatch(self):
+        self.__write_upload()
+        journal = UploadJournal(self.path)
+        self.assertFalse(journal.Matches(
+            UploadJournal.Identity('other', self.data_path, 'fixed:100')))
+        self.assertFalse(journal.Matches(
+            UploadJournal.Identity('vault', self.data_path, 'cdc:1:2:3')))
+        journal.Close()
+
+        with open(self.data_path, 'ab') as data_file:
+            data_file.write(b'y')
+        journal = UploadJournal(self.path)
+        self.assertFalse(journal.Matches(
+            UploadJournal.Identity('vault', self.data_path, 'fixed:100')))
+        journal.Close()
+
+    def test_finalized_does_not_match(self):
+        self.__write_upload()
+        journal = UploadJournal(self.path)
+        journal.Finalize()
+        journal.Close()
+        journal = UploadJournal(self.path)
+        self.assertTrue(journal.Finalized)
+        self.assertFalse(journal.Matches(self.identity))
+        journal.Close()
+
+    def test_torn_record_ignored_and_truncated(self):
+        self.__write_upload()
+        valid_size = os.path.getsize(self.path)
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"record":"assigned","blocks":[["c",200,1')
+
+        journal = UploadJournal(self.path)
+        self.assertEqual(os.path.getsize(self.path), valid_size)
+        self.assertEqual(journal.ResumeOffset, 200)
+        self.assertTrue(journal.Matches(self.identity))
+
+        # New records start on a line of their own
+        journal.Assigned([('c', 200, 100)])
+        journal.Close()
+        journal = UploadJournal(self.path)
+        self.assertEqual(journal.ResumeOffset, 300)
+        self.assertEqual(journal.AssignedBlocks, 3)
+        journal.Close()
+
+    def test_complete_record_without_newline_is_torn(self):
+        self.__write_upload()
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"record":"finalized"}')
+
+        journal = UploadJournal(self.path)
+        self.assertFalse(journal.Finalized)
+        self.assertTrue(journal.Matches(self.identity))
+        journal.Close()
+
+    def test_begin_discards_earlier_upload(self):
+        self.__write_upload()
+        journal = UploadJournal(self.path)
+        journal.Begin(self.identity, 'file-2')
+        journal.Close()
+        journal = UploadJournal(self.path)
+        self.assertEqual(journal.FileId, 'file-2')
+        self.assertEqual(journal.ResumeOffset, 0)
+        self.assertEqual(journal.AssignedBlocks, 0)
+        journal.Remove()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class FaultyDeuceServer(FakeDeuceServer):
+    """
+    Fake server failing the assignment after a number of them, or failing
+    finalizations after applying them
+    """
+
+    def __init__(self):
+        super(FaultyDeuceServer, self).__init__()
+        self.assignments_left = None
+        self.assignments = 0
+        self.fail_finalize = False
+
+    def post_file(self, vault, file, query, body):
+        if body:
+            self.assignments = self.assignments + 1
+            if self.assignments_left is not None:
+                if not self.assignments_left:
+                    return 500, {}, b'Assignment failed'
+                self.assignments_left = self.assignments_left - 1
+        result = super(FaultyDeuceServer, self).post_file(vault, file,
+                                                          query, body)
+        if not body and self.fail_finalize:
+            return 500, {}, b'Lost the response'
+        return result
+
+
+class ResumedUploadTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FaultyDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        self.server.assignments_left = None
+        self.server.assignments = 0
+        self.server.fail_finalize = False
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+        self.journal_path = os.path.join(self.directory, 'upload.journal')
+        with open(self.path, 'wb') as data_file:
+            data_file.write(os.urandom(10 * 1024))
+        self.client = DeuceClient(False, StaticAuthenticator(),
+                                  self.server.ApiHost,
+                                  retry_policy=RetryPolicy(max_attempts=1))
+        self.client.CreateVault('vault')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self):
+        return self.client.UploadFile('vault', self.path,
+                                      chunker=FixedSizeChunker(1024),
+                                      batch_size=2,
+                                      journal_path=self.journal_path)
+
+    def check_file(self, fileid):
+        vault = self.server.vaults['vault']
+        self.assertIn(fileid, vault.finalized)
+        self.assertEqual(sorted(vault.files[fileid]),
+                         list(range(0, 10 * 1024, 1024)))
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_resume_after_failed_assignment(self):
+        # Each batch is assigned before and after uploading its blocks
+        self.server.assignments_left = 4
+        self.assertRaises(DeuceServerError, self.upload)
+        journal = UploadJournal(self.journal_path)
+        self.assertEqual(journal.ResumeOffset, 4 * 1024)
+        fileid = journal.FileId
+        journal.Close()
+
+        self.server.assignments_left = None
+        self.server.assignments = 0
+        self.assertEqual(self.upload(), fileid)
+        # Only the three remaining batches were assigned
+        self.assertEqual(self.server.assignments, 6)
+        self.check_file(fileid)
+
+    def test_resume_after_lost_finalization(self):
+        self.server.fail_finalize = True
+        self.assertRaises(DeuceServerError, self.upload)
+        journal = UploadJournal(self.journal_path)
+        fileid = journal.FileId
+        self.assertFalse(journal.Finalized)
+        journal.Close()
+
+        self.server.fail_finalize = False
+        self.server.assignments = 0
+        self.assertEqual(self.upload(), fileid)
+        self.assertEqual(self.server.assignments, 0)
+        self.check_file(fileid)
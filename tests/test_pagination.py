@@ -0,0 +1,102 @@
+"""
+Tests for the paginating list iterators of DeuceClient
+"""
+import hashlib
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient
+
+
+class PagingDeuceServer(FakeDeuceServer):
+    """
+    Fake server counting the list pages requested
+    """
+
+    def __init__(self):
+        super(PagingDeuceServer, self).__init__()
+        self.pages = 0
+
+    def get_blocks(self, vault, query, body):
+        self.pages = self.pages + 1
+        return super(PagingDeuceServer, self).get_blocks(vault, query, body)
+
+    def get_file_blocks(self, vault, file, query, body):
+        self.pages = self.pages + 1
+        return super(PagingDeuceServer, self).get_file_blocks(
+            vault, file, query, body)
+
+
+class PaginationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = PagingDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        self.client = DeuceClient(False, StaticAuthenticator(),
+                                  self.server.ApiHost)
+        self.client.CreateVault('vault')
+
+    def store(self, count):
+        blocks = []
+        for number in range(count):
+            data = 'block {0:}'.format(number).encode('utf-8')
+            blockid = hashlib.sha1(data).hexdigest()
+            self.client.UploadBlock('vault', blockid, data)
+            blocks.append(blockid)
+        return sorted(blocks)
+
+    def test_block_list(self):
+        blocks = self.store(23)
+        for prefetch in (True, False):
+            self.server.pages = 0
+            self.assertEqual(list(self.client.IterBlockList(
+                'vault', limit=5, prefetch=prefetch)), blocks)
+            # Each page after the first repeats its marker, so the pages
+            # bring 5, 4, 4, 4, 4 and 2 blocks; the short last one ends
+            # the walk
+            self.assertEqual(self.server.pages, 6)
+
+    def test_full_last_page(self):
+        blocks = self.store(13)
+        for prefetch in (True, False):
+            self.server.pages = 0
+            self.assertEqual(list(self.client.IterBlockList(
+                'vault', limit=5, prefetch=prefetch)), blocks)
+            # The pages bring 5, 4 and 4 blocks; the fourth only holds the
+            # marker and ends the walk
+            self.assertEqual(self.server.pages, 4)
+
+    def test_empty_list(self):
+        for prefetch in (True, False):
+            self.assertEqual(list(self.client.IterBlockList(
+                'vault', limit=5, prefetch=prefetch)), [])
+
+    def test_file_block_list(self):
+        blocks = self.store(12)
+        location = self.client.CreateFile('vault')
+        fileid = location.rstrip('/').split('/')[-1]
+        self.client.AssignBlocksToFile('vault', fileid, {
+            'blocks': [{'id': blockid, 'size': 10, 'offset': number * 10}
+                       for number, blockid in enumerate(blocks)]
+        })
+
+        for prefetch in (True, False):
+            entries = list(self.client.IterFileBlockList(
+                'vault', fileid, limit=5, prefetch=prefetch))
+            self.assertEqual([entry[0] for entry in entries], blocks)
+            self.assertEqual([int(entry[1]) for entry in entries],
+                             list(range(0, 120, 10)))
+
+    def test_abandoned_walk(self):
+        blocks = self.store(23)
+        walk = self.client.IterBlockList('vault', limit=5)
+        self.assertEqual([next(walk) for number in range(7)], blocks[:7])
+        walk.close()
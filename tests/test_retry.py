@@ -0,0 +1,167 @@
+"""
+Tests for deuceclient.common.retry
+"""
+import email.utils
+import time
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient
+from deuceclient.common.retry import CircuitBreaker, RetryPolicy
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_idempotent_methods_retried_on_any_retry_status(self):
+        policy = RetryPolicy(max_attempts=3)
+        for status in (408, 429, 500, 502, 503, 504):
+            self.assertTrue(policy.ShouldRetry('GetBlockData', 'GET', 0,
+                                               status))
+        self.assertFalse(policy.ShouldRetry('GetBlockData', 'GET', 0, 404))
+
+    def test_non_idempotent_only_retried_when_not_processed(self):
+        policy = RetryPolicy(max_attempts=3)
+        self.assertFalse(policy.ShouldRetry('CreateFile', 'POST', 0, 500))
+        self.assertTrue(policy.ShouldRetry('CreateFile', 'POST', 0, 503))
+        self.assertTrue(policy.ShouldRetry('CreateFile', 'POST', 0, 429))
+        self.assertFalse(policy.ShouldRetry('CreateFile', 'POST', 0, None,
+                                            sent=True))
+        self.assertTrue(policy.ShouldRetry('CreateFile', 'POST', 0, None,
+                                           sent=False))
+
+    def test_operation_overrides(self):
+        policy = RetryPolicy(non_idempotent_operations=('DeleteBlock',))
+        self.assertTrue(policy.ShouldRetry('AssignBlocksToFile', 'POST', 0,
+                                           500))
+        self.assertFalse(policy.ShouldRetry('DeleteBlock', 'DELETE', 0,
+                                            500))
+
+    def test_attempts_exhausted(self):
+        policy = RetryPolicy(max_attempts=2)
+        self.assertTrue(policy.ShouldRetry('GetBlockData', 'GET', 0, 503))
+        self.assertFalse(policy.ShouldRetry('GetBlockData', 'GET', 1, 503))
+        self.assertRaises(ValueError, RetryPolicy, max_attempts=0)
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1.0, max_backoff=5.0, jitter=False)
+        self.assertEqual([policy.Delay(attempt) for attempt in range(5)],
+                         [1.0, 2.0, 4.0, 5.0, 5.0])
+        # Retry-After is a floor
+        self.assertEqual(policy.Delay(0, retry_after=3.0), 3.0)
+        self.assertEqual(policy.Delay(3, retry_after=3.0), 5.0)
+
+        policy = RetryPolicy(backoff=1.0, max_backoff=5.0, jitter=True)
+        for attempt in range(5):
+            self.assertTrue(0 <= policy.Delay(attempt) <= 5.0)
+
+    def test_deadline(self):
+        policy = RetryPolicy(max_elapsed=10.0)
+        now = time.time()
+        self.assertTrue(policy.WithinDeadline(now, 5.0))
+        self.assertFalse(policy.WithinDeadline(now - 8.0, 5.0))
+
+    def test_retry_after(self):
+        self.assertIsNone(RetryPolicy.RetryAfter({}))
+        self.assertEqual(RetryPolicy.RetryAfter({'Retry-After': '7'}), 7.0)
+        self.assertIsNone(RetryPolicy.RetryAfter({'Retry-After': 'soon'}))
+        when = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertTrue(25 <= RetryPolicy.RetryAfter(
+            {'Retry-After': when}) <= 31)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2,
+                                      reset_timeout=0.1,
+                                      probe_interval=0.01)
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertEqual(self.breaker.Allow('a'), 0.0)
+        self.breaker.Failure('a')
+        self.breaker.Success('a')
+        self.breaker.Failure('a')
+        self.assertEqual(self.breaker.State('a'), CircuitBreaker.CLOSED)
+        self.breaker.Failure('a')
+        self.assertEqual(self.breaker.State('a'), CircuitBreaker.OPEN)
+        self.assertTrue(0 < self.breaker.Allow('a') <= 0.1)
+        # Hosts are independent
+        self.assertEqual(self.breaker.Allow('b'), 0.0)
+
+    def test_probe_closes_circuit(self):
+        self.breaker.Failure('a')
+        self.breaker.Failure('a')
+        time.sleep(0.11)
+        self.assertEqual(self.breaker.Allow('a'), 0.0)
+        self.assertEqual(self.breaker.State('a'), CircuitBreaker.HALF_OPEN)
+        # Only the probe goes through
+        self.assertEqual(self.breaker.Allow('a'), 0.01)
+        self.breaker.Success('a')
+        self.assertEqual(self.breaker.State('a'), CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.Allow('a'), 0.0)
+
+    def test_released_probe_lets_next_caller_probe(self):
+        self.breaker.Failure('a')
+        self.breaker.Failure('a')
+        time.sleep(0.11)
+        self.assertEqual(self.breaker.Allow('a'), 0.0)
+        self.breaker.Release('a')
+        self.assertEqual(self.breaker.State('a'), CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.breaker.Allow('a'), 0.0)
+        # Releasing outside a probe changes nothing
+        self.breaker.Success('a')
+        self.breaker.Release('a')
+        self.assertEqual(self.breaker.State('a'), CircuitBreaker.CLOSED)
+
+    def test_failed_probe_reopens_circuit(self):
+        self.breaker.Failure('a')
+        self.breaker.Failure('a')
+        time.sleep(0.11)
+        self.assertEqual(self.breaker.Allow('a'), 0.0)
+        self.breaker.Failure('a')
+        self.assertEqual(self.breaker.State('a'), CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.Allow('a') > 0)
+
+
+class FailingAuthenticator(StaticAuthenticator):
+    """
+    Authenticator failing to provide a token
+    """
+
+    @property
+    def AuthToken(self):
+        raise RuntimeError('identity is down')
+
+    @AuthToken.setter
+    def AuthToken(self, token):
+        pass
+
+
+class DeuceClientCircuitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeDeuceServer()
+        self.server.Start()
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.5,
+                                      probe_interval=10.0)
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def test_authentication_failure_does_not_hold_probe(self):
+        self.breaker.Failure(self.server.ApiHost)
+        time.sleep(0.5)
+
+        failing = DeuceClient(False, FailingAuthenticator(),
+                              self.server.ApiHost,
+                              circuit_breaker=self.breaker)
+        self.assertRaises(RuntimeError, failing.CreateVault, 'vault')
+
+        client = DeuceClient(False, StaticAuthenticator(),
+                             self.server.ApiHost,
+                             circuit_breaker=self.breaker)
+        started = time.time()
+        self.assertTrue(client.CreateVault('vault'))
+        self.assertTrue(time.time() - started < 0.25)
+        self.assertEqual(self.breaker.State(self.server.ApiHost),
+                         CircuitBreaker.CLOSED)
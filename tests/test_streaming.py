@@ -0,0 +1,80 @@
+"""
+Tests for streaming block data with DeuceClient.GetBlockDataInto
+"""
+import hashlib
+import io
+import os
+import tracemalloc
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import BlockVerificationError, DeuceClient
+
+
+class GetBlockDataIntoTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeDeuceServer()
+        cls.server.Start()
+        cls.client = DeuceClient(False, StaticAuthenticator(),
+                                 cls.server.ApiHost)
+        cls.client.CreateVault('vault')
+        cls.data = os.urandom(8 * 1024 * 1024)
+        cls.blockid = hashlib.sha1(cls.data).hexdigest()
+        cls.client.UploadBlock('vault', cls.blockid, cls.data)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def test_into_buffer(self):
+        buffer = bytearray(len(self.data) + 10)
+        self.assertEqual(self.client.GetBlockDataInto('vault', self.blockid,
+                                                      buffer),
+                         len(self.data))
+        self.assertEqual(buffer[:len(self.data)], self.data)
+
+    def test_into_file(self):
+        destination = io.BytesIO()
+        self.assertEqual(self.client.GetBlockDataInto('vault', self.blockid,
+                                                      destination),
+                         len(self.data))
+        self.assertEqual(destination.getvalue(), self.data)
+
+    def test_buffer_too_small(self):
+        buffer = bytearray(len(self.data) - 1)
+        self.assertRaises(BlockVerificationError,
+                          self.client.GetBlockDataInto, 'vault',
+                          self.blockid, buffer)
+
+    def test_verification(self):
+        data = b'x' * 100
+        blockid = hashlib.sha1(data).hexdigest()
+        self.client.UploadBlock('vault', blockid, data)
+        self.server.vaults['vault'].blocks[blockid] = b'y' * 100
+        self.assertRaises(BlockVerificationError,
+                          self.client.GetBlockDataInto, 'vault', blockid,
+                          bytearray(100))
+        self.assertEqual(self.client.GetBlockDataInto('vault', blockid,
+                                                      bytearray(100),
+                                                      verify=False), 100)
+
+    def test_bounded_allocations(self):
+        chunk_size = 256 * 1024
+        for destination in (bytearray(len(self.data)), io.BytesIO()):
+            # Warm up the connection pool outside the measurement
+            self.client.GetBlockDataInto('vault', self.blockid, destination,
+                                         chunk_size=chunk_size)
+            if hasattr(destination, 'seek'):
+                destination.seek(0)
+            tracemalloc.start()
+            try:
+                self.client.GetBlockDataInto('vault', self.blockid,
+                                             destination,
+                                             chunk_size=chunk_size)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertTrue(peak < 4 * chunk_size,
+                            'peak allocation {0:} bytes'.format(peak))
@@ -0,0 +1,84 @@
+"""
+Tests for deuceclient.auth.tokencache
+"""
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from deuceclient.auth.tokencache import parse_expiration, TokenCache
+
+
+def auth_data(token, lifetime):
+    expires = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                            time.gmtime(time.time() + lifetime))
+    return {'access': {'token': {'id': token, 'expires': expires}}}
+
+
+class ParseExpirationTest(unittest.TestCase):
+
+    def test_formats(self):
+        for expires in ('2013-12-24T14:02:26.550Z', '2013-12-24T14:02:26Z',
+                        '2013-12-24T14:02:26'):
+            self.assertEqual(parse_expiration(expires), 1387893746)
+        self.assertRaises(ValueError, parse_expiration, 'tomorrow')
+
+
+class TokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = TokenCache(os.path.join(self.directory, 'cache',
+                                             'tokens.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entries(self):
+        with open(self.cache.Path) as cache_file:
+            return json.load(cache_file)
+
+    def test_key(self):
+        key = TokenCache.Key('host', 'user', 'user', 'apikey', 'secret')
+        self.assertEqual(key, TokenCache.Key('host', 'user', 'user',
+                                             'apikey', 'secret'))
+        self.assertNotEqual(key, TokenCache.Key('host', 'user', 'user',
+                                                'apikey', 'other'))
+        self.assertNotIn('secret', key)
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.Get('a'))
+        self.cache.Put('a', auth_data('t1', 3600))
+        self.assertEqual(self.cache.Get('a'), auth_data('t1', 3600))
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache.Path).st_mode),
+                         0o600)
+
+    def test_corrupt_file(self):
+        with open(self.cache.Path, 'w') as cache_file:
+            cache_file.write('{"a": ')
+        self.assertIsNone(self.cache.Get('a'))
+        self.cache.Put('b', auth_data('t2', 3600))
+        self.assertEqual(list(self.entries()), ['b'])
+
+    def test_put_prunes_expired_entries(self):
+        self.cache.Put('expired', auth_data('t1', -10))
+        self.cache.Put('valid', auth_data('t2', 3600))
+        self.cache.Put('junk', {'access': {}})
+        self.cache.Put('new', auth_data('t3', 3600))
+        self.assertEqual(sorted(self.entries()), ['new', 'valid'])
+
+    def test_remove(self):
+        self.cache.Put('a', auth_data('t1', 3600))
+        # A token another process has since stored is kept
+        self.cache.Remove('a', 'old-token')
+        self.assertIsNotNone(self.cache.Get('a'))
+        self.cache.Remove('a', 't1')
+        self.assertIsNone(self.cache.Get('a'))
+
+        self.cache.Put('b', auth_data('t2', 3600))
+        self.cache.Remove('b')
+        self.assertIsNone(self.cache.Get('b'))
+        self.cache.Remove('missing')
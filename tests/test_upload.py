@@ -0,0 +1,94 @@
+"""
+Tests for DeuceClient.UploadFile
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from deuceclient.benchmark.server import FakeDeuceServer, StaticAuthenticator
+from deuceclient.client.deuce import DeuceClient
+from deuceclient.common.chunker import FixedSizeChunker
+
+
+class CountingDeuceServer(FakeDeuceServer):
+    """
+    Fake server recording the blocks uploaded to it
+    """
+
+    def __init__(self):
+        super(CountingDeuceServer, self).__init__()
+        self.uploaded = []
+
+    def put_block(self, vault, block, query, body):
+        self.uploaded.append(block)
+        return super(CountingDeuceServer, self).put_block(vault, block,
+                                                          query, body)
+
+
+class UploadFileTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CountingDeuceServer()
+        cls.server.Start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.Stop()
+
+    def setUp(self):
+        self.server.Reset()
+        self.server.uploaded = []
+        self.directory = tempfile.mkdtemp()
+        self.client = DeuceClient(False, StaticAuthenticator(),
+                                  self.server.ApiHost)
+        self.client.CreateVault('vault')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, data, **kwargs):
+        path = os.path.join(self.directory, 'source')
+        with open(path, 'wb') as source:
+            source.write(data)
+        return self.client.UploadFile('vault', path,
+                                      chunker=FixedSizeChunker(1024),
+                                      **kwargs)
+
+    def blockids(self, data):
+        return set(hashlib.sha1(data[offset:offset + 1024]).hexdigest()
+                   for offset in range(0, len(data), 1024))
+
+    def test_upload(self):
+        data = os.urandom(10 * 1024 + 100)
+        fileid = self.upload(data)
+
+        contents = self.server.vaults['vault']
+        self.assertIn(fileid, contents.finalized)
+        self.assertEqual(sorted(contents.files[fileid]),
+                         list(range(0, len(data), 1024)))
+        self.assertEqual(set(contents.blocks), self.blockids(data))
+
+    def test_repeated_blocks_sent_once(self):
+        data = b'\0' * 8 * 1024 + os.urandom(1024)
+        self.upload(data)
+        self.assertEqual(sorted(self.server.uploaded),
+                         sorted(self.blockids(data)))
+
+    def test_known_blocks_not_sent(self):
+        data = os.urandom(8 * 1024)
+        self.upload(data)
+        self.server.uploaded = []
+
+        # The same file again sends no block at all
+        fileid = self.upload(data)
+        self.assertEqual(self.server.uploaded, [])
+        self.assertIn(fileid, self.server.vaults['vault'].finalized)
+
+        # A changed file only sends its new blocks
+        changed = data[:4 * 1024] + os.urandom(1024) + data[5 * 1024:]
+        self.upload(changed, batch_size=3)
+        self.assertEqual(set(self.server.uploaded),
+                         self.blockids(changed) - self.blockids(data))